@@ -1,3 +1,4 @@
+import sys
 import xtrack as xt
 from pathlib import Path
 from ruamel.yaml import YAML
@@ -6,29 +7,47 @@ import time
 start = time.time()
 
 from knob_tools import set_cavity_frequency, add_phase_knob, add_mo_knob, add_tuning_knobs, check_knobs, \
-                       set_correctors
-from slice_tools import slice_env
-from tuning_tools import tune_line
+                       set_correctors, set_knobs
+from tuning_tools import tune_lines_parallel
+from storage_tools import store_env
+from pipeline_tools import Stage
+from profiling_tools import step, start_profiling, write_report
 
 
 # Paths
 path_acc_models = Path("/eos/project-c/collimation-team/machine_configurations/acc-models/lhc/2025")
 path_optics = Path("/afs/cern.ch/eng/lhc/optics/runIII/RunIII_dev")
 path_scenarios = Path("/eos/project-c/collimation-team/machine_configurations/LHC_run3/2025/scenarios")
-outfile = Path("lattices/injection_clean.json")
+outfile = Path("lattices/injection_clean.json")  # The lattice of record, so JSON (see storage_tools.store_env)
+rebuild = False  # Rebuild even if the output is up to date (see pipeline_tools.Stage)
+profile = None  # 'cprofile' or 'sampling' to add a profile to the report (see profiling_tools)
+path_reports = Path("reports")  # Where the timing and memory report of every run is written
 
 # Load the configuration
 config = yaml.load(path_scenarios / 'injection.yaml')
 settings_clean = {'qx': 62.28,  'qy': 60.31,  'dqx': 0,  'dqy': 0,  'i_mo': 0,   'c_minus': 0}
 # settings_clean = {'qx': 62.31,  'qy': 60.32,  'dqx': 0,  'dqy': 0,  'i_mo': 0,   'c_minus': 0}  # After tune-change
 
+# Skip if the lattice is already built from the same inputs
+stage = Stage('build_clean_lattice', outputs=[outfile],
+              files=[path_acc_models / "lhc.seq", path_optics / config['optics'], path_scenarios / 'injection.yaml'],
+              values={'settings_clean': settings_clean})
+if stage.is_up_to_date() and not rebuild:
+    print(f"{outfile} is up to date")
+    sys.exit()
+
 
 # =================================================================================================
 
 
+if profile:
+    start_profiling(profile)
+
 # Load the model
-env = xt.load_madx_lattice(path_acc_models / "lhc.seq", reverse_lines=['lhcb2'])
-env.vars.load_madx(path_optics / config['optics'])
+with step('load_madx_lattice'):
+    env = xt.load_madx_lattice(path_acc_models / "lhc.seq", reverse_lines=['lhcb2'])
+with step('load_optics'):
+    env.vars.load_madx(path_optics / config['optics'])
 env.vars.default_to_zero = False
 for line in env.lines.values():
     line.particle_ref = xt.Particles.reference_from_pdg_id('proton', p0c=config['knob_settings']['nrj']*1e9)
@@ -44,20 +63,21 @@ set_correctors(env)
 check_knobs(env, config)
 
 
-# Apply the knob settings for this scneario
-for knob, val in config['knob_settings'].items():
-    env.vars[knob] = val
+# Apply the knob settings for this scneario (all at once)
+set_knobs(env, config['knob_settings'])
 
 
-# # Slice
-# slice_env(env, slicefactor=4)
+# # Slice (the slicing is cached in lattices/sliced; see slice_tools.benchmark_slicing to choose the slicefactor)
+# from slice_tools import slice_env
+# slice_env(env, slicefactor=4, cache_dir=Path("lattices/sliced"))
 
 
-# Tuning
-for line in env.lines.values():
-    tune_line(line, **settings_clean)
+# Tuning (both beams at the same time, each on its own circuits)
+tune_lines_parallel(env, {linename: settings_clean for linename in env.lines})
 
 
 # Save the environment
-env.to_json(outfile)
+store_env(env, outfile)
+stage.done()
 print(f"Building took {time.time() - start:.2f} seconds")
+print(f"Report written to {write_report(path_reports)}")
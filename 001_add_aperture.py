@@ -1,20 +1,37 @@
-import xtrack as xt
+import sys
 from pathlib import Path
 import time
 start = time.time()
 
+from orbit_tools import store_orbit_response, orbit_response_file
+from storage_tools import store_env, load_env, record_file
+from pipeline_tools import Stage
+from profiling_tools import start_profiling, write_report
+
 
 # Paths
 path_acc_models = Path("/eos/project-c/collimation-team/machine_configurations/acc-models/lhc/2025")
 path_layout = Path("/eos/project-c/collimation-team/machine_configurations/layout_db/files/LHC")
 infile = Path("lattices/injection_clean.json")
-outfile = Path("lattices/injection_clean_with_apertures.json")
+outfile = Path("lattices/injection_clean_with_apertures.xenv")  # Binary cache for 002 (see storage_tools.store_env), or .json
+rebuild = False  # Rebuild even if the output is up to date (see pipeline_tools.Stage)
+profile = None  # 'cprofile' or 'sampling' to add a profile to the report (see profiling_tools)
+path_reports = Path("reports")  # Where the timing and memory report of every run is written
 
 
 # =================================================================================================
 
+# Skip if the apertures are already added to the same clean lattice
+stage = Stage('add_aperture', outputs=[outfile, record_file(outfile), orbit_response_file(outfile)], files=[infile])
+if stage.is_up_to_date() and not rebuild:
+    print(f"{outfile} is up to date")
+    sys.exit()
+
+if profile:
+    start_profiling(profile)
+
 # Load the environment and the configuration
-env = xt.Environment.from_json(infile)
+env = load_env(infile)
 
 # TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO
 # TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO TODO
@@ -27,6 +44,12 @@ print("TODO TODO: aperture not yet implemented")
 # Step two: misalign aperture and elements based on the mech_sep (is important in the doglegs, both for
 #           aperture and feeddown effects from errors)
 
-# Save the environment
-env.to_json(outfile)
+# Store the orbit response for the trajectory corrections (before saving, such that the corrector
+# knobs are saved as well)
+store_orbit_response(env, orbit_response_file(outfile))
+
+# Save the environment, with its lattice of record as JSON (the base of the seed deltas in 002)
+store_env(env, outfile, record=True)
+stage.done()
 print(f"Adding apertures took {time.time() - start:.2f} seconds")
+print(f"Report written to {write_report(path_reports)}")
@@ -1,78 +1,65 @@
-import xtrack as xt
+import sys
 from pathlib import Path
 from ruamel.yaml import YAML
 yaml = YAML(typ='safe')
 import time
 start = time.time()
 
-from knob_tools import disable_crossing, enable_crossing
-from tfs_tools import store_twiss_reference
-from error_tools import add_error_knobs, load_error_table, assign_errors, consider_micado
-from tuning_tools import tune_environment_from_config
-from correction_tools import run_fortran_correction, load_fortran_correction
+from campaign_tools import add_errors_for_seed, run_campaign, seed_stage
+from profiling_tools import start_profiling, write_report
 
 
-seed = 6
+# Seeds to run, e.g. `python 002_add_errors.py 1 60` runs seeds 1 to 60 in parallel
+seeds = range(int(sys.argv[1]), int(sys.argv[2]) + 1) if len(sys.argv) > 2 else [6]
+n_processes = None  # Defaults to the number of cores
+store_full = False  # Store the full environment instead of only the changes w.r.t. the clean lattice
+fortran_correction = True  # Use the corr_MB_ats_v4 executable instead of correction_tools.run_mb_correction
+solver = 'newton'  # Tune with Newton steps on a cached response matrix ('match' to use line.match only)
+parallel_tuning = True  # Tune both beams at the same time (in a campaign only for the preparation)
+rebuild = False  # Rerun seeds even if their output is up to date (see pipeline_tools.Stage)
+profile = None  # 'cprofile' or 'sampling' to add a profile to the report (only of this process, see profiling_tools)
 
 
 # Paths
 path_errors = Path("/eos/project-c/collimation-team/machine_configurations/lhcerrors")
 path_scenarios = Path("/eos/project-c/collimation-team/machine_configurations/LHC_run3/2025/scenarios")
-infile = Path("lattices/injection_clean_with_apertures.json")
-outfile = Path(f"lattices/injection_with_errors_s{seed}.json")
+path_scratch = Path("scratch")
+path_reports = Path("reports")  # Where the timing and memory report of every run is written
+infile = Path("lattices/injection_clean_with_apertures.xenv")
+outfile = Path("lattices/injection_with_errors_s{seed}.json")
 
 
 # Load the configuration
 config = yaml.load(path_scenarios / 'injection.yaml')
 
+# Skip the seeds of which the output is already made from the same inputs
+stages = {seed: seed_stage(seed, config, infile, outfile, path_errors, store_full=store_full,
+                           fortran_correction=fortran_correction, solver=solver, parallel_tuning=parallel_tuning)
+          for seed in seeds}
+seeds = [seed for seed in seeds if rebuild or not stages[seed].is_up_to_date()]
+if not seeds:
+    print("All seeds are up to date")
+    sys.exit()
 
-# =================================================================================================
-
-
-# Load the environment
-env = xt.Environment.from_json(infile)
-
-
-# Set knobs and store the reference optics for correction later
-add_error_knobs(env)
-store_twiss_reference(env)
-tw_for_orbit_corr = {linename: line.twiss() for linename, line in env.lines.items()}
-disable_crossing(env, config)
-
-
-# Tune the environment to its nominal settings, such that the relative errors are representative
-tune_environment_from_config(env, config)
-
-
-# Load the error tables
-tt_err, tt_rot = load_error_table(env, path_errors, seed, rotation_table=True)
 
-# Errors for the Main Dipoles, Separation Dipoles, and Quadrupoles
-assign_errors(env, tt_err, tt_rot, dipoles=True, separation_dipoles=True, quadrupoles=True)
-
-# # Errors for the (Skew) Sextupoles and Octupoles
-# # Only fidel tables have errors for these magnets
-# tt_err = load_error_table(env, path_errors, seed, table_type='fidel')
-# assign_errors(env, tt_err, tt_rot, sextupoles=True, skew_sextupoles=True, octupoles=True)
-
-
-
-# Do the correction (for the time being, with the FORTRAN code)
-run_fortran_correction(env, path_errors)
-load_fortran_correction(env)
-
-
-# First micado if needed, then restore the crossing knobs
-consider_micado(env)
-enable_crossing(env, config)
-
-
-# Final tuning
-tune_environment_from_config(env, config, tw_for_orbit_corr)
-for line in env.lines. values():
-    line.twiss_default.pop("method", None)
+# =================================================================================================
 
 
-# Store the environment with errors
-env.to_json(outfile)
-print(f"Error assignments took {time.time() - start:.2f} seconds")
+if profile:
+    start_profiling(profile)
+
+# Load the environment, assign the errors, correct, tune, and store (see campaign_tools)
+if len(seeds) == 1:
+    add_errors_for_seed(seeds[0], config, infile, outfile, path_errors, store_full=store_full,
+                        fortran_correction=fortran_correction, solver=solver, parallel_tuning=parallel_tuning)
+    stages[seeds[0]].done()
+    print(f"Error assignments took {time.time() - start:.2f} seconds")
+else:
+    summary = run_campaign(seeds, config, infile, outfile, path_errors, path_scratch=path_scratch,
+                           n_processes=n_processes, store_full=store_full, fortran_correction=fortran_correction,
+                           solver=solver, parallel_tuning=parallel_tuning,
+                           summary_file=Path("lattices/injection_with_errors_summary.json"))
+    for seed in seeds:
+        if seed not in summary['failed']:
+            stages[seed].done()
+print(f"Report written to {write_report(path_reports, seeds=seeds)}")
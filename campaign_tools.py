@@ -0,0 +1,236 @@
+import json
+import multiprocessing
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from knob_tools import disable_crossing, enable_crossing
+from tfs_tools import store_twiss_reference
+from twiss_tools import cached_twiss
+from orbit_tools import get_trajectory_correction, load_orbit_response, orbit_response_file
+from error_tools import add_error_knobs, load_error_table, error_table_files, assign_errors, consider_micado
+from tuning_tools import tune_environment_from_config
+from correction_tools import run_fortran_correction, load_fortran_correction, run_mb_correction
+from storage_tools import store_env, load_env, store_delta, is_env_file, record_file
+from pipeline_tools import Stage
+from profiling_tools import timed, step_stats, reset_steps, merge_step_stats
+
+
+# Set by run_campaign before forking the workers, such that they share the seed-independent state
+_prepared = None
+
+
+@timed()
+def prepare_environment(config, infile, path_temp='temp', solver='match', parallel_tuning=False):
+    # Everything that does not depend on the seed: returns the environment and the reference twiss
+    # for the orbit correction, and writes the reference optics for the MB correction in path_temp.
+    # With solver='newton', the tuning response matrices are calculated here as well, such that
+    # forked workers reuse them (see tuning_tools.match_tune_chrom_coupling_newton). With
+    # parallel_tuning, the beams are tuned at the same time (see tuning_tools.tune_lines_parallel).
+
+    # Load the environment
+    env = load_env(infile)
+
+    # Set knobs and store the reference optics for correction later
+    add_error_knobs(env)
+    store_twiss_reference(env, path_temp=path_temp)
+    # Same machine state as for the reference optics, so these come from the twiss cache
+    tw_for_orbit_corr = {linename: cached_twiss(line) for linename, line in env.lines.items()}
+
+    # The orbit responses are the same for all seeds: load them if they are stored with the lattice,
+    # and build them otherwise (before forking, such that the workers share them). This one is for
+    # the final tuning (see tuning_tools.tune_line)
+    if orbit_response_file(infile).exists():
+        load_orbit_response(env, orbit_response_file(infile))
+    for linename, line in env.lines.items():
+        get_trajectory_correction(line, twiss_table=tw_for_orbit_corr[linename])
+    disable_crossing(env, config)
+
+    # Tune the environment to its nominal settings, such that the relative errors are representative
+    tune_environment_from_config(env, config, solver=solver, parallel=parallel_tuning)
+
+    # The reference of the micado is the error-free orbit of this state (see consider_micado)
+    env.vars['on_errors'] = 0
+    for line in env.lines.values():
+        get_trajectory_correction(line, twiss_table=cached_twiss(line))
+    env.vars['on_errors'] = 1
+    return env, tw_for_orbit_corr
+
+
+@timed()
+def add_errors_for_seed(seed, config, infile, outfile, path_errors, path_temp='temp', store_full=False,
+                        prepared=None, fortran_correction=True, solver='match', parallel_tuning=False):
+    # The outfile can contain {seed}, e.g. 'lattices/injection_with_errors_s{seed}.json'.
+    # Unless store_full is True, only the delta w.r.t. the infile is stored (as .delta.json); for a
+    # binary infile, w.r.t. its lattice of record (see storage_tools.store_delta).
+    # If prepared (the output of prepare_environment) is given, it is used (and modified) instead
+    # of preparing the environment again; the reference optics files should then be in path_temp.
+    # With fortran_correction=False, the MB correction is calculated in-process (see
+    # correction_tools.run_mb_correction) instead of with the corr_MB_ats_v4 executable.
+    # The solver ('match' or 'newton') and parallel_tuning are passed to
+    # tuning_tools.tune_environment_from_config (parallel_tuning cannot be used in a campaign worker).
+    outfile = Path(str(outfile).format(seed=seed))
+    if prepared is None:
+        prepared = prepare_environment(config, infile, path_temp=path_temp, solver=solver,
+                                       parallel_tuning=parallel_tuning)
+    env, tw_for_orbit_corr = prepared
+
+    # Load the error tables
+    tt_err, tt_rot = load_error_table(env, path_errors, seed, rotation_table=True, columnar=True)
+
+    # Errors for the Main Dipoles, Separation Dipoles, and Quadrupoles
+    assign_errors(env, tt_err, tt_rot, dipoles=True, separation_dipoles=True, quadrupoles=True)
+
+    # # Errors for the (Skew) Sextupoles and Octupoles
+    # # Only fidel tables have errors for these magnets
+    # tt_err = load_error_table(env, path_errors, seed, table_type='fidel', columnar=True)
+    # assign_errors(env, tt_err, tt_rot, sextupoles=True, skew_sextupoles=True, octupoles=True)
+
+    # Do the correction
+    if fortran_correction:
+        run_fortran_correction(env, path_errors, path_temp=path_temp)
+        load_fortran_correction(env, path_temp=path_temp)
+    else:
+        run_mb_correction(env, path_temp=path_temp)
+
+    # First micado if needed, then restore the crossing knobs
+    consider_micado(env)
+    enable_crossing(env, config)
+
+    # Final tuning
+    tune_environment_from_config(env, config, tw_for_orbit_corr, solver=solver, parallel=parallel_tuning)
+    for line in env.lines.values():
+        line.twiss_default.pop("method", None)
+
+    # Store the environment with errors (the delta can be loaded with storage_tools.load_delta)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    if store_full:
+        store_env(env, outfile)
+    else:
+        store_delta(env, infile, outfile.with_suffix('.delta.json'))
+    return env
+
+
+def seed_stage(seed, config, infile, outfile, path_errors, store_full=False, fortran_correction=True,
+               solver='match', parallel_tuning=False):
+    # The pipeline stage of add_errors_for_seed (see pipeline_tools.Stage), to skip the seeds of
+    # which the output is up to date, and to mark them as done afterwards
+    outfile = Path(str(outfile).format(seed=seed))
+    files = [infile, orbit_response_file(infile), *([record_file(infile)] if is_env_file(infile) else []),
+             *error_table_files(Path(path_errors), seed, config['knob_settings']['nrj'])]
+    if fortran_correction:
+        files.append(Path(path_errors) / "HL-LHC/corr_MB_ats_v4")
+    values = {'seed': seed, 'config': config, 'store_full': store_full, 'fortran_correction': fortran_correction,
+              'solver': solver, 'parallel_tuning': parallel_tuning}
+    return Stage(f'add_errors_s{seed}', outputs=[outfile if store_full else outfile.with_suffix('.delta.json')],
+                 files=files, values=values)
+
+
+def run_campaign(seeds, config, infile, outfile, path_errors, path_scratch='scratch', n_processes=None,
+                 store_full=False, keep_scratch=False, summary_file=None, prepare_once=True,
+                 fortran_correction=True, solver='match', parallel_tuning=False):
+    # Run add_errors_for_seed for many seeds in worker processes. Every seed gets its own scratch
+    # directory (path_scratch/s{seed}/temp) such that the correction files do not clash.
+    # With prepare_once, the seed-independent part is done once in this process, and every seed
+    # runs in a fresh worker forked from that state (so the workers cannot affect each other).
+    # Returns a summary with the timing and status of each seed. parallel_tuning only applies to the
+    # preparation, as the workers of the pool cannot fork themselves. The steps timed in the workers
+    # (see profiling_tools) are in the result of every seed, and merged into the ones of this process.
+    global _prepared
+    start = time.time()
+    seeds = list(seeds)
+    path_scratch = Path(path_scratch)
+    n_processes = min(n_processes or multiprocessing.cpu_count(), len(seeds))
+    summary = {'seeds': {}, 'n_processes': n_processes, 'prepare_time': 0}
+    path_prepare = None
+    if prepare_once:
+        path_prepare = path_scratch / 'prepare' / 'temp'
+        _prepared = prepare_environment(config, infile, path_temp=path_prepare, solver=solver,
+                                        parallel_tuning=parallel_tuning)
+        summary['prepare_time'] = time.time() - start
+        print(f"Preparing the environment took {summary['prepare_time']:.2f} seconds")
+    # Fork, such that the workers inherit the prepared state and do not re-import the calling script.
+    # Every seed gets a pool with a single worker of its own: a worker that dies (e.g. killed when
+    # out of memory) only breaks the pool of its seed, which is then recorded as failed.
+    context = multiprocessing.get_context('fork')
+    pending = [(seed, config, infile, outfile, path_errors, path_scratch / f's{seed}', store_full,
+                keep_scratch, path_prepare, fortran_correction, solver) for seed in seeds]
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < n_processes:
+                args = pending.pop(0)
+                executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+                running[executor.submit(_run_seed, args)] = (args, executor, time.time())
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                args, executor, seed_start = running.pop(future)
+                executor.shutdown()
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    result = _died_seed(args, time.time() - seed_start)
+                seed = result['seed']
+                summary['seeds'][seed] = result
+                merge_step_stats(result['steps'])
+                if result['status'] == 'ok':
+                    print(f"Seed {seed} finished in {result['time']:.2f} seconds")
+                else:
+                    print(f"Seed {seed} failed after {result['time']:.2f} seconds:\n{result['error']}")
+    finally:
+        for _, executor, _ in running.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        _prepared = None
+        if path_prepare is not None and not keep_scratch:
+            shutil.rmtree(path_prepare.parent, ignore_errors=True)
+    summary['seeds'] = {seed: summary['seeds'][seed] for seed in seeds}
+    summary['failed'] = [seed for seed, result in summary['seeds'].items() if result['status'] != 'ok']
+    summary['total_time'] = time.time() - start
+    summary['steps'] = step_stats()
+    print(f"Campaign of {len(seeds)} seeds took {summary['total_time']:.2f} seconds "
+          f"({len(summary['failed'])} failed)")
+    if summary_file is not None:
+        Path(summary_file).parent.mkdir(parents=True, exist_ok=True)
+        with Path(summary_file).open('w') as fp:
+            json.dump(summary, fp, indent=1)
+    return summary
+
+
+def _run_seed(args):
+    seed, config, infile, outfile, path_errors, path_work, store_full, keep_scratch, path_prepare, \
+        fortran_correction, solver = args
+    start = time.time()
+    result = {'seed': seed, 'status': 'ok', 'error': None}
+    reset_steps()  # The worker inherits the steps of the parent
+    try:
+        path_temp = path_work / 'temp'
+        prepared = None
+        if path_prepare is not None:
+            # Forked from the prepared state: only the reference optics files need to be copied
+            path_temp.mkdir(parents=True, exist_ok=True)
+            for ff in path_prepare.glob('optics0_MB_*.mad'):
+                shutil.copy(ff, path_temp / ff.name)
+            prepared = _prepared
+        add_errors_for_seed(seed, config, infile, outfile, path_errors, path_temp=path_temp,
+                            store_full=store_full, prepared=prepared, fortran_correction=fortran_correction,
+                            solver=solver)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    if not keep_scratch:
+        shutil.rmtree(path_work, ignore_errors=True)
+    result['time'] = time.time() - start
+    result['steps'] = step_stats()
+    return result
+
+
+def _died_seed(args, seed_time):
+    # The result of a seed of which the worker process died before returning
+    seed, path_work, keep_scratch = args[0], args[5], args[7]
+    if not keep_scratch:
+        shutil.rmtree(path_work, ignore_errors=True)
+    return {'seed': seed, 'status': 'failed', 'error': 'The worker process died unexpectedly', 'time': seed_time,
+            'steps': {}}
@@ -1,48 +1,307 @@
-import xtrack as xt
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
 from pathlib import Path
 from subprocess import run, PIPE
-from tfs_tools import store_errors
+from concurrent.futures import ThreadPoolExecutor
+from xdeps.refs import BaseRef
+from xdeps.tasks import ExprTask
+from tfs_tools import store_errors, get_errors, read_table_columns
+from knob_tools import set_knobs
+from profiling_tools import timed
 
 
-def run_fortran_correction(env, path_errors):
+# The arcs, named after the IPs they connect, and those whose MQT and MQS circuits are used for
+# the tune and coupling knobs
+_ARCS = ['12', '23', '34', '45', '56', '67', '78', '81']
+_KNOB_ARCS = ['23', '34', '67', '78']
+# Lengths as used by corr_MB_ats_v4
+_L_MB  = 14.3
+_L_MQT = 0.32
+_L_MQS = 0.32
+_N_MQT = 8     # MQT per family and arc
+# Spool pieces as (error column, order, is skew, magnet prefix, circuit prefix, length variable)
+_SPOOL_PIECES = [
+    ('K2L',  2, False, 'mcs.', 'kcs', 'l.mcs'),   # b3
+    ('K2SL', 2, True,  'mss.', 'kss', 'l.mss'),   # a3
+    ('K3L',  3, False, 'mco.', 'kco', 'l.mco'),   # b4
+    ('K4L',  4, False, 'mcd.', 'kcd', 'l.mcd'),   # b5
+]
+
+
+@timed()
+def run_fortran_correction(env, path_errors, path_temp='temp', scratch_dir=None):
     # Correction algorithm for MB errors (assigning to spool pieces)
-    env['on_errors'] = 1
-    store_val_on_errors = env['on_errors']
-    env['on_correction'] = 1
-    store_errors(env, pattern=['mb.*', 'mbh.*'])
-    file_opt  = Path('temp/optics0_MB.mad')
-    file_err  = Path('temp/MB.errors')
-    file_corr = Path('temp/MB_corr_setting.mad')
-    for linename, _ in env.lines.items():
-        if file_opt.exists() or file_opt.is_symlink():
-            file_opt.unlink()
-        file_opt.symlink_to(f'optics0_MB_{linename}.mad')
-        if file_err.exists() or file_err.is_symlink():
-            file_err.unlink()
-        file_err.symlink_to(f'MB_{linename}.errors')
-        cmd = run([(path_errors / "HL-LHC/corr_MB_ats_v4").as_posix()], stdout=PIPE, stderr=PIPE)
+    # The executable reads and writes its files in temp/ relative to its working directory, so every
+    # line gets its own scratch directory (on tmpfs if available, or in scratch_dir if given), and
+    # the lines are corrected concurrently. The results end up in path_temp.
+    path_temp = Path(path_temp)
+    executable = (Path(path_errors).resolve() / "HL-LHC/corr_MB_ats_v4").as_posix()
+    set_knobs(env, {'on_errors': 1, 'on_correction': 1})
+    store_errors(env, pattern=['mb.*', 'mbh.*'], path_temp=path_temp)
+    linenames = list(env.lines.keys())
+    with ThreadPoolExecutor(max_workers=len(linenames)) as executor:
+        futures = {linename: executor.submit(_run_fortran_correction_line, executable, linename, path_temp,
+                                             scratch_dir)
+                   for linename in linenames}
+    errors = []
+    for linename, future in futures.items():
+        try:
+            future.result()
+        except Exception as error:
+            errors.append(f"{linename}: {error}")
+    if errors:
+        errors = '\n'.join(errors)
+        raise RuntimeError(f"Correction algorithm failed!\nError given is:\n{errors}")
+
+
+def _run_fortran_correction_line(executable, linename, path_temp, scratch_dir=None):
+    if scratch_dir is None and os.access('/dev/shm', os.W_OK):
+        scratch_dir = '/dev/shm'
+    if scratch_dir is not None:
+        Path(scratch_dir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=f'corr_MB_{linename}_', dir=scratch_dir) as scratch:
+        scratch_temp = Path(scratch) / 'temp'
+        scratch_temp.mkdir()
+        (scratch_temp / 'optics0_MB.mad').symlink_to((path_temp / f'optics0_MB_{linename}.mad').resolve())
+        (scratch_temp / 'MB.errors').symlink_to((path_temp / f'MB_{linename}.errors').resolve())
+        cmd = run([executable], stdout=PIPE, stderr=PIPE, cwd=scratch)
         if cmd.returncode != 0:
-            stderr = cmd.stderr.decode('UTF-8').strip().split('\n')
-            raise RuntimeError(f"Correction algorithm failed!\nError given is:\n{stderr}")
-        file_corr.rename(f'temp/MB_corr_setting_{linename}.mad')
-    env['on_errors'] = store_val_on_errors
+            raise RuntimeError(cmd.stderr.decode('UTF-8').strip())
+        shutil.move(scratch_temp / 'MB_corr_setting.mad', path_temp / f'MB_corr_setting_{linename}.mad')
+
+
+def load_fortran_correction(env, path_temp='temp'):
+    _link_correction_knobs(env)
+    for linename, _ in env.lines.items():
+        settings = read_correction_settings(Path(path_temp) / f'MB_corr_setting_{linename}.mad')
+        settings.pop('prad', None)
+        apply_correction_settings(env, _inline_coefficients(settings))
+
+
+def read_correction_settings(filename):
+    # Read a MAD-X file that only has assignments (like MB_corr_setting_*.mad) into a dict of names
+    # (lower case) to values, or to expressions as strings (that can be given to env.new_expr).
+    # Other statements are ignored, and so are non-finite values (the executable gives +-Infinity
+    # for circuits without magnets).
+    lines = []
+    with Path(filename).open('r') as fp:
+        for line in fp.readlines():
+            lines.append(re.split(r'!|//', line, maxsplit=1)[0])
+    settings = {}
+    for statement in ' '.join(lines).split(';'):
+        match = re.fullmatch(r'\s*([A-Za-z_][\w.]*)\s*:?=\s*(.*?)\s*', statement)
+        if match is None or 'infinity' in match.group(2).lower():
+            continue
+        name, ex = match.group(1).lower(), match.group(2).lower()
+        try:
+            settings[name] = float(ex)
+        except ValueError:
+            settings[name] = ' '.join(ex.split())
+    return settings
+
+
+def _inline_coefficients(settings):
+    # The coefficients of the coupling knobs (b11, b12, ...) have the same names for both beams, so
+    # they are put directly into the kqs expressions instead
+    coefficients = {nn: vv for nn, vv in settings.items() if re.fullmatch(r'b\d\d', nn)}
+    result = {}
+    for nn, ex in settings.items():
+        if nn in coefficients:
+            continue
+        if isinstance(ex, str):
+            ex = re.sub(r'\bb\d\d\b', lambda mm: repr(coefficients[mm.group(0)]), ex)
+        result[nn] = ex
+    return result
+
+
+@timed()
+def run_mb_correction(env, optics=None, path_temp='temp'):
+    # In-process replacement of run_fortran_correction followed by load_fortran_correction: the
+    # spool-piece, MQT and MQS settings are calculated from the MB errors in the environment and
+    # the reference optics, without any files or external executable.
+    # The optics is a dict per line as given by tfs_tools.get_twiss_reference (on the error-free
+    # lattice); if not given, it is read from the files written by store_twiss_reference (which are
+    # rewritten for every seed, so they are not cached).
+    # Returns the settings per line (see compute_mb_correction).
+    if optics is None:
+        optics = {linename: read_table_columns(Path(path_temp) / f'optics0_MB_{linename}.mad', cache_dir=None)
+                  for linename in env.lines}
+    set_knobs(env, {'on_errors': 1, 'on_correction': 1})
+    errors = get_errors(env, pattern=['mb.*', 'mbh.*'])
+    settings = {linename: compute_mb_correction(optics[linename], errors[linename], beam=int(linename[-1]))
+                for linename in env.lines}
+    _link_correction_knobs(env)
+    for linename in env.lines:
+        apply_correction_settings(env, settings[linename])
+    return settings
+
+
+def compute_mb_correction(optics, errors, beam):
+    # Same algorithm as corr_MB_ats_v4, per arc:
+    #  - b2: the MQT families compensate the tune shift of the MB errors (on top of their present
+    #    strength, and linked to the kqtf/kqtd knobs in the knob arcs),
+    #  - a2: the MQS circuits of the knob arcs give the cmrs/cmis coupling knobs (minimum norm),
+    #  - b3, b4, b5: the spool pieces compensate the average MB error,
+    #  - a3: the MSS compensate the chromatic coupling of the MB errors (least squares), and the MSS
+    #    of the knob arcs also what remains of it over the whole ring.
+    # The optics and errors are dicts of columns (as read_table_columns of optics0_MB_*.mad and
+    # MB_*.errors), and the result is a dict of MAD-X variables to values or expressions (strings),
+    # the same as in the MB_corr_setting_*.mad file of the executable.
+    # The executable gives +-Infinity for the spool pieces of an arc without any of them (e.g. no
+    # MCO), those circuits are skipped here instead.
+    # Checked against the executable in tests/test_mb_correction.py (the dkqtf/dkqtd only against the
+    # tune shift of the MB errors, as the reference has no b2 errors).
+    bb = f'b{beam}'
+    opt_name = np.asarray(optics['name'], dtype=str)
+    opt_arc = _arc_from_names(opt_name)
+    err_arc = _arc_from_names(errors['name'])
+    row = {nn: i for i, nn in enumerate(opt_name.tolist())}
+    mb_rows = np.array([row[nn] for nn in errors['name']], dtype=int)
+    betx = np.asarray(optics['BETX'], dtype=float)
+    bety = np.asarray(optics['BETY'], dtype=float)
+    phase = np.exp(2j*np.pi*(np.asarray(optics['MUX'], dtype=float) - np.asarray(optics['MUY'], dtype=float)))
+    coupling = np.sqrt(betx*bety) * phase / (2*np.pi)
+    chromatic_coupling = np.asarray(optics['DX'], dtype=float) * np.sqrt(betx*bety) * phase
+    is_mqt = np.char.startswith(opt_name, 'mqt.')
+    is_mqs = np.char.startswith(opt_name, 'mqs.')
+    settings = {}
+
+    # b2-correction
+    settings[f'kqtf.{bb}'] = 0.
+    settings[f'kqtd.{bb}'] = 0.
+    k1l = _beam_sign(beam, 1, False) * np.asarray(errors['K1L'], dtype=float)
+    odd_cell = np.array([int(re.match(r'[^.]+\.(\d*)', nn).group(1) or 0) % 2 == 1 for nn in opt_name])
+    for arc in _ARCS:
+        in_arc = err_arc == arc
+        odd_focusing = _alternates(arc, beam)
+        focusing = is_mqt & (opt_arc == arc) & (odd_cell == odd_focusing)
+        defocusing = is_mqt & (opt_arc == arc) & (odd_cell != odd_focusing)
+        matrix = _L_MQT * np.array([[betx[focusing].sum(), betx[defocusing].sum()],
+                                    [-bety[focusing].sum(), -bety[defocusing].sum()]])
+        shift = np.array([(k1l[in_arc] * betx[mb_rows[in_arc]]).sum(),
+                          -(k1l[in_arc] * bety[mb_rows[in_arc]]).sum()])
+        if np.all(shift == 0) or np.linalg.det(matrix) == 0:
+            dkqtf, dkqtd = 0., 0.
+        else:
+            dkqtf, dkqtd = np.linalg.solve(matrix, -shift)
+        # The present strength of the circuit (some MQT might be unplugged)
+        kqtf = float(np.sum(optics['K1L'][focusing])) / _N_MQT / _L_MQT
+        kqtd = float(np.sum(optics['K1L'][defocusing])) / _N_MQT / _L_MQT
+        knob = 1.0 if arc in _KNOB_ARCS else 0.0
+        settings[f'dkqtf.a{arc}{bb}'] = float(dkqtf)
+        settings[f'dkqtd.a{arc}{bb}'] = float(dkqtd)
+        settings[f'kqtf.a{arc}{bb}'] = f'{kqtf!r} + dkqtf.a{arc}{bb} + {knob}*kqtf.{bb}'
+        settings[f'kqtd.a{arc}{bb}'] = f'{kqtd!r} + dkqtd.a{arc}{bb} + {knob}*kqtd.{bb}'
 
+    # a2-correction: the response of c- to each knob arc, inverted
+    settings['cmrskew'] = 0.
+    settings['cmiskew'] = 0.
+    response = np.array([coupling[is_mqs & (opt_arc == arc)].sum() for arc in _KNOB_ARCS])
+    knobs = -_beam_sign(beam, 1, True) * np.linalg.pinv(np.array([response.real, response.imag])) / _L_MQS
+    knobs = {arc: knobs[_KNOB_ARCS.index(arc)] if arc in _KNOB_ARCS else np.zeros(2) for arc in _ARCS}
+    for arc in _ARCS:
+        for circuit in _kqs_circuits(arc, beam):
+            settings[f'kqs.{circuit}{bb}'] = f'{float(knobs[arc][0])!r}*cmrskew + {float(knobs[arc][1])!r}*cmiskew'
 
-def load_fortran_correction(env):
+    # b3, a3, b4 and b5-correction
+    for column, order, is_skew, prefix, circuit, length in _SPOOL_PIECES:
+        kl = _beam_sign(beam, order, is_skew) * np.asarray(errors[column], dtype=float)
+        is_spool = np.char.startswith(opt_name, prefix)
+        if is_skew:
+            values = _chromatic_coupling_correction(kl, err_arc, mb_rows, [is_spool & (opt_arc == arc) for arc in _ARCS],
+                                                    chromatic_coupling)
+        for arc in _ARCS:
+            spools = is_spool & (opt_arc == arc)
+            if is_skew:
+                value = values[arc]
+            else:
+                if not np.any(spools):
+                    continue
+                value = -kl[err_arc == arc].sum() / spools.sum() / _L_MB
+            settings[f'{circuit}.a{arc}{bb}'] = f'{float(value)!r} / {length}'
+    return settings
+
+
+def _chromatic_coupling_correction(kl, err_arc, mb_rows, spools, chromatic_coupling):
+    # Every arc compensates its own chromatic coupling as well as it can with one circuit (least
+    # squares). What remains of the total is then compensated by the knob arcs, with the smallest
+    # change to their own settings (minimum norm). The spools are a mask per arc (in _ARCS order), and
+    # an arc without any gets no setting.
+    response = np.array([chromatic_coupling[spools[i]].sum() for i in range(len(_ARCS))])
+    error = np.array([(kl[err_arc == arc] * chromatic_coupling[mb_rows[err_arc == arc]]).sum() for arc in _ARCS])
+    values = np.zeros(len(_ARCS))
+    has_spools = np.abs(response) > 0
+    values[has_spools] = -np.real(error[has_spools] * np.conj(response[has_spools])) / np.abs(response[has_spools])**2
+    knob_arcs = np.array([arc in _KNOB_ARCS for arc in _ARCS])
+    remaining = (error + values * response).sum()
+    matrix = np.array([response[knob_arcs].real, response[knob_arcs].imag])
+    values[knob_arcs] -= np.linalg.pinv(matrix) @ np.array([remaining.real, remaining.imag])
+    return {arc: float(value) / _L_MB for arc, value in zip(_ARCS, values)}
+
+
+def apply_correction_settings(env, settings):
+    # Settings of existing variables are added to them, the others are created. All settings are
+    # put in place first, and everything that depends on them is recomputed once at the end.
+    manager = env.ref_manager
+    changed = []
+    for nn, ex in settings.items():
+        if isinstance(ex, str):
+            ex = env.new_expr(ex)
+        ref = env._xdeps_vref[nn]
+        if nn in env.vars:
+            ex = (manager.tasks[ref].expr if ref in manager.tasks else env[nn]) + ex
+        if ref in manager.tasks:
+            manager.unregister(ref)
+        if isinstance(ex, BaseRef):
+            manager.register(ExprTask(ref, ex))
+            ex = ex._get_value()
+        ref._set_value(ex)
+        changed.append(ref)
+    manager.run_tasks(manager.find_tasks(changed))
+
+
+def _link_correction_knobs(env):
     env['kqtf.b1'] = env.ref['kqtf']
     env['kqtf.b2'] = env.ref['kqtf']
     env['kqtd.b1'] = env.ref['kqtd']
     env['kqtd.b2'] = env.ref['kqtd']
     env['cmrskew'] = env.ref['cmrs']
     env['cmiskew'] = env.ref['cmis']
-    for linename, _ in env.lines.items():
-        new_env = xt.Environment()
-        new_env.vars.load_madx(f'temp/MB_corr_setting_{linename}.mad')
-        vart = new_env.vars.get_table()
-        for nn, ex in zip(vart.name, vart.expr):
-            if nn in env.vars:
-                if nn != 'prad':
-                    ex = 0 or ex
-                    env.ref[nn] += ex
-            else:
-                env[nn] = ex
+
+
+def _arc_from_names(names):
+    # The arc of each magnet from its name, e.g. mb.a8r1.b1 and mb.a8l2.b1 are in arc 12
+    arcs = []
+    for nn in names:
+        match = re.match(r'[^.]+\.[a-z]*\d+([rl])(\d)', nn)
+        if match is None:
+            arcs.append('')
+            continue
+        ip = int(match.group(2))
+        if match.group(1) == 'l':
+            ip = ip - 1 if ip > 1 else 8
+        arcs.append(_ARCS[ip - 1])
+    return np.array(arcs, dtype=str)
+
+
+def _alternates(arc, beam):
+    # The arc layout alternates from arc to arc, and is opposite for both beams: in these arcs the
+    # odd MQT are focusing, and the MQS are powered per side of the arc
+    return (_ARCS.index(arc) % 2 == 0) == (beam == 1)
+
+
+def _kqs_circuits(arc, beam):
+    # e.g. kqs.r1b1 and kqs.l2b1 in arc 12, and kqs.a23b1 in arc 23
+    if _alternates(arc, beam):
+        return [f'r{arc[0]}', f'l{arc[1]}']
+    return [f'a{arc}']
+
+
+def _beam_sign(beam, order, is_skew):
+    # The errors of beam 2 are given in the reversed (beam 4) frame
+    if beam == 1:
+        return 1
+    return (-1)**order if is_skew else (-1)**(order + 1)
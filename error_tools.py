@@ -1,6 +1,12 @@
 import numpy as np
 from math import factorial
-from tfs_tools import read_table
+from xdeps.tasks import ExprTask
+from tfs_tools import read_table_columns, columns_to_rows
+from index_tools import get_element_index
+from twiss_tools import cached_twiss
+from orbit_tools import correct_trajectory
+from knob_tools import set_knobs
+from profiling_tools import step, timed
 
 _MAX_ORDER = 15  # Maximum order of errors to be assigned
 
@@ -19,13 +25,27 @@ def add_error_knobs(env):
         if f'on_b{i}r' not in env.vars: env[f'on_b{i}r'] = 1
 
 
-def load_error_table(env, path, seed, table_type='wise', rotation_table=False):
+def error_table_files(path, seed, nrj, table_type='wise'):
+    # The error table and the rotation table as read by load_error_table
+    nrj = 'collision' if nrj > 2000 else 'injection'
+    return path / f'LHC/{table_type}/{nrj}_errors-emfqcs-{seed}.tfs', path / 'LHC/rotations_Q2_integral.tab'
+
+
+@timed()
+def load_error_table(env, path, seed, table_type='wise', rotation_table=False, columnar=False,
+                     cache_dir='temp/tfs_cache'):
+    # With columnar=True the tables are returned as dicts of NumPy arrays instead of dicts of dicts.
+    # Parsed tables are cached in cache_dir (set to None to always parse the text files).
     if table_type not in ['wise', 'fidel']:
         raise ValueError(f"Invalid table_type: {table_type}. Choose 'wise' or 'fidel'.")
-    nrj = 'collision' if env['nrj'] > 2000 else 'injection'
-    tt_err = read_table(path / f'LHC/{table_type}/{nrj}_errors-emfqcs-{seed}.tfs')
+    error_file, rotation_file = error_table_files(path, seed, env['nrj'], table_type=table_type)
+    tt_err = read_table_columns(error_file, cache_dir=cache_dir)
+    if not columnar:
+        tt_err = columns_to_rows(tt_err)
     if rotation_table:
-        tt_rot = read_table(path / 'LHC/rotations_Q2_integral.tab')
+        tt_rot = read_table_columns(rotation_file, cache_dir=cache_dir)
+        if not columnar:
+            tt_rot = columns_to_rows(tt_rot)
         return tt_err, tt_rot
     else:
         return tt_err
@@ -63,148 +83,350 @@ def assign_errors_single_magnet(env, name, error_list, order, kl_ref, is_skew=Fa
                             kl_ref * (Rr**(order-i)) * factorial(i) / factorial(order)
 
 
+def map_error_table(env, error_table, rotation_table):
+    # Resolve all slots of the error table to the element names in the environment, in one go. Per
+    # element: the row in the table, the slot name, the element name, whether it is rotated (from the
+    # rotation table) or in beam 4, and its status ('ok', 'vetoed' if unplugged, or 'unmatched' if it
+    # does not exist). The mapping is cached per lattice, such that repeated seeds reuse it.
+    names, beams, _, _ = _error_columns(error_table)
+    return _map_slots(env, names, beams, _rotated_names(rotation_table))
+
+
+def mismatch_report(mapping, mask=None):
+    # The unmatched and vetoed slots of a mapping (optionally only those in mask)
+    report = {}
+    for status in ['unmatched', 'vetoed']:
+        this_mask = mapping['status'] == status
+        if mask is not None:
+            this_mask &= mask
+        report[status] = [{'row': int(row), 'slot': str(slot), 'element': str(element)}
+                          for row, slot, element in zip(mapping['row'][this_mask],
+                              mapping['slot'][this_mask], mapping['element'][this_mask])]
+    return report
+
+
+@timed()
 def assign_errors(env, error_table, rotation_table, dipoles=False, separation_dipoles=False,
                   quadrupoles=False, sextupoles=False, skew_sextupoles=False, octupoles=False,
                   corrector_dipoles=False, corrector_sextupoles=False, corrector_skew_sextupoles=False,
                   corrector_octupoles=False, corrector_skew_octupoles=False, corrector_decapoles=False,
-                  corrector_dodecapoles=False):
-    # Some magnets are unplugged from the lattice (put as Drifts), so we veto them
-    veto = _veto_for_errors(env)
+                  corrector_dodecapoles=False, frozen=False, Rr=0.017):
+    # The error and rotation tables can be in the dict-of-dicts format or in the columnar format
+    # (see load_error_table). The errors are grouped per magnet family, and the sign flips and
+    # scaling factors are calculated for all magnets at once (see assign_errors_single_magnet for
+    # the conventions).
+    # The deferred expressions still need one task per knl/ksl entry, but these are registered
+    # directly, with a single update of whatever depends on them (see _add_knl_ksl_expressions).
+    # With frozen=True, the errors are assigned as numbers instead of deferred expressions, written
+    # per element array. This is much faster and lighter, but the error knobs (on_errors, on_b3s,
+    # ...) no longer have any effect.
+    # Every family is timed as a step (see profiling_tools), e.g. assign_errors[quadrupoles].
+    # Returns a report of the slots that could not be assigned (see map_error_table).
+    if frozen:
+        env.metadata['frozen_errors'] = True
+    names, beams, an_table, bn_table = _error_columns(error_table)
+    mapping = _map_slots(env, names, beams, _rotated_names(rotation_table))
+    report = {'unmatched': [], 'vetoed': []}
 
     # First do the main dipoles, and a micado if k0 errors are assigned
     if dipoles:
-        _extend_order_knl_ksl(env, 'mb\..*')
-        for nn, err in error_table.items():
-            if nn.startswith('mb.'):
-                name, beam, magnets = _get_name_from_slot(nn, err)
-                is_rotated = _is_rotated(name, rotation_table)
-                for this_name in magnets:
-                    if this_name in veto: continue
-                    if this_name not in env.elements:
-                        print(f"Warning: {this_name} not found in environment, not assigning errors.")
-                        continue
-                    assign_errors_single_magnet(env, this_name, err, order=0, is_skew=False,
-                                                kl_ref=1e-4 * env.ref[this_name].k0 * env[this_name].length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-        consider_micado(env)
-
-    # Now all the other magnets
-    startswith = []
+        with step('assign_errors[dipoles]'):
+            _extend_order_knl_ksl(env, 'mb\..*')
+            # The error-free orbit cannot be recovered after freezing, so we compute it now
+            tw_ref = {linename: cached_twiss(line) for linename, line in env.lines.items()} \
+                     if frozen and _needs_micado(env) else None
+            rows = [i for i, nn in enumerate(names) if nn.startswith('mb.')]
+            report = _merge_reports(report, _assign_errors_batch(env, mapping, rows, names, an_table,
+                                      bn_table, families=[_MAIN_DIPOLES], frozen=frozen, Rr=Rr))
+        consider_micado(env, tw_ref=tw_ref)
+
+    # Now all the other magnets, as (flag, prefixes in the error table)
+    groups = []
     if separation_dipoles:
         _extend_order_knl_ksl(env, 'mb[^.].*')
-        startswith += ['mb']
+        groups.append(('separation_dipoles', ('mb',)))
     if quadrupoles:
         _extend_order_knl_ksl(env, 'mq\..*')
-        startswith += ['mq.']
+        groups.append(('quadrupoles', ('mq.',)))
     if sextupoles:
         _extend_order_knl_ksl(env, 'ms\..*')
-        startswith += ['ms.']
+        groups.append(('sextupoles', ('ms.',)))
     if skew_sextupoles:
         _extend_order_knl_ksl(env, 'mss\..*')
-        startswith += ['mss.']
+        groups.append(('skew_sextupoles', ('mss.',)))
     if octupoles:
         _extend_order_knl_ksl(env, 'mo\..*')
-        startswith += ['mo.']
+        groups.append(('octupoles', ('mo.',)))
     if corrector_dipoles:
         _extend_order_knl_ksl(env, 'mcb.*')
-        startswith += ['mcb.']
+        groups.append(('corrector_dipoles', ('mcb.',)))
     if corrector_sextupoles:
         _extend_order_knl_ksl(env, 'mcs\..*')
         _extend_order_knl_ksl(env, 'mcsx\..*')
-        startswith += ['mcs.', 'mcsx.']
+        groups.append(('corrector_sextupoles', ('mcs.', 'mcsx.')))
     if corrector_skew_sextupoles:
         _extend_order_knl_ksl(env, 'mcssx\..*')
-        startswith += ['mcssx.']
+        groups.append(('corrector_skew_sextupoles', ('mcssx.',)))
     if corrector_octupoles:
         _extend_order_knl_ksl(env, 'mco\..*')
         _extend_order_knl_ksl(env, 'mcox\..*')
-        startswith += ['mco.', 'mcox.']
+        groups.append(('corrector_octupoles', ('mco.', 'mcox.')))
     if corrector_skew_octupoles:
         _extend_order_knl_ksl(env, 'mcosx\..*')
-        startswith += ['mcosx.']
+        groups.append(('corrector_skew_octupoles', ('mcosx.',)))
     if corrector_decapoles:
         _extend_order_knl_ksl(env, 'mcd\..*')
-        startswith += ['mcd.']
+        groups.append(('corrector_decapoles', ('mcd.',)))
     if corrector_dodecapoles:
         _extend_order_knl_ksl(env, 'mctx\..*')
-        startswith += ['mctx.']
-    store_val_on_b2s = env['on_b2s']
-    env['on_b2s'] = 0
-    for nn, err in error_table.items():
-        if any([nn.startswith(start) for start in startswith]):
-            if nn.startswith('mb.'):
-                # Main Dipole, already handled above
+        groups.append(('corrector_dodecapoles', ('mctx.',)))
+    # When frozen, the final value of on_b2s has to be used to get the same strengths as deferred
+    with set_knobs(env, {} if frozen else {'on_b2s': 0}, restore=True):
+        # Main Dipoles are already handled above
+        for group, startswith in groups:
+            with step(f'assign_errors[{group}]'):
+                rows = [i for i, nn in enumerate(names) if nn.startswith(startswith) and not nn.startswith('mb.')]
+                report = _merge_reports(report, _assign_errors_batch(env, mapping, rows, names, an_table, bn_table,
+                                                                     families=_FAMILIES, frozen=frozen, Rr=Rr))
+    if report['unmatched']:
+        print(f"Warning: {len(report['unmatched'])} magnets not found in environment, not assigning "
+              f"errors: {', '.join(ss['element'] for ss in report['unmatched'])}")
+    return report
+
+
+# Magnet families as (prefixes in the error table, order of the main field, is skew, follows the
+# magnetic sign convention, attribute of the reference strength). The first matching family is used.
+_MAIN_DIPOLES = (('mb.',), 0, False, True, 'k0')
+_FAMILIES = [
+    (('mb', 'mcb'), 0, False, True, 'k0'),               # (Separation and Corrector) Dipoles
+    # Quadrupoles don't seem to follow the magnetic sign convention. Not sure why...
+    (('mq.',), 1, False, False, 'k1'),                   # Quadrupoles
+    (('ms.', 'mcs.', 'mcsx.'), 2, False, True, 'k2'),    # Sextupoles
+    (('mss.', 'mcssx.'), 2, True, True, 'k2s'),          # Skew Sextupoles
+    (('mo.', 'mco.', 'mcox.'), 3, False, True, 'k3'),    # Octupoles
+    (('mcosx.',), 3, True, True, 'k3s'),                 # Skew Octupoles
+    (('mcd.',), 4, False, True, None),                   # Decapoles
+    (('mctx.',), 5, False, True, None),                  # Dodecapoles
+]
+
+
+def _assign_errors_batch(env, mapping, rows, names, an_table, bn_table, families, frozen=False,
+                         Rr=0.017):
+    # Family of each table row (the first matching one), or -1 if none matches
+    table_family = np.full(len(names), -1)
+    names = np.asarray(names, dtype=str)
+    for ii in reversed(range(len(families))):
+        for prefix in families[ii][0]:
+            table_family[np.char.startswith(names, prefix)] = ii
+    selected = np.zeros(len(names), dtype=bool)
+    selected[np.asarray(rows, dtype=int)] = True
+    selected &= table_family >= 0
+
+    # Collect all magnets to assign, together with their family and row in the error table
+    in_rows = selected[mapping['row']]
+    report = mismatch_report(mapping, in_rows)
+    assign = in_rows & (mapping['status'] == 'ok')
+    magnet_names = mapping['element'][assign].tolist()
+    if len(magnet_names) == 0:
+        return report
+    magnet_rows = mapping['row'][assign]
+    magnet_families = [families[ii] for ii in table_family[magnet_rows]]
+    magnet_rotated = mapping['is_rotated'][assign]
+    is_beam4 = mapping['is_beam4'][assign]
+
+    # Sign flips and scaling factors, for all magnets and all orders at once
+    magnet_rows = np.array(magnet_rows, dtype=int)
+    order = np.array([ff[1] for ff in magnet_families])
+    is_skew = np.array([ff[2] for ff in magnet_families])
+    magnetic_sign = np.array([ff[3] for ff in magnet_families])
+    yfac = np.where(magnetic_sign, -1, 1) * np.where(is_beam4, -1, 1) * np.where(magnet_rotated, -1, 1)
+    kl_sign = np.where(yfac < 0, (-1.)**order * np.where(is_skew, -1, 1), 1)
+    idx = np.arange(_MAX_ORDER)  # Index in knl/ksl, i.e. the b{idx+1} and a{idx+1} errors
+    bn = np.where(idx%2 == 1, bn_table[magnet_rows] * yfac[:, None], bn_table[magnet_rows])
+    an = np.where(idx%2 == 0, an_table[magnet_rows] * yfac[:, None], an_table[magnet_rows])
+    fact = np.array([factorial(i) for i in range(_MAX_ORDER)], dtype=float)
+    scale = kl_sign[:, None] * Rr**(order[:, None] - idx[None, :]) * fact[None, :] / fact[order][:, None]
+    coef_knl = 1e-4 * bn * scale
+    coef_ksl = 1e-4 * an * scale
+
+    # Reference strengths (as value or as expression) times the length
+    kl_ref = []
+    for this_name, (_, this_order, this_skew, _, kref_attr) in zip(magnet_names, magnet_families):
+        ee = env[this_name]
+        eeref = ee if frozen else env.ref[this_name]
+        if kref_attr is not None and hasattr(ee, kref_attr):
+            kref = getattr(eeref, kref_attr)
+        else:
+            kref = eeref.ksl[this_order] if this_skew else eeref.knl[this_order]
+        kl_ref.append(kref * ee.length)
+
+    if frozen:
+        on_bn = np.array([env[f'on_b{i+1}s'] for i in idx], dtype=float)
+        on_an = np.array([env[f'on_a{i+1}s'] for i in idx], dtype=float)
+        kl_ref = np.array(kl_ref, dtype=float)[:, None] * env['on_errors']
+        _add_knl_ksl(env, magnet_names, coef_knl * on_bn[None, :] * kl_ref,
+                     coef_ksl * on_an[None, :] * kl_ref)
+    else:
+        # The knob products are shared by all expressions
+        on_bn = [env.vars['on_errors'] * env.vars[f'on_b{i+1}s'] for i in idx]
+        on_an = [env.vars['on_errors'] * env.vars[f'on_a{i+1}s'] for i in idx]
+        _add_knl_ksl_expressions(env, magnet_names, kl_ref, coef_knl, coef_ksl, on_bn, on_an)
+    return report
+
+
+def _add_knl_ksl(env, names, knl, ksl):
+    # Add numerical values to knl and ksl, directly on the element arrays. Entries that are
+    # controlled by an expression go through the expression, otherwise they would be overwritten.
+    driven = _expression_targets(env, attrs=('knl', 'ksl'))
+    for this_name, this_knl, this_ksl in zip(names, knl, ksl):
+        el = env._element_dict[this_name]
+        for attr, values in [('knl', this_knl), ('ksl', this_ksl)]:
+            values = values.copy()
+            for i in np.flatnonzero(values):
+                if (this_name, attr, i) in driven:
+                    getattr(env[this_name], attr)[i] += float(values[i])
+                    values[i] = 0
+            getattr(el, attr)[:len(values)] += values
+
+
+def _add_knl_ksl_expressions(env, names, kl_ref, coef_knl, coef_ksl, on_bn, on_an):
+    # Add coef * on_bn[i] * kl_ref (as deferred expression) to knl[i] and ksl[i] of every element,
+    # as ee.knl[i] += ... would (the current value plus the new term), but without a set_value per
+    # entry: the tasks are registered directly, the values are written per element array, and the
+    # tasks depending on any of the entries are run once at the end.
+    manager = env.ref_manager
+    dependencies = set()
+    for this_name, this_kl_ref, this_knl, this_ksl in zip(names, kl_ref, coef_knl, coef_ksl):
+        element_ref = env.ref[this_name]
+        el = env._element_dict[this_name]
+        for attr, coefs, on in [('knl', this_knl, on_bn), ('ksl', this_ksl, on_an)]:
+            nonzero = np.flatnonzero(coefs)
+            if len(nonzero) == 0:
                 continue
-            name, beam, magnets = _get_name_from_slot(nn, err)
-            is_rotated = _is_rotated(name, rotation_table)
-            for this_name in magnets:
-                if this_name in veto: continue
-                if this_name not in env.elements:
-                    print(f"Warning: {this_name} not found in environment, not assigning errors.")
-                    continue
-                ee = env[this_name]
-                eeref = env.ref[this_name]
-                if nn.startswith('mb') or nn.startswith('mcb'):
-                    kref = eeref.k0 if hasattr(ee, 'k0') else eeref.knl[0]
-                    assign_errors_single_magnet(env, this_name, err, order=0, is_skew=False,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-                elif nn.startswith('mq.'):
-                    # Quadrupole
-                    # These don't seem to follow the magnetic sign convention. Not sure why...
-                    kref = eeref.k1 if hasattr(ee, 'k1') else eeref.knl[1]
-                    assign_errors_single_magnet(env, this_name, err, order=1, is_skew=False,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017,
-                                                magnetic_sign=False)
-                elif nn.startswith('ms.') or nn.startswith('mcs.') or nn.startswith('mcsx.'):
-                    # Sextupole
-                    kref = eeref.k2 if hasattr(ee, 'k2') else eeref.knl[2]
-                    assign_errors_single_magnet(env, this_name, err, order=2, is_skew=False,
-                                                kl_ref=1e-4 * kref* ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-                elif nn.startswith('mss.') or nn.startswith('mcssx.'):
-                    # Skew Sextupole
-                    kref = eeref.k2s if hasattr(ee, 'k2s') else eeref.ksl[2]
-                    assign_errors_single_magnet(env, this_name, err, order=2, is_skew=True,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-                elif nn.startswith('mo.') or nn.startswith('mco.') or nn.startswith('mcox.'):
-                    # Octupole
-                    kref = eeref.k3 if hasattr(ee, 'k3') else eeref.knl[3]
-                    assign_errors_single_magnet(env, this_name, err, order=3, is_skew=False,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-                elif nn.startswith('mcosx.'):
-                    # Skew Octupole
-                    kref = eeref.k3s if hasattr(ee, 'k3s') else eeref.ksl[3]
-                    assign_errors_single_magnet(env, this_name, err, order=3, is_skew=True,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-                elif nn.startswith('mcd.'):
-                    # Decapole
-                    kref = eeref.knl[4]
-                    assign_errors_single_magnet(env, this_name, err, order=4, is_skew=False,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-                elif nn.startswith('mctx.'):
-                    # Dodecapole
-                    kref = eeref.knl[5]
-                    assign_errors_single_magnet(env, this_name, err, order=5, is_skew=False,
-                                                kl_ref=1e-4 * kref * ee.length,
-                                                is_rotated=is_rotated, is_beam4=(beam==2), Rr=0.017)
-    env['on_b2s'] = store_val_on_b2s
-
-
-def consider_micado(env):
-    if env.vars['on_errors'] and (env['on_a1s'])**2 + (env['on_a1r'])**2 \
-                               + (env['on_b1s'])**2 + (env['on_b1r'])**2 > 0:
+            attr_ref = getattr(element_ref, attr)
+            values = getattr(el, attr).copy()
+            for i in nonzero:
+                target = attr_ref[int(i)]
+                if target in manager.tasks:
+                    manager.unregister(target)
+                expr = float(values[i]) + float(coefs[i]) * on[i] * this_kl_ref
+                manager.register(ExprTask(target, expr))
+                values[i] = expr._get_value()
+                dependencies.update(target._get_dependencies())
+            getattr(el, attr)[:] = values
+    manager.run_tasks(manager.find_tasks(list(dependencies)))
+
+
+def _expression_targets(env, attrs):
+    # All (element name, attribute, index) that are the target of a deferred expression
+    targets = set()
+    for ref in env.ref_manager.tasks:
+        owner = getattr(ref, '_owner', None)
+        if getattr(owner, '_key', None) in attrs and hasattr(owner, '_owner'):
+            targets.add((owner._owner._key, owner._key, ref._key))
+    return targets
+
+
+def _error_columns(error_table):
+    # Names, beams, and the an and bn errors as arrays (one row per table entry)
+    if 'name' in error_table and isinstance(error_table['name'], np.ndarray):
+        names = error_table['name'].tolist()
+        n_rows = len(names)
+        columns = error_table
+    else:
+        names = list(error_table.keys())
+        n_rows = len(names)
+        keys = {kk for err in error_table.values() for kk in err}
+        columns = {kk: np.array([err.get(kk, 0.) for err in error_table.values()], dtype=float)
+                   for kk in keys}
+    beams = np.asarray(columns.get('beam', np.zeros(n_rows)), dtype=float)
+    an_table = np.zeros((n_rows, _MAX_ORDER))
+    bn_table = np.zeros((n_rows, _MAX_ORDER))
+    for i in range(_MAX_ORDER):
+        if f'a{i+1}' in columns:
+            an_table[:, i] = columns[f'a{i+1}']
+        if f'b{i+1}' in columns:
+            bn_table[:, i] = columns[f'b{i+1}']
+    return names, beams, an_table, bn_table
+
+
+def _rotated_names(rotation_table):
+    if 'name' in rotation_table and isinstance(rotation_table['name'], np.ndarray):
+        mask = np.isclose(rotation_table['YROTA'], 180)
+        return set(rotation_table['name'][mask].tolist())
+    return {nn for nn in rotation_table if _is_rotated(nn, rotation_table)}
+
+
+@timed()
+def consider_micado(env, tw_ref=None):
+    # The reference orbit is the one without errors, unless tw_ref (a dict per line) is given.
+    # The trajectory correction is reused for references with the same optics (see
+    # orbit_tools.get_trajectory_correction).
+    if _needs_micado(env):
+        if tw_ref is None and env.metadata.get('frozen_errors', False):
+            raise ValueError("The errors are frozen, so the error-free reference orbit cannot be "
+                             "computed. Please provide tw_ref.")
         print("Correcting trajectory with Micado")
-        for line in env.lines.values():
-            env.vars['on_errors'] = 0
-            tw_ref = line.twiss()
-            env.vars['on_errors'] = 1
-            line.correct_trajectory(twiss_table=tw_ref, n_micado=5, n_iter=1)
+        for linename, line in env.lines.items():
+            if tw_ref is None:
+                env.vars['on_errors'] = 0
+                this_tw_ref = cached_twiss(line)
+                env.vars['on_errors'] = 1
+            else:
+                this_tw_ref = tw_ref[linename]
+            correct_trajectory(line, twiss_table=this_tw_ref, n_micado=5, n_iter=1)
+
+
+def _needs_micado(env):
+    return env.vars['on_errors'] and (env['on_a1s'])**2 + (env['on_a1r'])**2 \
+                                   + (env['on_b1s'])**2 + (env['on_b1r'])**2 > 0
+
+
+def _map_slots(env, names, beams, rotated):
+    # Vectorised version of _get_name_from_slot, together with the rotation, beam-4, veto and
+    # existence checks (see map_error_table)
+    index = get_element_index(env)
+    beam = np.round(np.asarray(beams, dtype=float)).astype(int)
+    key = ('error_table_mapping', hash(tuple(names)), hash(beam.tobytes()), hash(frozenset(rotated)))
+    if key in index.cache:
+        return index.cache[key]
+
+    names = np.asarray(names, dtype=str)
+    shared = beam == 0
+    # Slots like mq.12r1.v2 are named without the .v2 suffix
+    is_v = (np.char.rfind(names, '.v') == np.char.str_len(names) - 3) & ~shared
+    slot = names.copy()
+    slot[is_v] = [nn[:-3] for nn in names[is_v]]
+
+    # Shared slots give one element per line
+    n_elements = np.where(shared, 2, 1)
+    row = np.repeat(np.arange(len(names)), n_elements)
+    first = np.arange(len(row)) - np.repeat(np.cumsum(n_elements) - n_elements, n_elements) == 0
+    suffix = np.where(shared[row], np.where(first, '/lhcb1', '/lhcb2'),
+                      np.char.add('.b', beam[row].astype(str)))
+    element = np.char.add(slot[row], suffix)
+
+    status = np.full(len(row), 'ok', dtype='<U9')
+    status[~np.isin(element, list(env._element_dict.keys()))] = 'unmatched'
+    # Some magnets are unplugged from the lattice (put as Drifts), so we veto them
+    status[np.isin(element, list(_veto_for_errors(env)))] = 'vetoed'
+
+    mapping = {
+        'row': row,
+        'slot': slot[row],
+        'element': element,
+        'is_rotated': np.isin(slot, list(rotated))[row],
+        'is_beam4': beam[row] == 2,
+        'status': status,
+    }
+    for vv in mapping.values():
+        vv.flags.writeable = False
+    index.cache[key] = mapping
+    return mapping
+
+
+def _merge_reports(report, other):
+    return {kk: report[kk] + other[kk] for kk in report}
 
 
 def _get_name_from_slot(name, error_list):
@@ -221,25 +443,17 @@ def _get_name_from_slot(name, error_list):
 def _extend_order_knl_ksl(env, pattern, order=_MAX_ORDER):
     # Some magnets are unplugged from the lattice (put as Drifts).
     # With this function we extend the knl/ksl arrays but skip the unplugged.
-    for line in env.lines.values():
-        tt = line.get_table()
-        mask = ~np.array([nn.startswith('Limit') or nn.startswith('Drift') or nn.startswith('Marker')
-                          for nn in tt.element_type])
-        line.extend_knl_ksl(order=order, element_names=list(tt.rows[mask].rows[pattern].name))
+    index = get_element_index(env)
+    for linename, line in env.lines.items():
+        line.extend_knl_ksl(order=order, element_names=list(index[linename].names(pattern)))
 
 def _veto_for_errors(env):
     # Get all the unplugged magnets in both lines.
-    veto = np.array([])
-    if 'lhcb1' in env.lines:
-        tt_1 = env['lhcb1'].get_table()
-        mask = np.array([nn.startswith('Limit') or nn.startswith('Drift') or nn.startswith('Marker')
-                        for nn in tt_1.element_type])
-        veto = np.concatenate((veto, tt_1.rows[mask].name))
-    if 'lhcb2' in env.lines:
-        tt_2 = env['lhcb2'].get_table()
-        mask = np.array([nn.startswith('Limit') or nn.startswith('Drift') or nn.startswith('Marker')
-                        for nn in tt_2.element_type])
-        veto = np.concatenate((veto, tt_2.rows[mask].name))
+    index = get_element_index(env)
+    veto = set()
+    for linename in ['lhcb1', 'lhcb2']:
+        if linename in index:
+            veto |= index[linename].unplugged
     return veto
 
 def _is_rotated(name, rotation_table):
@@ -0,0 +1,198 @@
+import re
+import hashlib
+import weakref
+import numpy as np
+from xdeps.refs import Ref, ItemRef, AttrRef
+
+
+# Element types that are not real magnets (e.g. unplugged magnets are put as Drifts)
+UNPLUGGED_TYPES = ('Drift', 'Limit', 'Marker')
+
+_indices = weakref.WeakKeyDictionary()
+
+
+def get_element_index(env):
+    # The index is built once per environment, and rebuilt when the element names of a line change.
+    # If elements are replaced without changing their names, use invalidate_element_index.
+    key = _lattice_key(env)
+    index = _indices.get(env)
+    if index is None or index.key != key:
+        index = ElementIndex(env, key)
+        _indices[env] = index
+    return index
+
+
+def invalidate_element_index(env):
+    _indices.pop(env, None)
+
+
+class ElementIndex:
+    # Per line: element name, type, family, beam, plugged status, and s position, as arrays in the
+    # order of line.get_table(), together with set and dict lookups.
+    def __init__(self, env, key=None):
+        self.key = _lattice_key(env) if key is None else key
+        self.lines = {linename: LineIndex(linename, line) for linename, line in env.lines.items()}
+        # Other lookups that only depend on the lattice (e.g. the error table mapping), such that
+        # they are dropped together with the index
+        self.cache = {}
+
+    def __getitem__(self, linename):
+        return self.lines[linename]
+
+    def __contains__(self, linename):
+        return linename in self.lines
+
+
+class LineIndex:
+    def __init__(self, linename, line):
+        tt = line.get_table()
+        self.linename = linename
+        self.name = np.array(tt.name, dtype=str)
+        self.element_type = np.array(tt.element_type, dtype=str)
+        self.s = np.array(tt.s, dtype=float)
+        self.family = np.array([nn.split('.')[0] for nn in self.name], dtype=str)
+        self.beam = int(linename[-1]) if linename[-1].isdigit() else 0
+        self.plugged = ~self.type_mask(UNPLUGGED_TYPES)
+        self.plugged_names = set(self.name[self.plugged].tolist())
+        self.unplugged = set(self.name[~self.plugged].tolist())
+        self.row = {nn: i for i, nn in enumerate(self.name.tolist())}
+        self._pattern_masks = {}
+
+    def __contains__(self, name):
+        return name in self.row
+
+    def type_mask(self, element_types):
+        return np.array([et.startswith(tuple(element_types)) for et in self.element_type], dtype=bool)
+
+    def mask(self, *patterns, exclude_types=UNPLUGGED_TYPES):
+        # Rows matching all regex patterns (full match, as in table.rows[pattern]) and not of the
+        # excluded element types
+        mask = ~self.type_mask(exclude_types) if exclude_types != UNPLUGGED_TYPES else self.plugged.copy()
+        for pattern in patterns:
+            if pattern not in self._pattern_masks:
+                regex = re.compile(pattern)
+                self._pattern_masks[pattern] = np.array([regex.fullmatch(nn) is not None
+                                                         for nn in self.name], dtype=bool)
+            mask &= self._pattern_masks[pattern]
+        return mask
+
+    def names(self, *patterns, exclude_types=UNPLUGGED_TYPES):
+        return self.name[self.mask(*patterns, exclude_types=exclude_types)]
+
+
+def line_digest(line):
+    # Like the lattice key, but stable over processes (to store with the environment)
+    return hashlib.sha1('\n'.join(line.element_names).encode()).hexdigest()
+
+
+def _lattice_key(env):
+    return tuple((linename, len(line.element_names), hash(tuple(line.element_names)))
+                 for linename, line in env.lines.items())
+
+
+_dependency_indices = weakref.WeakKeyDictionary()
+
+# Containers of the expression graph that are nodes of the dependency index
+_NODE_KINDS = {'vars': 'vars', 'element_refs': 'elements'}
+
+
+def get_dependency_index(env):
+    # The index is built once per environment, and every expression that was added, removed or
+    # replaced since the last call (e.g. env.ref['kqtf.a12b1'] += ...) is picked up (see refresh).
+    index = _dependency_indices.get(env)
+    if index is None:
+        index = DependencyIndex(env)
+        _dependency_indices[env] = index
+    else:
+        index.refresh()
+    return index
+
+
+class DependencyIndex:
+    # Forward (what a node depends on) and reverse (what depends on a node) edges of the expression
+    # graph, where the nodes are variables ('vars', name) and elements ('elements', name). The
+    # transitive queries are cached until the graph changes.
+    def __init__(self, env):
+        self.manager = env.ref_manager
+        self.forward = {}
+        self.reverse = {}
+        self._tasks = {}
+        self._closures = {}
+        for task in list(self.manager.tasks.values()):
+            self._add_task(task)
+
+    def driven_vars(self, name):
+        # All variables that depend (directly or not) on the variable name
+        return self._closure('vars', name, self.reverse, 'vars')
+
+    def driven_elements(self, name):
+        # All elements with an attribute that depends (directly or not) on the variable name
+        return self._closure('vars', name, self.reverse, 'elements')
+
+    def knobs_of(self, name, element=False):
+        # All variables that the variable (or element) name depends on, directly or not
+        return self._closure('elements' if element else 'vars', name, self.forward, 'vars')
+
+    def refresh(self):
+        # Pick up expressions that were added, removed or replaced since the index was built. Every
+        # new expression is a new task, so the tasks are compared by identity (which is much
+        # faster than looking up their targets). The tasks in the index are kept alive, so their
+        # ids cannot be reused by new ones.
+        tasks = {id(task): task for task in self.manager.tasks.values()}
+        if tasks.keys() == self._tasks.keys():
+            return
+        for task_id in self._tasks.keys() - tasks.keys():
+            self._remove_task(task_id)
+        for task_id in tasks.keys() - self._tasks.keys():
+            self._add_task(tasks[task_id])
+
+    def _closure(self, kind, name, edges, result_kind):
+        key = (kind, name, id(edges), result_kind)
+        if key not in self._closures:
+            seen = set()
+            todo = [(kind, name)]
+            while todo:
+                for node in edges.get(todo.pop(), ()):
+                    if node not in seen:
+                        seen.add(node)
+                        todo.append(node)
+            self._closures[key] = frozenset(nn for kk, nn in seen if kk == result_kind)
+        return self._closures[key]
+
+    def _add_task(self, task):
+        targets = {_node(ref) for ref in task.targets} - {None}
+        dependencies = {_node(ref) for ref in task.dependencies} - {None}
+        self._tasks[id(task)] = task
+        for target in targets:
+            for dependency in dependencies:
+                _count(self.forward, target, dependency, 1)
+                _count(self.reverse, dependency, target, 1)
+        self._closures.clear()
+
+    def _remove_task(self, task_id):
+        task = self._tasks.pop(task_id)
+        targets = {_node(ref) for ref in task.targets} - {None}
+        dependencies = {_node(ref) for ref in task.dependencies} - {None}
+        for target in targets:
+            for dependency in dependencies:
+                _count(self.forward, target, dependency, -1)
+                _count(self.reverse, dependency, target, -1)
+        self._closures.clear()
+
+
+def _node(ref):
+    # The variable or element a reference belongs to (e.g. element_refs['mq'].knl[0] -> ('elements', 'mq'))
+    while isinstance(ref, (ItemRef, AttrRef)) and not isinstance(ref._owner, Ref):
+        ref = ref._owner
+    if not isinstance(ref, ItemRef) or not isinstance(ref._owner, Ref):
+        return None
+    kind = _NODE_KINDS.get(ref._owner._key)
+    return None if kind is None else (kind, ref._key)
+
+
+def _count(edges, node, other, increment):
+    # Edges are counted, as the same pair can come from several expressions (e.g. knl[0] and ksl[0])
+    counts = edges.setdefault(node, {})
+    counts[other] = counts.get(other, 0) + increment
+    if counts[other] == 0:
+        del counts[other]
@@ -1,22 +1,101 @@
 import xtrack as xt
 import numpy as np
 import scipy.constants as sc
+from xdeps.refs import BaseRef
+from xdeps.tasks import ExprTask
+
+from index_tools import get_element_index, get_dependency_index, line_digest
+from profiling_tools import timed
 
 
 def disable_crossing(env, config=None):
     if config:
-        for knob, _ in config['knob_settings'].items():
-            if knob.startswith('on_'):
-                env.vars[knob] = 0
+        set_knobs(env, {knob: 0 for knob in config['knob_settings'] if knob.startswith('on_')})
     else:
-        for knob in env.vars.get_table().name:
-            if knob.startswith('on_'):
-                env.vars[knob] = 0
+        set_knobs(env, {knob: 0 for knob in env.vars.keys() if knob.startswith('on_')})
 
 def enable_crossing(env, config):
-    for knob, val in config['knob_settings'].items():
-        if knob.startswith('on_'):
-            env.vars[knob] = val
+    set_knobs(env, {knob: val for knob, val in config['knob_settings'].items() if knob.startswith('on_')})
+
+
+def set_knobs(env, settings, restore=False):
+    # Set all knobs (values or expressions) at once, with a single update of everything that depends
+    # on them (see KnobTransaction). Can be used to set knobs temporarily as well:
+    #     with set_knobs(env, {'on_b2s': 0}, restore=True):
+    #         ...
+    transaction = KnobTransaction(env, restore=restore)
+    transaction.update(settings)
+    transaction.commit()
+    return transaction
+
+
+class KnobTransaction:
+    # Knobs set on the transaction are not propagated to the expressions and elements that depend on
+    # them until commit (or the end of the with block), which updates each of those once (in
+    # dependency order) instead of once per knob. With restore=True, the previous values (or
+    # expressions) are set back in the same way at the end of the with block; knobs that did not
+    # exist before keep their value.
+    def __init__(self, env, restore=False):
+        self.env = env
+        self.restore = restore
+        self._pending = {}
+        self._previous = {}
+
+    def __setitem__(self, name, value):
+        self._set(name, value)
+
+    def __getitem__(self, name):
+        # The value as set (the knobs depending on it are only updated on commit)
+        return self.env[name]
+
+    def update(self, settings):
+        for name, value in settings.items():
+            self._set(name, value)
+
+    def commit(self):
+        manager = self.env.ref_manager
+        refs = [self.env._xdeps_vref[name] for name in self._pending]
+        manager.run_tasks(manager.find_tasks(refs))
+        for container in self.env.vars.vars_to_update:
+            for name, value in self._pending.items():
+                container[name] = value
+        self._pending = {}
+
+    def rollback(self):
+        previous = self._previous
+        self._previous = {}
+        for name, value in previous.items():
+            if value is not None:
+                self._set(name, value, record=False)
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commit()
+        if self.restore:
+            self.rollback()
+
+    def _set(self, name, value, record=True):
+        # As env.vars[name] = value, without running the tasks that depend on it
+        env = self.env
+        env._check_name_clashes(name, check_vars=False)
+        if isinstance(value, str):
+            value = env._xdeps_eval.eval(value)
+        ref = env._xdeps_vref[name]
+        if record and name not in self._previous:
+            previous = env._xdeps_vref._owner.get(name)
+            self._previous[name] = ref._expr if name in env.vars and ref._expr is not None else previous
+        manager = env.ref_manager
+        if ref in manager.tasks:
+            manager.unregister(ref)
+        if isinstance(value, BaseRef):
+            manager.register(ExprTask(ref, value))
+            ref._set_value(value._get_value())
+        else:
+            ref._set_value(value)
+        self._pending[name] = value
 
 
 def check_knobs(env, config=None):
@@ -123,44 +202,56 @@ def add_tuning_knobs(env, injection=False):
         env.vars[f'cmis.b{beam}_sq'] = env.ref['on_sq'] * env.ref['cmis']
 
 
-def set_correctors(env):
-    crossing_knobs = {'on_a2', 'on_a8', 'on_disp', 'on_o2', 'on_o8', 'on_oh1', 'on_oh2', 'on_oh5', 'on_oh8', 'on_ov1',
-                    'on_ov2', 'on_ov5', 'on_ov8', 'on_sep1', 'on_sep2h', 'on_sep2v', 'on_sep5', 'on_sep8h', 'on_sep8v',
-                    'on_ssep1', 'on_ssep5', 'on_x1', 'on_x2h', 'on_x2v', 'on_x5', 'on_x8h', 'on_x8v', 'on_xx1', 'on_xx5'}
-    crossing_currents = set()
-    for nn in env.vars.get_table().name:
-        if env.vars[nn]._expr is None:
-            continue
-        deps = {vv._key for vv in env.vars[nn]._expr._get_dependencies()}
-        if any([vvv in crossing_knobs for vvv in deps]):
-            crossing_currents.add(nn)
-    crossing_correctors = {vvv._key for vv in crossing_currents for vvv in env.vars[vv]._find_dependant_targets()}
+# Knobs of the crossing scheme, of which the orbit correctors cannot be used for steering
+_CROSSING_KNOBS = {'on_a2', 'on_a8', 'on_disp', 'on_o2', 'on_o8', 'on_oh1', 'on_oh2', 'on_oh5', 'on_oh8', 'on_ov1',
+                   'on_ov2', 'on_ov5', 'on_ov8', 'on_sep1', 'on_sep2h', 'on_sep2v', 'on_sep5', 'on_sep8h', 'on_sep8v',
+                   'on_ssep1', 'on_ssep5', 'on_x1', 'on_x2h', 'on_x2v', 'on_x5', 'on_x8h', 'on_x8v', 'on_xx1', 'on_xx5'}
 
-    for line in env.lines.values():
-        tt = line.get_table()
-        mask = ~np.array([nn.startswith('Limit') or nn.startswith('Drift') or nn.startswith('Marker')
-                          for nn in tt.element_type])
-        tt_h_correctors = tt.rows[mask].rows['mcb.*'].rows['.*h\..*'].name
-        line.steering_correctors_x = list({nn for nn in tt_h_correctors if nn not in crossing_correctors})
-        tt_v_correctors = tt.rows[mask].rows['mcb.*'].rows['.*v\..*'].name
-        line.steering_correctors_y = list({nn for nn in tt_v_correctors if nn not in crossing_correctors})
-
-        mask = ~np.array([nn.startswith('Limit') for nn in tt.element_type])
-        # tt_monitors = tt.rows[mask].rows['bpm.*'].rows['.*(?<!_entry)$'].rows['.*(?<!_exit)$'].name
-        tt_monitors = tt.rows[mask].rows['bpm\..*'].rows['.*(?<!_entry)$'].rows['.*(?<!_exit)$'].name
-        tt_monitors = [nn for nn in tt_monitors if not nn.startswith('bpmwa')]
-        tt_monitors = [nn for nn in tt_monitors if not nn.startswith('bpmwb')]
-        tt_monitors = [nn for nn in tt_monitors if not nn.startswith('bpmse')]
-        tt_monitors = [nn for nn in tt_monitors if not nn.startswith('bpmsd')]
-        # Remove double-counted monitors (multiple at same s), keep shortest name
-        monitors_by_s = {}
-        for nn, ss in zip(tt.name, tt.s):
-            if nn in tt_monitors:
-                ss_key = [sss for sss in monitors_by_s.keys() if np.isclose(ss, sss, atol=0.001)]
-                if not ss_key:
-                    monitors_by_s[ss] = [nn]
-                else:
-                    monitors_by_s[ss_key[0]].append(nn)
-        tt_monitors = [min(nn, key=len) for nn in monitors_by_s.values()]
+
+@timed()
+def set_correctors(env, force=False):
+    # The steering correctors (the orbit correctors that are not driven by the crossing knobs) and
+    # monitors (one per position) of every line. These are saved with the environment, and the
+    # lattice they were selected for is kept in env.metadata['steering'], such that they are only
+    # selected again if the lattice changed (or if force is True).
+    index = get_element_index(env)
+    steering = env.metadata.get('steering', {})
+    if not force and all(steering.get(linename) == line_digest(line)
+                         and line.steering_correctors_x is not None and line.steering_monitors_x is not None
+                         for linename, line in env.lines.items()):
+        return
+
+    # All elements driven by the crossing knobs (through the crossing currents)
+    dependencies = get_dependency_index(env)
+    crossing_correctors = set().union(*[dependencies.driven_elements(kk) for kk in _CROSSING_KNOBS])
+
+    steering = {}
+    for linename, line in env.lines.items():
+        tt = index[linename]
+        tt_h_correctors = dict.fromkeys(tt.names('mcb.*', '.*h\..*').tolist())
+        line.steering_correctors_x = [nn for nn in tt_h_correctors if nn not in crossing_correctors]
+        tt_v_correctors = dict.fromkeys(tt.names('mcb.*', '.*v\..*').tolist())
+        line.steering_correctors_y = [nn for nn in tt_v_correctors if nn not in crossing_correctors]
+
+        mask = tt.mask('bpm\..*', '.*(?<!_entry)$', '.*(?<!_exit)$', exclude_types=['Limit'])
+        mask &= ~np.isin(tt.name.astype('<U5'), ['bpmwa', 'bpmwb', 'bpmse', 'bpmsd'])
+        tt_monitors = _unique_by_s(tt.name[mask], tt.s[mask])
         line.steering_monitors_x = tt_monitors
         line.steering_monitors_y = tt_monitors
+        steering[linename] = line_digest(line)
+    env.metadata['steering'] = steering
+
+
+def _unique_by_s(names, s, atol=0.001, rtol=1e-5):
+    # One monitor per position, keeping the shortest name: monitors within np.isclose tolerance of
+    # the first monitor of a group (in order of s) belong to that group
+    order = np.argsort(s, kind='stable')
+    names = names[order].tolist()
+    s = s[order]
+    unique = []
+    start = 0
+    while start < len(s):
+        end = np.searchsorted(s, s[start] + atol + rtol*abs(s[start]), side='right')
+        unique.append(min(names[start:end], key=len))
+        start = end
+    return unique
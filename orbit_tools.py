@@ -0,0 +1,123 @@
+import hashlib
+import weakref
+from collections import OrderedDict
+import numpy as np
+import xtrack as xt
+from pathlib import Path
+
+from index_tools import line_digest
+from twiss_tools import cached_twiss
+
+
+# The trajectory corrections per environment, as {(linename, selection key, optics key): TrajectoryCorrection},
+# of which the _MAX_CORRECTIONS most recently used are kept
+_corrections = weakref.WeakKeyDictionary()
+_MAX_CORRECTIONS = 8
+
+# The twiss columns the corrections are built from, which are stored (see store_orbit_response)
+_STORED_COLUMNS = ['s', 'betx', 'bety', 'mux', 'muy']
+
+
+def correct_trajectory(line, twiss_table=None, n_micado=None, n_iter='auto'):
+    # Same as line.correct_trajectory(twiss_table=twiss_table, n_micado=n_micado, n_iter=n_iter), but
+    # the correction (the response matrices with their SVD, and the corrector knobs) is only built
+    # once per lattice, steering selection and optics (see get_trajectory_correction).
+    correction = get_trajectory_correction(line, twiss_table=twiss_table)
+    correction.correct(n_micado=n_micado, n_iter=n_iter)
+    return correction
+
+
+def get_trajectory_correction(line, twiss_table=None):
+    # The correction for the steering correctors and monitors of the line (see knob_tools.set_correctors),
+    # built from the twiss_table (by default the 4d twiss of the line in its present state). It is
+    # reused for every twiss table with the same optics at the correctors and monitors (see
+    # _optics_key), e.g. the error-free reference of every seed.
+    if twiss_table is None:
+        twiss_table = cached_twiss(line, method='4d', reverse=False)
+    cache = _corrections.setdefault(line.env, OrderedDict())
+    key = (line.name, _selection_key(line), _optics_key(line, twiss_table))
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    cache[key] = line.correct_trajectory(run=False, twiss_table=twiss_table)
+    while len(cache) > _MAX_CORRECTIONS:
+        cache.popitem(last=False)
+    return cache[key]
+
+
+def clear_trajectory_corrections(env):
+    _corrections.pop(env, None)
+
+
+def store_orbit_response(env, filename):
+    # Store the optics of all lines (the columns of the 4d twiss in the present state that the
+    # corrections use), from which load_orbit_response rebuilds the corrections without any twiss
+    # (e.g. next to the lattice file, see orbit_response_file). The corrections are built as well,
+    # such that the lines have their corrector knobs.
+    data = {'xtrack_version': np.array(xt.__version__)}
+    for linename, line in env.lines.items():
+        tw = cached_twiss(line, method='4d', reverse=False)
+        get_trajectory_correction(line, twiss_table=tw)
+        data[f'{linename}.key'] = np.array(_selection_key(line))
+        data[f'{linename}.name'] = np.array(tw.name, dtype=str)
+        for col in _STORED_COLUMNS:
+            data[f'{linename}.{col}'] = tw[col]
+        for attr in ['qx', 'qy']:
+            data[f'{linename}.{attr}'] = np.array(tw[attr])
+    np.savez_compressed(filename, **data)
+
+
+def load_orbit_response(env, filename):
+    # Rebuild the trajectory corrections from a file written by store_orbit_response, without any
+    # twiss. Lines whose element names or steering selection changed since are skipped (they are
+    # rebuilt when needed), and so is the whole file if it was stored with another xtrack version.
+    # Returns the names of the lines that were loaded.
+    loaded = []
+    with np.load(filename) as data:
+        if 'xtrack_version' not in data or str(data['xtrack_version']) != xt.__version__:
+            print(f"Stored orbit response {filename} is not from xtrack {xt.__version__}, ignoring it.")
+            return loaded
+        for linename, line in env.lines.items():
+            if f'{linename}.key' not in data or str(data[f'{linename}.key']) != _selection_key(line):
+                print(f"Stored orbit response of {linename} does not match the lattice, ignoring it.")
+                continue
+            tw = xt.TwissTable({'name': data[f'{linename}.name'].astype(object),
+                                **{col: data[f'{linename}.{col}'] for col in _STORED_COLUMNS},
+                                'qx': float(data[f'{linename}.qx']), 'qy': float(data[f'{linename}.qy']),
+                                'reference_frame': 'proper'}, col_names=['name', *_STORED_COLUMNS])
+            get_trajectory_correction(line, twiss_table=tw)
+            loaded.append(linename)
+    return loaded
+
+
+def orbit_response_file(lattice_file):
+    # Where the orbit response of a lattice file is stored, e.g. lattices/injection_clean.orbit_response.npz
+    lattice_file = Path(lattice_file)
+    return lattice_file.with_name(lattice_file.name.split('.')[0] + '.orbit_response.npz')
+
+
+def _response_rows(line, twiss_table):
+    # The rows of the twiss table that the response matrices depend on (in their order in the table)
+    names = set()
+    for attr in ['steering_correctors_x', 'steering_correctors_y', 'steering_monitors_x', 'steering_monitors_y']:
+        names.update(getattr(line, attr) or [])
+    return np.isin(np.asarray(twiss_table.name, dtype=str), list(names))
+
+
+def _optics_key(line, twiss_table):
+    # The optics the response matrices are built from (see xtrack.trajectory_correction), rounded such
+    # that tables of the same machine state give the same key even if they are not bit-identical (e.g.
+    # after extending the knl of the magnets)
+    rows = _response_rows(line, twiss_table)
+    digest = hashlib.sha1(np.round([twiss_table.qx, twiss_table.qy], 9).tobytes())
+    for col, decimals in zip(_STORED_COLUMNS, [6, 6, 6, 9, 9]):
+        digest.update(np.round(np.asarray(twiss_table[col][rows], dtype=float), decimals).tobytes())
+    return digest.hexdigest()
+
+
+def _selection_key(line):
+    # Stable over processes (unlike hash), as it is stored
+    digest = hashlib.sha1(line_digest(line).encode())
+    for attr in ['steering_correctors_x', 'steering_correctors_y', 'steering_monitors_x', 'steering_monitors_y']:
+        digest.update(('\n' + attr + '\n' + '\n'.join(getattr(line, attr) or [])).encode())
+    return digest.hexdigest()
@@ -0,0 +1,100 @@
+import sys
+import json
+import hashlib
+from pathlib import Path
+
+import xtrack as xt
+import xobjects as xo
+
+
+# Local modules (and scripts) are part of the code version of a stage
+_ROOT = Path(__file__).resolve().parent
+
+
+class Stage:
+    # A step of the pipeline (one of the numbered scripts, or one seed) and its output files. Its
+    # fingerprint is a digest of the contents of the input files, the values (config, seed, flags,
+    # ...), the code (the script that runs and the local modules it imported) and the xtrack and
+    # xobjects versions (binary lattice files depend on both, see storage_tools.store_env).
+    # The stage is up to date if all outputs exist and were made with the same fingerprint (stored
+    # by done in <first output>.stage.json). As the outputs of a stage are inputs of the next one,
+    # only what is downstream of a change is rebuilt.
+    def __init__(self, name, outputs, files=(), values=None):
+        self.name = name
+        self.outputs = [Path(ff) for ff in outputs]
+        self.files = [Path(ff) for ff in files]
+        self.values = values or {}
+        self._fingerprint = None
+
+    @property
+    def manifest_file(self):
+        return _manifest_file(self.outputs[0])
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            digest = hashlib.sha1(f'{self.name}\nxtrack {xt.__version__}\nxobjects {xo.__version__}\n'.encode())
+            digest.update(json.dumps(self.values, sort_keys=True, default=str).encode())
+            for ff in self.files:
+                digest.update(f'\n{ff.as_posix()} {file_digest(ff)}'.encode())
+            for ff in _code_files():
+                digest.update(f'\n{ff.name} {file_digest(ff)}'.encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def is_up_to_date(self):
+        if not all(ff.exists() for ff in self.outputs) or not self.manifest_file.exists():
+            return False
+        with self.manifest_file.open() as fid:
+            manifest = json.load(fid)
+        return manifest.get('fingerprint') == self.fingerprint() \
+           and all(file_digest(ff) == manifest['outputs'].get(ff.as_posix()) for ff in self.outputs)
+
+    def done(self):
+        # Record that the outputs are made from the current inputs (call after writing them)
+        manifest = {'stage': self.name, 'fingerprint': self.fingerprint(),
+                    'outputs': {ff.as_posix(): _hash_file(ff) for ff in self.outputs},
+                    'stats': {ff.as_posix(): _file_stats(ff) for ff in self.outputs}}
+        with self.manifest_file.open('w') as fid:
+            json.dump(manifest, fid, indent=1)
+
+
+def file_digest(path):
+    # Content digest of a file ('missing' if it does not exist). Outputs of a stage are only hashed
+    # again if their size or modification time changed since the stage was done.
+    path = Path(path)
+    if not path.exists():
+        return 'missing'
+    manifest_file = _manifest_file(path)
+    if manifest_file.exists():
+        with manifest_file.open() as fid:
+            manifest = json.load(fid)
+        if manifest.get('stats', {}).get(path.as_posix()) == _file_stats(path):
+            return manifest['outputs'][path.as_posix()]
+    return _hash_file(path)
+
+
+def _manifest_file(path):
+    return path.with_name(path.name + '.stage.json')
+
+
+def _hash_file(path, chunk_size=1 << 24):
+    digest = hashlib.sha1()
+    with Path(path).open('rb') as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_stats(path):
+    stat = Path(path).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _code_files():
+    # The running script and the local modules it imported
+    files = set()
+    for module in list(sys.modules.values()):
+        ff = getattr(module, '__file__', None)
+        if ff is not None and Path(ff).resolve().parent == _ROOT and Path(ff).suffix == '.py':
+            files.add(Path(ff).resolve())
+    return sorted(files)
@@ -0,0 +1,188 @@
+import sys
+import json
+import time
+import signal
+import inspect
+import cProfile
+import pstats
+import resource
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+
+# Wall time, number of calls and peak memory per step of this process (see step), and the active
+# profiler (see start_profiling)
+_steps = {}
+_profiler = None
+_start = time.time()
+
+
+@contextmanager
+def step(name):
+    # Time a step of the pipeline. Per name, the number of calls, the total and maximum wall time,
+    # the peak RSS of the process at the end of the step, and how much the step raised that peak
+    # are kept (see step_stats). Steps can be nested (the time of the inner step is included in
+    # the outer one).
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_after = peak_rss_mb()
+        stats = _steps.setdefault(name, {'calls': 0, 'time': 0., 'max_time': 0., 'peak_rss_mb': 0.,
+                                         'rss_growth_mb': 0.})
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+        stats['peak_rss_mb'] = max(stats['peak_rss_mb'], peak_after)
+        stats['rss_growth_mb'] += peak_after - peak_before
+
+
+def timed(name=None):
+    # Decorator to time every call of a function as a step. The name defaults to the name of the
+    # function, and can refer to its arguments, e.g. @timed('tune_line[{line.name}]') for one
+    # step per line.
+    def decorator(func):
+        signature = inspect.signature(func)
+        step_name = func.__name__ if name is None else name
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            this_name = step_name
+            if '{' in step_name:
+                arguments = signature.bind(*args, **kwargs)
+                arguments.apply_defaults()
+                this_name = step_name.format(**arguments.arguments)
+            with step(this_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def step_stats():
+    return {name: dict(stats) for name, stats in _steps.items()}
+
+
+def reset_steps():
+    # E.g. in a forked worker, which inherits the steps of its parent
+    _steps.clear()
+
+
+def merge_step_stats(stats):
+    # Add the steps of another process (e.g. a worker, from its step_stats) to the ones of this process
+    for name, other in stats.items():
+        this = _steps.setdefault(name, {'calls': 0, 'time': 0., 'max_time': 0., 'peak_rss_mb': 0.,
+                                        'rss_growth_mb': 0.})
+        for kk in ['calls', 'time', 'rss_growth_mb']:
+            this[kk] += other[kk]
+        for kk in ['max_time', 'peak_rss_mb']:
+            this[kk] = max(this[kk], other[kk])
+
+
+def peak_rss_mb(children=False):
+    # Peak resident memory of this process (or of its finished child processes) so far
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # In kilobytes on Linux, in bytes on macOS
+    return usage.ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def start_profiling(mode='cprofile', interval=0.005):
+    # Profile this process until stop_profiling (or write_report) with cProfile (every function
+    # call, with some overhead), or by sampling the stack every interval seconds of CPU time
+    # ('sampling', with little overhead, main thread only). Forked workers are not profiled.
+    global _profiler
+    if _profiler is not None:
+        raise RuntimeError("Profiling is already active.")
+    if mode == 'cprofile':
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif mode == 'sampling':
+        _profiler = _Sampler(interval)
+        _profiler.start()
+    else:
+        raise ValueError(f"Unknown profiling mode {mode}")
+
+
+def stop_profiling(n_functions=30, profile_file=None):
+    # Stop the profiler and return the n_functions with the most (cumulative) time or samples. With
+    # cProfile, the full profile is dumped in profile_file if given (e.g. for snakeviz).
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    if isinstance(profiler, _Sampler):
+        profiler.stop()
+        return profiler.summary(n_functions)
+    profiler.disable()
+    if profile_file is not None:
+        profiler.dump_stats(profile_file)
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:n_functions]
+    return {'mode': 'cprofile', 'profile_file': None if profile_file is None else Path(profile_file).as_posix(),
+            'functions': [{'function': _function_name(*key), 'calls': nc, 'tottime': tt, 'cumtime': ct}
+                          for key, (_, nc, tt, ct, _) in top]}
+
+
+def write_report(path_reports='reports', name=None, **info):
+    # Write the steps of this run (and the profile, if active) to path_reports/<name>_<time>.json,
+    # where the name defaults to the running script. Extra info (e.g. the seeds) is added as is.
+    # Returns the file name.
+    name = Path(sys.argv[0]).stem if name is None else name
+    filename = Path(path_reports) / f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    profile = None
+    if _profiler is not None:
+        profile = stop_profiling(profile_file=filename.with_suffix('.prof'))
+    report = {'script': name, 'argv': sys.argv[1:], 'start': datetime.fromtimestamp(_start).isoformat(),
+              'wall_time': time.time() - _start, 'peak_rss_mb': peak_rss_mb(),
+              'peak_rss_children_mb': peak_rss_mb(children=True), **info,
+              'steps': dict(sorted(step_stats().items(), key=lambda item: item[1]['time'], reverse=True)),
+              'profile': profile}
+    with filename.open('w') as fid:
+        json.dump(report, fid, indent=1, default=str)
+    return filename
+
+
+class _Sampler:
+    # Counts the functions on the stack of the main thread at every interval of CPU time (SIGPROF):
+    # own samples for the innermost function, total samples for every function on the stack.
+    def __init__(self, interval):
+        self.interval = interval
+        self.n_samples = 0
+        self.own = Counter()
+        self.total = Counter()
+        self._previous_handler = None
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+
+    def summary(self, n_functions):
+        return {'mode': 'sampling', 'interval': self.interval, 'n_samples': self.n_samples,
+                'functions': [{'function': _function_name(*key), 'total_samples': count,
+                               'own_samples': self.own[key]}
+                              for key, count in self.total.most_common(n_functions)]}
+
+    def _sample(self, signum, frame):
+        self.n_samples += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if not seen:
+                self.own[key] += 1
+            if key not in seen:
+                seen.add(key)
+                self.total[key] += 1
+            frame = frame.f_back
+
+
+def _function_name(filename, lineno, function):
+    return f"{filename}:{lineno}({function})"
@@ -0,0 +1,17 @@
+import sys
+import subprocess
+
+
+# Run the pipeline, e.g. `python run_pipeline.py 1 60` (the arguments are passed to 002_add_errors.py).
+# Every script skips what is up to date (see pipeline_tools.Stage), so only the stages of which an
+# input changed and the ones downstream of them are rebuilt.
+scripts = ['000_build_clean_lattice.py', '001_add_aperture.py', '002_add_errors.py']
+
+
+# =================================================================================================
+
+
+for script in scripts:
+    args = sys.argv[1:] if script == '002_add_errors.py' else []
+    print(f"Running {script}")
+    subprocess.run([sys.executable, script, *args], check=True)
@@ -1,24 +1,156 @@
+import os
+import time
+import hashlib
+import numpy as np
 import xtrack as xt
+from pathlib import Path
 
-def slice_env(env, slicefactor=4):
+
+def slice_env(env, slicefactor=4, cache_dir=None):
+    # Slice all lines. With a cache_dir, the slicing (the slice elements, which refer to their thick
+    # parents, and the new element order of every line) is stored there, keyed by the structure of
+    # the lines (element names and types) and the slicing, and applied instead of recalculated the
+    # next time. The element strengths and the knobs do not change the slicing, so the cache stays
+    # valid when only those are different.
+    spec = _slicing_spec(slicefactor)
+    if cache_dir is None:
+        _slice_lines(env, spec)
+        return env
+    cache_file = Path(cache_dir) / f'sliced_{_slicing_key(env, spec)}.json'
+    if cache_file.exists():
+        _apply_slicing(env, xt.json.load(cache_file))
+        return env
+    elements_before = set(env.element_dict)
+    _slice_lines(env, spec)
+    slicing = {'elements': {nn: _element_to_dict(ee) for nn, ee in env.element_dict.items() if nn not in elements_before},
+               'lines': {linename: list(line.element_names) for linename, line in env.lines.items()}}
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first, such that an interrupted write is not mistaken for a cache hit,
+    # of this process, such that processes slicing the same lattice do not clash
+    temp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    xt.json.dump(slicing, temp_file, indent=None)
+    temp_file.replace(cache_file)
+    return env
+
+
+def benchmark_slicing(env, slicefactors=range(1, 9), linenames=None, n_turns=100, n_particles=100,
+                      cache_dir=None, **twiss_kwargs):
+    # For every slicefactor, the deviation of the sliced lines from the thick ones: the tunes, and the
+    # maximum beta-beating at the elements that are in both (the unsliced ones, like markers and
+    # monitors), together with the number of elements and the tracking speed (turns per second for
+    # n_particles). The environment itself is not sliced (every slicefactor is done on a copy).
+    # Returns {linename: {'slicefactor': [...], 'delta_qx': [...], ...}} and the thick reference as
+    # {linename: {'n_elements': ..., 'turns_per_second': ...}}, and prints a summary.
+    linenames = list(env.lines) if linenames is None else list(linenames)
+    thick = {}
+    twiss_thick = {}
+    for linename in linenames:
+        line = env.lines[linename]
+        twiss_thick[linename] = line.twiss(**twiss_kwargs)
+        thick[linename] = {'n_elements': len(line.element_names),
+                           'turns_per_second': _turns_per_second(line, n_turns, n_particles)}
+    columns = ['slicefactor', 'delta_qx', 'delta_qy', 'beta_beat_x', 'beta_beat_y', 'n_elements', 'turns_per_second']
+    result = {linename: {cc: [] for cc in columns} for linename in linenames}
+    for slicefactor in slicefactors:
+        sliced_env = slice_env(env.copy(), slicefactor=slicefactor, cache_dir=cache_dir)
+        for linename in linenames:
+            line = sliced_env.lines[linename]
+            tw0 = twiss_thick[linename]
+            tw = line.twiss(**twiss_kwargs)
+            _, i0, i1 = np.intersect1d(tw0.name, tw.name, return_indices=True)
+            this_result = result[linename]
+            this_result['slicefactor'].append(slicefactor)
+            this_result['delta_qx'].append(tw.qx - tw0.qx)
+            this_result['delta_qy'].append(tw.qy - tw0.qy)
+            this_result['beta_beat_x'].append(np.max(np.abs(tw.betx[i1] / tw0.betx[i0] - 1)))
+            this_result['beta_beat_y'].append(np.max(np.abs(tw.bety[i1] / tw0.bety[i0] - 1)))
+            this_result['n_elements'].append(len(line.element_names))
+            this_result['turns_per_second'].append(_turns_per_second(line, n_turns, n_particles))
+    result = {linename: {cc: np.array(vv) for cc, vv in this_result.items()} for linename, this_result in result.items()}
+
+    for linename in linenames:
+        print(f"{linename}: thick has {thick[linename]['n_elements']} elements, "
+              f"{thick[linename]['turns_per_second']:.1f} turns/s")
+        print(f"  {'slicefactor':>11} {'delta_qx':>10} {'delta_qy':>10} {'beta_beat_x':>11} {'beta_beat_y':>11} "
+              f"{'n_elements':>10} {'turns/s':>8}")
+        this_result = result[linename]
+        for i in range(len(this_result['slicefactor'])):
+            print(f"  {this_result['slicefactor'][i]:>11} {this_result['delta_qx'][i]:>10.2e} "
+                  f"{this_result['delta_qy'][i]:>10.2e} {this_result['beta_beat_x'][i]:>11.2e} "
+                  f"{this_result['beta_beat_y'][i]:>11.2e} {this_result['n_elements'][i]:>10} "
+                  f"{this_result['turns_per_second'][i]:>8.1f}")
+    return result, thick
+
+
+# The fields of the slice elements (xtrack.beam_elements.slice_base)
+_SLICE_FIELDS = ['radiation_flag', 'delta_taper', 'weight', 'slice_offset', '_slice_offset_fraction']
+
+
+def _slicing_spec(slicefactor):
+    # Number of Teapot slices per element name pattern (the first one is the default for all elements)
+    return [
+        (None, 2),
+        ("mq\..*", 2 * slicefactor),
+        ("mqxa\..*", 32 * slicefactor),
+        ("mqxb\..*", 32 * slicefactor),
+        ("mbx\..*", 4),
+        ("mbrb\..*", 4),
+        ("mbrc\..*", 4),
+        ("mbrs\..*", 4),
+        ("mqwa\..*", 4),
+        ("mqwb\..*", 4),
+        ("mqy\..*", 4 * slicefactor),
+        ("mqm\..*", 4 * slicefactor),
+        ("mqmc\..*", 4 * slicefactor),
+        ("mqml\..*", 4 * slicefactor),
+        ("mqtlh\..*", 2 * slicefactor),
+        ("mqtli\..*", 2 * slicefactor),
+        ("mqt\..*", 2 * slicefactor),
+    ]
+
+
+def _slice_lines(env, spec):
+    strategies = [xt.Strategy(slicing=xt.Teapot(n_slices), name=name) for name, n_slices in spec] \
+               + [xt.Strategy(slicing=None, element_type=xt.Solenoid)]
     for line in env.lines.values():
-        line.slice_thick_elements(slicing_strategies=[
-            xt.Strategy(slicing=xt.Teapot(2)),  # Default slicing for all elements
-            xt.Strategy(slicing=xt.Teapot(2 * slicefactor), name="mq\..*"),
-            xt.Strategy(slicing=xt.Teapot(32 * slicefactor), name="mqxa\..*"),
-            xt.Strategy(slicing=xt.Teapot(32 * slicefactor), name="mqxb\..*"),
-            xt.Strategy(slicing=xt.Teapot(4), name="mbx\..*"),
-            xt.Strategy(slicing=xt.Teapot(4), name="mbrb\..*"),
-            xt.Strategy(slicing=xt.Teapot(4), name="mbrc\..*"),
-            xt.Strategy(slicing=xt.Teapot(4), name="mbrs\..*"),
-            xt.Strategy(slicing=xt.Teapot(4), name="mqwa\..*"),
-            xt.Strategy(slicing=xt.Teapot(4), name="mqwb\..*"),
-            xt.Strategy(slicing=xt.Teapot(4 * slicefactor), name="mqy\..*"),
-            xt.Strategy(slicing=xt.Teapot(4 * slicefactor), name="mqm\..*"),
-            xt.Strategy(slicing=xt.Teapot(4 * slicefactor), name="mqmc\..*"),
-            xt.Strategy(slicing=xt.Teapot(4 * slicefactor), name="mqml\..*"),
-            xt.Strategy(slicing=xt.Teapot(2 * slicefactor), name="mqtlh\..*"),
-            xt.Strategy(slicing=xt.Teapot(2 * slicefactor), name="mqtli\..*"),
-            xt.Strategy(slicing=xt.Teapot(2 * slicefactor), name="mqt\..*"),
-            xt.Strategy(slicing=None, element_type=xt.Solenoid)
-        ])
+        line.slice_thick_elements(slicing_strategies=strategies)
+
+
+def _slicing_key(env, spec):
+    # Digest of the element names and types of all lines, the slicing, and the xtrack version
+    digest = hashlib.sha1(f'{xt.__version__}\n{spec!r}'.encode())
+    for linename, line in env.lines.items():
+        digest.update(f'\n{linename}\n'.encode())
+        digest.update('\n'.join(f'{nn} {env.element_dict[nn].__class__.__name__}'
+                                 for nn in line.element_names).encode())
+    return digest.hexdigest()
+
+
+def _element_to_dict(element):
+    # Slices only have a few fields next to their parent (to_dict copies the element, which is slow)
+    if not hasattr(element, 'parent_name'):
+        return element.to_dict()
+    dct = {'__class__': element.__class__.__name__, 'parent_name': element.parent_name}
+    for field in element._xofields:
+        if field in _SLICE_FIELDS:
+            dct[field] = getattr(element, field)
+    return dct
+
+
+def _apply_slicing(env, slicing):
+    for nn, dct in slicing['elements'].items():
+        env.element_dict[nn] = getattr(xt, dct['__class__']).from_dict(dct)
+    for linename, element_names in slicing['lines'].items():
+        line = env.lines[linename]
+        line.discard_tracker()
+        line.element_names = element_names
+
+
+def _turns_per_second(line, n_turns, n_particles):
+    if not line._has_valid_tracker():
+        line.build_tracker()
+    particles = line.build_particles(x=np.linspace(0, 1e-4, n_particles))
+    line.track(particles.copy(), num_turns=1)  # Warm-up
+    start = time.time()
+    line.track(particles, num_turns=n_turns)
+    return n_turns / (time.time() - start)
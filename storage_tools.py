@@ -0,0 +1,430 @@
+import io
+import os
+import sys
+import copy
+import zlib
+import marshal
+import xtrack as xt
+import xobjects as xo
+import numpy as np
+from pathlib import Path
+from xdeps.tasks import ExprTask
+
+from profiling_tools import timed
+from pipeline_tools import file_digest
+
+
+# A binary environment file (see store_env) starts with this tag, followed by the size of the JSON
+# header (as uint64), the header, and the data sections (each aligned to _SECTION_ALIGNMENT bytes)
+_ENV_FILE_TAG = b'XTENV001'
+_SECTION_ALIGNMENT = 64
+_ELEMENT_ALIGNMENT = 8
+
+
+@timed()
+def store_env(env, filename, record=False):
+    # Store the environment in a binary file, which is much faster to write and to load (see load_env)
+    # than JSON. The data of the elements is stored as it is in memory, one element after the other,
+    # such that loading only has to point the elements at it, and the expressions are stored compiled
+    # (next to their text, which is used with another Python version). Everything else is stored as
+    # in env.to_dict(). The element data depends on the xtrack and xobjects versions, so the file can
+    # only be loaded with the same ones (pipeline_tools.Stage rebuilds its outputs when they change).
+    # This makes it a cache format only, to hand the environment from one stage to the next within
+    # one installation: the lattices to keep or share are stored as JSON, which is what a filename
+    # ending in .json is stored as (with env.to_json). With record, the environment is stored as JSON
+    # next to the binary file as well (see record_file), and the binary file refers to it, such that
+    # deltas w.r.t. the binary file are stored w.r.t. the JSON file (see store_delta).
+    filename = Path(filename)
+    if filename.suffix == '.json':
+        env.to_json(filename)
+        return
+    header = {'versions': _versions(), 'env': _env_dict_without_elements(env), 'record': None}
+    if record:
+        env.to_json(record_file(filename))
+        header['record'] = {'file': record_file(filename).name, 'digest': file_digest(record_file(filename))}
+    element_data, header['elements'] = _pack_elements(env.element_dict)
+    expressions = marshal.dumps(_compile_expressions(header['env'].get('_var_manager', [])))
+    header['expressions'] = {'cache_tag': sys.implementation.cache_tag}
+    _write_env_file(filename, header, {'elements': element_data, 'expressions': zlib.compress(expressions, 1)})
+
+
+@timed()
+def load_env(filename, mmap=True):
+    # Load an environment stored by store_env (or as JSON). With mmap, the element data is mapped from
+    # the file instead of read (copy-on-write, so changing the elements does not change the file).
+    if not is_env_file(filename):
+        return xt.Environment.from_json(filename)
+    return EnvFile(filename, mmap=mmap).environment()
+
+
+def record_file(filename):
+    # The lattice of record of an environment file: the JSON file next to it (see store_env)
+    return Path(filename).with_suffix('.json')
+
+
+def is_env_file(filename):
+    with Path(filename).open('rb') as fid:
+        return fid.read(len(_ENV_FILE_TAG)) == _ENV_FILE_TAG
+
+
+class EnvFile:
+    # The contents of a file written by store_env. The elements are only built when asked for, and all
+    # share one buffer on the element data of the file, such that a delta w.r.t. the file only has
+    # to look at the elements of which the data differs (see store_delta).
+    def __init__(self, filename, mmap=True):
+        self.filename = Path(filename)
+        with self.filename.open('rb') as fid:
+            if fid.read(len(_ENV_FILE_TAG)) != _ENV_FILE_TAG:
+                raise ValueError(f"File {filename} is not a binary environment file.")
+            header_size = int(np.frombuffer(fid.read(8), dtype=np.uint64)[0])
+            header = xt.json.load(string=fid.read(header_size).decode())
+            start = _align(fid.tell(), _SECTION_ALIGNMENT)
+        if header['versions'] != _versions():
+            raise ValueError(f"File {filename} was stored with {header['versions']}, but the current versions "
+                             f"are {_versions()}. Store it again with these (or use JSON).")
+        self.env_dict = header['env']
+        self.table = header['elements']
+        self.index = {nn: ii for ii, nn in enumerate(self.table['names'])}
+        self._cache_tag = header['expressions']['cache_tag']
+        self._record = header.get('record')
+        self._sections = {kk: (start + offset, size) for kk, (offset, size) in header['sections'].items()}
+
+        # All element data is in use, so new allocations grow the buffer (which copies it out of the file)
+        offset, size = self._sections['elements']
+        self.buffer = xo.context_default.new_buffer(capacity=max(size, _ELEMENT_ALIGNMENT))
+        if size > 0:
+            if mmap:
+                self.buffer.buffer = np.memmap(self.filename, dtype=np.int8, mode='c', offset=offset, shape=(size,))
+            else:
+                self.buffer.buffer = np.fromfile(self.filename, dtype=np.int8, count=size, offset=offset)
+            self.buffer.capacity = size
+        self.buffer.chunks = []
+
+    def record_file(self):
+        # The JSON file stored with this file (see store_env), or None if there is none, or if it
+        # changed since
+        if self._record is None:
+            return None
+        filename = self.filename.parent / self._record['file']
+        return filename if file_digest(filename) == self._record['digest'] else None
+
+    def element(self, name):
+        ii = self.index[name]
+        cls = getattr(xt, self.table['classes'][ii])
+        offset = self.table['offsets'][ii]
+        if offset is None:
+            return cls.from_dict(self.table['dicts'][name])
+        element = cls(_xobject=cls._XoStruct._from_buffer(self.buffer, offset))
+        for kk, vv in self.table['attributes'].get(name, {}).items():
+            setattr(element, kk, vv)
+        if hasattr(element, 'parent_name'):
+            element._parent = None  # As from_dict: the parent is set again when the tracker is built
+        return element
+
+    def elements(self):
+        return {nn: self.element(nn) for nn in self.table['names']}
+
+    def element_data(self, name):
+        # The stored data of the element (None if it is stored as a dictionary)
+        ii = self.index[name]
+        offset = self.table['offsets'][ii]
+        if offset is None:
+            return None
+        return self.buffer.to_bytearray(offset, self.table['sizes'][ii])
+
+    def environment(self, env_dict=None, elements=None):
+        # Build the environment, as xt.Environment.from_dict, from the stored env_dict and elements
+        # (or modified ones, see load_delta)
+        env_dict = self.env_dict if env_dict is None else env_dict
+        elements = self.elements() if elements is None else elements
+        particle_ref = env_dict.get('particle_ref')
+        if particle_ref is not None and not isinstance(particle_ref, str):
+            particle_ref = xt.Particles.from_dict(particle_ref)
+        particles = {nn: xt.Particles.from_dict(pp) for nn, pp in env_dict.get('particles', {}).items()}
+        var_management_dct = dict(env_dict, _var_manager=[]) if '_var_manager' in env_dict else None
+        env = xt.Environment(element_dict=elements, particle_ref=particle_ref,
+                             _var_management_dct=var_management_dct, particles=particles)
+        if var_management_dct is not None:
+            manager = env._xdeps_manager
+            for lhs, rhs in self.expressions(env_dict['_var_manager'], manager.containers):
+                manager.register(ExprTask(lhs, rhs))
+        for nn, ddll in env_dict['lines'].items():
+            env[nn] = xt.Line.from_dict(ddll, _env=env, verbose=False)
+        if 'metadata' in env_dict:
+            env.metadata = env_dict['metadata']
+        return env
+
+    def expressions(self, pairs, containers):
+        # The (target, expression) references of the [target, expression] pairs, taken from the stored
+        # compiled expressions where they are the same as the stored ones (evaluating the text of
+        # every expression is what makes loading the expressions slow)
+        if self._cache_tag != sys.implementation.cache_tag:
+            return [(eval(lhs, {}, containers), eval(rhs, {}, containers)) for lhs, rhs in pairs]
+        offset, size = self._sections['expressions']
+        with self.filename.open('rb') as fid:
+            fid.seek(offset)
+            code = marshal.loads(zlib.decompress(fid.read(size)))
+        stored = dict(zip(map(tuple, self.env_dict.get('_var_manager', [])), eval(code, {}, containers)))
+        return [stored.get((lhs, rhs)) or (eval(lhs, {}, containers), eval(rhs, {}, containers))
+                for lhs, rhs in pairs]
+
+
+@timed()
+def store_delta(env, base, outfile):
+    # Only store what differs from the base environment (typically the clean lattice), i.e. the
+    # knl/ksl of the magnets with errors, the corrector strengths and the knob values.
+    # The base can be an Environment, a dictionary (as from env.to_dict()) or a path to a JSON file
+    # or to a binary file (see store_env). With a binary file, only the elements of which the data
+    # differs are compared as dictionaries, which is much faster. As a binary file is only a cache,
+    # the delta then refers to its lattice of record (see store_env) if it has one. The content
+    # digest of the base file is stored as well, such that load_delta refuses to apply the delta to
+    # another base.
+    base_file = None
+    base_digest = None
+    if isinstance(base, (str, Path)):
+        base_file = Path(base)
+        if is_env_file(base):
+            base = EnvFile(base)
+            if base.record_file() is not None:
+                base_file = base.record_file()
+            else:
+                print(f"Warning: {base_file} has no (unchanged) lattice of record, the delta refers to "
+                      f"this binary file, which can only be loaded with the current xsuite versions.")
+        else:
+            base = xt.json.load(base)
+    elif isinstance(base, xt.Environment):
+        base = base.to_dict()
+    if base_file is not None:
+        base_digest = file_digest(base_file)
+        base_file = base_file.as_posix()
+    if isinstance(base, EnvFile):
+        delta = _env_file_delta(base, env)
+    else:
+        delta = _dict_delta(_prepare_dict(base), _prepare_dict(env.to_dict()))
+    delta = {'base_file': base_file, 'base_digest': base_digest, 'delta': delta,
+             'xsuite_data_type': 'EnvironmentDelta'}
+    xt.json.dump(delta, outfile, indent=None)
+
+
+@timed()
+def load_delta(infile, base=None):
+    # Rebuild the full environment from the base environment and the stored delta.
+    # If no base is given, the base file stored in the delta is used. A ValueError is raised if the
+    # base file is not the one the delta was stored against (e.g. it was built again since).
+    delta = xt.json.load(infile)
+    if delta.get('xsuite_data_type') != 'EnvironmentDelta':
+        raise ValueError(f"File {infile} does not contain an environment delta.")
+    if base is None:
+        if delta['base_file'] is None:
+            raise ValueError("No base environment given, and none is stored in the delta.")
+        base = delta['base_file']
+    if isinstance(base, (str, Path)):
+        if delta.get('base_digest') is not None and file_digest(base) != delta['base_digest']:
+            raise ValueError(f"The delta {infile} was stored against another version of {delta['base_file']} "
+                             f"than {base}. Store the delta again against this base.")
+        if is_env_file(base):
+            return _apply_env_file_delta(EnvFile(base), delta['delta'])
+        base = xt.json.load(base)
+    elif isinstance(base, xt.Environment):
+        base = base.to_dict()
+    dct = _apply_delta(_prepare_dict(base), delta['delta'])
+    dct['_var_manager'] = [[kk, vv] for kk, vv in dct['_var_manager'].items()]
+    return xt.Environment.from_dict(dct)
+
+
+def _env_file_delta(env_file, env):
+    # Same as the delta of the dictionaries of both, but only the elements of which the type, the
+    # Python attributes or the data differ are compared as dictionaries
+    delta = _dict_delta(_prepare_dict(env_file.env_dict), _prepare_dict(_env_dict_without_elements(env)))
+    changed = {}
+    nested = {}
+    for nn, ee in env.element_dict.items():
+        if nn not in env_file.index or env_file.table['classes'][env_file.index[nn]] != ee.__class__.__name__:
+            changed[nn] = ee.to_dict()
+            continue
+        data = env_file.element_data(nn)
+        if data is not None and data == _element_data(ee) \
+                and env_file.table['attributes'].get(nn, {}) == _element_attributes(ee):
+            continue
+        this_delta = _dict_delta(env_file.element(nn).to_dict(), ee.to_dict())
+        if this_delta:
+            nested[nn] = this_delta
+    removed = [nn for nn in env_file.table['names'] if nn not in env.element_dict]
+    element_delta = {kk: vv for kk, vv in [('changed', changed), ('nested', nested), ('removed', removed)] if vv}
+    if element_delta:
+        delta.setdefault('nested', {})['elements'] = element_delta
+    return delta
+
+
+def _apply_env_file_delta(env_file, delta):
+    # Same as applying the delta to the dictionary of the environment, but only the elements in the
+    # delta are built from a dictionary (the others are built from the element data of the file)
+    delta = dict(delta)
+    delta['nested'] = dict(delta.get('nested', {}))
+    element_delta = delta['nested'].pop('elements', {})
+    env_dict = _apply_delta(_prepare_dict(env_file.env_dict), delta)
+    env_dict['_var_manager'] = [[kk, vv] for kk, vv in env_dict['_var_manager'].items()]
+    removed = set(element_delta.get('removed', []))
+    elements = {}
+    for nn in env_file.table['names']:
+        if nn in removed:
+            continue
+        if nn in element_delta.get('nested', {}):
+            dct = _apply_delta(env_file.element(nn).to_dict(), element_delta['nested'][nn])
+            elements[nn] = getattr(xt, dct['__class__']).from_dict(dct)
+        else:
+            elements[nn] = env_file.element(nn)
+    for nn, dct in element_delta.get('changed', {}).items():
+        elements[nn] = getattr(xt, dct['__class__']).from_dict(dct)
+    return env_file.environment(env_dict=env_dict, elements=elements)
+
+
+def _prepare_dict(dct):
+    # The expressions are a list of [target, expression] pairs; a dict is easier to compare
+    dct = dict(dct)
+    dct['_var_manager'] = {kk: vv for kk, vv in dct.get('_var_manager', [])}
+    dct.pop('xtrack_version', None)
+    return dct
+
+
+def _dict_delta(base, new):
+    changed = {}
+    nested = {}
+    for kk, vv in new.items():
+        if kk not in base:
+            changed[kk] = vv
+        elif isinstance(vv, dict) and isinstance(base[kk], dict):
+            this_delta = _dict_delta(base[kk], vv)
+            if this_delta:
+                nested[kk] = this_delta
+        elif not _is_equal(base[kk], vv):
+            changed[kk] = vv
+    removed = [kk for kk in base if kk not in new]
+    delta = {}
+    if changed:
+        delta['changed'] = changed
+    if nested:
+        delta['nested'] = nested
+    if removed:
+        delta['removed'] = removed
+    return delta
+
+
+def _apply_delta(base, delta):
+    result = dict(base)
+    for kk in delta.get('removed', []):
+        result.pop(kk)
+    for kk, vv in delta.get('nested', {}).items():
+        result[kk] = _apply_delta(result[kk], vv)
+    result.update(delta.get('changed', {}))
+    return result
+
+
+def _is_equal(val1, val2):
+    if isinstance(val1, str) or isinstance(val2, str) or val1 is None or val2 is None:
+        return val1 == val2
+    try:
+        return np.array_equal(val1, val2)
+    except (ValueError, TypeError):
+        return val1 == val2
+
+
+def _versions():
+    # The element data is laid out by xobjects from the xtrack element definitions
+    return {'xtrack': xt.__version__, 'xobjects': xo.__version__}
+
+
+def _env_dict_without_elements(env):
+    # env.to_dict() without the elements (converting those is what makes it slow)
+    if getattr(env, '_bb_config', None) is not None:
+        raise ValueError("An environment with a beam-beam configuration cannot be stored in a binary file.")
+    # On a shallow copy, such that env itself is never left without its elements (e.g. for the
+    # threads of correction_tools, or when to_dict raises)
+    shallow = copy.copy(env)
+    shallow._element_dict = {}
+    dct = shallow.to_dict()
+    dct.pop('elements')
+    return dct
+
+
+def _pack_elements(element_dict):
+    # The data of all elements one after the other, and the table to find them back: per element its
+    # type, offset and size in the data, and its Python attributes (e.g. the parent of a slice).
+    # Elements without element data (or with TPSA strengths) are stored as dictionaries.
+    table = {'names': [], 'classes': [], 'offsets': [], 'sizes': [], 'attributes': {}, 'dicts': {}}
+    chunks = []
+    position = 0
+    for nn, ee in element_dict.items():
+        cls = ee.__class__.__name__
+        if getattr(xt, cls, None) is not ee.__class__:
+            raise ValueError(f"Element {nn} of type {cls} is not an xtrack element, it cannot be stored "
+                             f"in a binary file.")
+        table['names'].append(nn)
+        table['classes'].append(cls)
+        data = _element_data(ee)
+        if data is None:
+            table['offsets'].append(None)
+            table['sizes'].append(None)
+            table['dicts'][nn] = ee.to_dict()
+            continue
+        attributes = _element_attributes(ee)
+        if attributes:
+            table['attributes'][nn] = attributes
+        table['offsets'].append(position)
+        table['sizes'].append(len(data))
+        padding = _align(len(data), _ELEMENT_ALIGNMENT) - len(data)
+        chunks.extend([data, bytes(padding)])
+        position += len(data) + padding
+    return b''.join(chunks), table
+
+
+def _element_data(element):
+    # The element data (None if it cannot be stored as such). The reference of a slice to its parent
+    # is an offset in the buffer of the element, so it is stored as unset (as in to_dict, which only
+    # keeps the parent name).
+    if not hasattr(element, '_xobject') or getattr(element, '_tpsa_handles', None):
+        return None
+    xobject = element._xobject
+    data = xobject._buffer.to_bytearray(xobject._offset, xobject._size)
+    if hasattr(element, 'parent_name'):
+        buffer = xo.context_default.new_buffer(capacity=len(data))
+        buffer.update_from_buffer(0, data)
+        element.__class__._XoStruct._from_buffer(buffer, 0)._parent = None
+        data = buffer.to_bytearray(0, len(data))
+    return data
+
+
+def _element_attributes(element):
+    return {kk: vv for kk, vv in vars(element).items() if not kk.startswith('_') and vv is not None}
+
+
+def _compile_expressions(pairs):
+    # All expressions as one list of (target, expression) references, evaluated on the containers of
+    # the manager (as xdeps.Manager.load does for every pair)
+    return compile('[' + ','.join(f'({lhs},{rhs})' for lhs, rhs in pairs) + ']', '<expressions>', 'eval')
+
+
+def _write_env_file(filename, header, sections):
+    position = 0
+    header['sections'] = {}
+    for kk, data in sections.items():
+        header['sections'][kk] = [position, len(data)]
+        position = _align(position + len(data), _SECTION_ALIGNMENT)
+    header_string = io.StringIO()
+    xt.json.dump(header, header_string, indent=None, sort_keys=False)
+    header_bytes = header_string.getvalue().encode()
+    # Write to a temporary file first: a loaded environment can still map the data of the old file.
+    # The temporary file is per process, such that processes storing the same file do not clash.
+    temp_file = filename.with_name(f'{filename.name}.{os.getpid()}.tmp')
+    with temp_file.open('wb') as fid:
+        fid.write(_ENV_FILE_TAG)
+        fid.write(np.uint64(len(header_bytes)).tobytes())
+        fid.write(header_bytes)
+        for data in sections.values():
+            fid.write(bytes(_align(fid.tell(), _SECTION_ALIGNMENT) - fid.tell()))
+            fid.write(data)
+    temp_file.replace(filename)
+
+
+def _align(position, alignment):
+    return -(-position // alignment) * alignment
@@ -0,0 +1 @@
+../campaign_tools.py
\ No newline at end of file
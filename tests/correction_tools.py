@@ -0,0 +1 @@
+../correction_tools.py
\ No newline at end of file
@@ -0,0 +1 @@
+../index_tools.py
\ No newline at end of file
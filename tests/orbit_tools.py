@@ -0,0 +1 @@
+../orbit_tools.py
\ No newline at end of file
@@ -0,0 +1 @@
+../pipeline_tools.py
\ No newline at end of file
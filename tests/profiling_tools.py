@@ -0,0 +1 @@
+../profiling_tools.py
\ No newline at end of file
@@ -0,0 +1 @@
+../slice_tools.py
\ No newline at end of file
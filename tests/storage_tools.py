@@ -0,0 +1 @@
+../storage_tools.py
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import signal
+import tempfile
+from pathlib import Path
+
+import campaign_tools
+from campaign_tools import run_campaign
+
+
+# A seed of which the worker process is killed (e.g. when out of memory) must be recorded as failed,
+# without hanging the campaign or affecting the other seeds
+path_temp = Path(tempfile.mkdtemp())
+
+
+def add_errors_for_seed(seed, config, infile, outfile, path_errors, path_temp='temp', **kwargs):
+    if seed == 2:
+        os.kill(os.getpid(), signal.SIGKILL)
+    if seed == 3:
+        raise ValueError("No errors for seed 3")
+    Path(str(outfile).format(seed=seed)).write_text(f'{seed}')
+
+
+# The workers are forked, so they run the replaced function
+campaign_tools.add_errors_for_seed = add_errors_for_seed
+summary = run_campaign([1, 2, 3, 4, 5], config={}, infile=None, outfile=path_temp / 'seed_{seed}.txt',
+                       path_errors=None, path_scratch=path_temp / 'scratch', n_processes=2, prepare_once=False,
+                       summary_file=path_temp / 'summary.json')
+assert list(summary['seeds']) == [1, 2, 3, 4, 5]
+assert summary['failed'] == [2, 3]
+assert 'died' in summary['seeds'][2]['error']
+assert 'No errors for seed 3' in summary['seeds'][3]['error']
+for seed in [1, 4, 5]:
+    assert (path_temp / f'seed_{seed}.txt').read_text() == f'{seed}'
+assert not (path_temp / 'scratch' / 's2').exists()
@@ -0,0 +1,67 @@
+import xtrack as xt
+
+from knob_tools import add_phase_knob, add_mo_knob, add_tuning_knobs, set_knobs
+from index_tools import get_dependency_index, DependencyIndex, _node
+
+
+# The dependency index must follow the expressions when the knobs are added (which replaces
+# existing expressions), without being told which variables changed
+def make_env():
+    env = xt.Environment()
+    env['nrj'] = 450
+    env['kmax_mo'] = 6.3e4
+    env['imax_mo'] = 550
+    env['on_x1'] = 0
+    env['acbh1.b1'] = 1e-6 * env.ref['on_x1']
+    env.new('mcbh.1.b1', xt.Multipole, knl=['-acbh1.b1'])
+    for beam in [1, 2]:
+        for i in range(1, 9):
+            arc = f'a{i}{i%8+1}b{beam}'
+            for kk in ['kqtf', 'kqtd', 'kof', 'kod']:
+                env[f'{kk}.{arc}'] = 1e-3
+            env[f'kqtf.{arc}'] = 1e-3 + env.ref['on_x1'] * 0
+            env.new(f'mqtf.{arc}', xt.Quadrupole, length=0.32, k1=f'kqtf.{arc}')
+            env.new(f'mqtd.{arc}', xt.Quadrupole, length=0.32, k1=f'kqtd.{arc}')
+            env.new(f'mof.{arc}', xt.Octupole, length=0.32, k3=f'kof.{arc}')
+    return env
+
+
+def check_index(env):
+    index = get_dependency_index(env)
+    # The direct dependencies of every variable are the ones of its expression
+    for name in env.vars.keys():
+        ref = env.ref[name]
+        expected = set()
+        if ref._expr is not None:
+            expected = {node[1] for node in map(_node, ref._expr._get_dependencies())
+                        if node is not None and node[0] == 'vars'}
+        found = {nn for kk, nn in index.forward.get(('vars', name), {}) if kk == 'vars'}
+        assert found == expected, f"{name}: {found} != {expected}"
+    # And the index is the same as a new one
+    new = DependencyIndex(env)
+    assert index.forward == new.forward and index.reverse == new.reverse
+
+
+env = make_env()
+check_index(env)
+assert {'mcbh.1.b1', 'mqtf.a12b1', 'mqtf.a81b2'} <= get_dependency_index(env).driven_elements('on_x1')
+add_phase_knob(env)
+check_index(env)
+# kqtf.a81b2 is set to a new expression, the others are added to
+assert 'mqtf.a81b2' not in get_dependency_index(env).driven_elements('on_x1')
+assert 'mqtf.a12b1' in get_dependency_index(env).driven_elements('on_x1')
+assert {'mqtf.a12b1', 'mqtd.a23b2'} <= get_dependency_index(env).driven_elements('phase_knob')
+add_mo_knob(env)
+check_index(env)
+assert 'mof.a45b1' in get_dependency_index(env).driven_elements('i_mo')
+add_tuning_knobs(env, injection=True)
+check_index(env)
+assert get_dependency_index(env).driven_vars('kqtf') == {'dqx.b1', 'dqx.b2', 'dqx.b1_sq', 'dqx.b2_sq'}
+
+# Expressions replaced by knob transactions and plain assignments
+set_knobs(env, {'kqtf.a12b1': env.ref['i_mo'] * 1e-3, 'on_x1': 1})
+env['kqtd.a12b1'] = env.ref['cmrs'] * 1e-3
+check_index(env)
+assert 'mqtf.a12b1' in get_dependency_index(env).driven_elements('i_mo')
+assert 'mqtf.a12b1' not in get_dependency_index(env).driven_elements('phase_knob')
+assert 'mqtd.a12b1' in get_dependency_index(env).driven_elements('cmrs')
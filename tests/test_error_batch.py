@@ -0,0 +1,79 @@
+import numpy as np
+import xtrack as xt
+
+from error_tools import add_error_knobs, assign_errors, assign_errors_single_magnet, _MAX_ORDER
+
+
+# The errors assigned per family in one go (as deferred expressions) must be the same as the ones of
+# assign_errors_single_magnet, magnet by magnet, also when the knobs change afterwards
+n_cells = 6
+rng = np.random.default_rng(3)
+
+
+def make_env():
+    env = xt.Environment()
+    env.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, p0c=450e9)
+    env['kqf'] = 0.008
+    env['ksf'] = 0.05
+    env['kx'] = 1
+    for beam in [1, 2]:
+        components = []
+        for cell in range(n_cells):
+            components += [env.new(f'mq.{cell}r1.b{beam}', xt.Quadrupole, length=3, k1='kqf'),
+                           env.new(f'ms.{cell}r1.b{beam}', xt.Sextupole, length=0.4, k2='ksf'),
+                           env.new(f'd.{cell}.b{beam}', xt.Drift, length=2)]
+        env.new_line(name=f'lhcb{beam}', components=components)
+        env[f'lhcb{beam}'].extend_knl_ksl(order=_MAX_ORDER, element_names=[nn for nn in env[f'lhcb{beam}'].element_names
+                                                                          if nn.startswith(('mq.', 'ms.'))])
+    # Entries that are already driven by an expression
+    env.ref['mq.1r1.b1'].knl[2] = 1e-3 * env.ref['kx']
+    env.ref['ms.2r1.b2'].ksl[3] = 2e-3 * env.ref['kx']
+    add_error_knobs(env)
+    env['on_b2s'] = 1
+    return env
+
+
+# Slots of beam 1 and 2 (the elements have a .b1 or .b2 suffix)
+beams = np.repeat([1., 2.], 2 * n_cells)
+slots = np.array([f'{kk}.{cell}r1' for _ in [1, 2] for kk in ['mq', 'ms'] for cell in range(n_cells)])
+names = [f'{slot}.b{beam:.0f}' for slot, beam in zip(slots, beams)]
+error_table = {'name': slots, 'beam': beams}
+for i in range(1, _MAX_ORDER + 1):
+    error_table[f'b{i}'] = rng.normal(0, 1, len(slots)) * (rng.random(len(slots)) < 0.8)
+    error_table[f'a{i}'] = rng.normal(0, 1, len(slots)) * (rng.random(len(slots)) < 0.8)
+rotated = ['mq.2r1', 'ms.4r1']
+rotation_table = {'name': np.array(rotated), 'YROTA': np.array([180., 180.])}
+
+batch = make_env()
+report = assign_errors(batch, error_table, rotation_table, quadrupoles=True, sextupoles=True)
+assert report == {'unmatched': [], 'vetoed': []}
+
+single = make_env()
+single['on_b2s'] = 0
+for ii, nn in enumerate(names):
+    errors = {f'{ab}{i}': error_table[f'{ab}{i}'][ii] for ab in 'ab' for i in range(1, _MAX_ORDER + 1)}
+    quad = nn.startswith('mq.')
+    assign_errors_single_magnet(single, nn, errors, order=1 if quad else 2,
+                                kl_ref=1e-4 * (single.ref[nn].k1 if quad else single.ref[nn].k2) * single[nn].length,
+                                is_rotated=nn[:-3] in rotated, is_beam4=nn.endswith('.b2'), magnetic_sign=not quad)
+single['on_b2s'] = 1
+
+
+def strengths(env):
+    return np.array([np.r_[env.element_dict[nn].knl[:_MAX_ORDER], env.element_dict[nn].ksl[:_MAX_ORDER]]
+                     for nn in names])
+
+
+assert np.any(strengths(batch) != strengths(make_env()))
+assert np.allclose(strengths(batch), strengths(single), rtol=1e-12, atol=0)
+for env in [batch, single]:
+    env['kqf'] = 0.009
+    env['on_b3s'] = 0.5
+    env['on_a4s'] = 0
+assert np.allclose(strengths(batch), strengths(single), rtol=1e-12, atol=0)
+# An entry with an expression gets one expression with the errors (as ee.knl[i] += ...), not a second one
+for env in [batch, single]:
+    env['kx'] = 2
+    assert "vars['on_b3s']" in str(env.ref['mq.1r1.b1'].knl[2]._expr)
+    assert "vars['on_a4s']" in str(env.ref['ms.2r1.b2'].ksl[3]._expr)
+assert np.allclose(strengths(batch), strengths(single), rtol=1e-12, atol=0)
@@ -0,0 +1,70 @@
+import numpy as np
+import xtrack as xt
+from pathlib import Path
+
+from tfs_tools import read_table_columns
+from correction_tools import compute_mb_correction, read_correction_settings, _inline_coefficients, \
+                             _L_MQT, _SPOOL_PIECES
+
+
+# Compare the in-process MB correction with the output of corr_MB_ats_v4 for the same optics and errors
+path_temp = Path(__file__).resolve().parent.parent / 'temp'
+
+
+def evaluate(settings, knobs):
+    env = xt.Environment()
+    for nn in ['l.mcs', 'l.mss', 'l.mco', 'l.mcd']:
+        env[nn] = 1
+    for nn, vv in knobs.items():
+        env[nn] = vv
+    values = {}
+    for nn, ex in settings.items():
+        if nn not in knobs:
+            env[nn] = ex
+    for nn in settings:
+        values[nn] = env[nn]
+    return values
+
+
+for beam in [1, 2]:
+    optics = read_table_columns(path_temp / f'optics0_MB_lhcb{beam}.mad', cache_dir=None)
+    errors = read_table_columns(path_temp / f'MB_lhcb{beam}.errors', cache_dir=None)
+    settings = compute_mb_correction(optics, errors, beam=beam)
+
+    reference = read_correction_settings(path_temp / f'MB_corr_setting_lhcb{beam}.mad')
+    reference = _inline_coefficients(reference)
+
+    for knobs in [{f'kqtf.b{beam}': 0, f'kqtd.b{beam}': 0, 'cmrskew': 0, 'cmiskew': 0},
+                  {f'kqtf.b{beam}': 1, f'kqtd.b{beam}': 0, 'cmrskew': 1, 'cmiskew': 0},
+                  {f'kqtf.b{beam}': 0, f'kqtd.b{beam}': 1, 'cmrskew': 0, 'cmiskew': 1}]:
+        new = evaluate(settings, knobs)
+        ref = evaluate(reference, knobs)
+        for nn, vv in new.items():
+            assert nn in ref, f"{nn} not in the reference settings"
+            assert np.isclose(vv, ref[nn], rtol=1e-5, atol=1e-10), f"{nn}: {vv} != {ref[nn]}"
+        missing = {nn for nn in ref if nn not in new}
+        assert len(missing) == 0, f"Not calculated: {missing}"
+
+
+# The reference has no b2 errors, so the MQT settings are checked against values calculated by hand
+# for an arc 12 with two MB and one MQT per family, of which the odd one is focusing for beam 1 and
+# the even one for beam 2 (see correction_tools._alternates):
+#   tune shift of the MB: 2e-5*100 - 1e-5*40 = 1.6e-3 (x) and -(2e-5*30 - 1e-5*90) = 3e-4 (-y)
+#   beam 1: L*(150*dkqtf + 35*dkqtd) = -1.6e-3 and L*(35*dkqtf + 150*dkqtd) = 3e-4, so
+#           dkqtf = (150*-1.6e-3 - 35*3e-4) / (150**2 - 35**2) / L = -0.2505 / 21275 / L
+#           dkqtd = (150*3e-4 - 35*-1.6e-3) / (150**2 - 35**2) / L = 0.101 / 21275 / L
+#   beam 2: the same with the families swapped
+optics = {'name': ['mb.a8r1.b{beam}', 'mb.b8r1.b{beam}', 'mqt.13r1.b{beam}', 'mqt.14r1.b{beam}', 'mqt.13l3.b{beam}'],
+          'BETX': np.array([100., 40., 150., 35., 1.]), 'BETY': np.array([30., 90., 35., 150., 1.]),
+          **{column: np.zeros(5) for column in ['MUX', 'MUY', 'DX', 'K1L']}}
+expected = {'f': -0.2505 / 21275 / _L_MQT, 'd': 0.101 / 21275 / _L_MQT}
+for beam in [1, 2]:
+    this_optics = dict(optics, name=np.array([nn.format(beam=beam) for nn in optics['name']]))
+    errors = {'name': this_optics['name'][:2], 'K1L': np.array([2e-5, -1e-5])}
+    errors.update({column: np.zeros(2) for column, *_ in _SPOOL_PIECES})
+    settings = compute_mb_correction(this_optics, errors, beam=beam)
+    dkqtf, dkqtd = (expected['f'], expected['d']) if beam == 1 else (expected['d'], expected['f'])
+    assert np.isclose(settings[f'dkqtf.a12b{beam}'], dkqtf, rtol=1e-12, atol=0), settings[f'dkqtf.a12b{beam}']
+    assert np.isclose(settings[f'dkqtd.a12b{beam}'], dkqtd, rtol=1e-12, atol=0), settings[f'dkqtd.a12b{beam}']
+    # An arc without errors needs no b2 correction
+    assert settings[f'dkqtf.a23b{beam}'] == settings[f'dkqtd.a23b{beam}'] == 0
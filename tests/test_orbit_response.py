@@ -0,0 +1,84 @@
+import tempfile
+import numpy as np
+import xtrack as xt
+from pathlib import Path
+
+from orbit_tools import correct_trajectory, get_trajectory_correction, store_orbit_response, load_orbit_response
+
+
+# A trajectory correction rebuilt from a stored orbit response must give the same kicks as
+# line.correct_trajectory, and is only reused for the same optics
+path_temp = Path(tempfile.mkdtemp())
+
+
+def make_env(n_cells=50, kq=0.012):
+    env = xt.Environment()
+    env.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, p0c=450e9)
+    env['kqf'] = kq
+    env['kqd'] = -kq
+    angle = np.pi / n_cells
+    components = []
+    for cell in range(n_cells):
+        components += [env.new(f'mqf.{cell}', xt.Quadrupole, length=3, k1='kqf'),
+                       env.new(f'bpm.{cell}a', xt.Marker),
+                       env.new(f'mcbh.{cell}a', xt.Multipole, knl=[0], ksl=[0]),
+                       env.new(f'mcbv.{cell}a', xt.Multipole, knl=[0], ksl=[0]),
+                       env.new(f'mb.{cell}a', xt.Bend, length=20, angle=angle, k0_from_h=True),
+                       env.new(f'mqd.{cell}', xt.Quadrupole, length=3, k1='kqd'),
+                       env.new(f'bpm.{cell}b', xt.Marker),
+                       env.new(f'mcbh.{cell}b', xt.Multipole, knl=[0], ksl=[0]),
+                       env.new(f'mcbv.{cell}b', xt.Multipole, knl=[0], ksl=[0]),
+                       env.new(f'mb.{cell}b', xt.Bend, length=20, angle=angle, k0_from_h=True)]
+    env.new_line(name='lhcb1', components=components)
+    line = env.lhcb1
+    line.steering_correctors_x = [nn for nn in line.element_names if nn.startswith('mcbh.')]
+    line.steering_correctors_y = [nn for nn in line.element_names if nn.startswith('mcbv.')]
+    line.steering_monitors_x = [nn for nn in line.element_names if nn.startswith('bpm.')]
+    line.steering_monitors_y = line.steering_monitors_x
+    return env
+
+
+def add_errors(env):
+    rng = np.random.default_rng(1)
+    for cell in range(0, 50, 3):
+        env[f'mqf.{cell}'].shift_x = rng.normal(0, 1e-4)
+        env[f'mqd.{cell}'].shift_y = rng.normal(0, 1e-4)
+
+
+def kicks(line):
+    return np.array([line[f'orbit_corr_{nn}_x'] for nn in line.steering_correctors_x]
+                    + [line[f'orbit_corr_{nn}_y'] for nn in line.steering_correctors_y])
+
+
+# Reference: xtrack itself
+kicks_ref = {}
+for n_micado in [None, 5]:
+    env = make_env()
+    tw = env.lhcb1.twiss4d()
+    add_errors(env)
+    env.lhcb1.correct_trajectory(twiss_table=tw, n_micado=n_micado, n_iter=1)
+    kicks_ref[n_micado] = kicks(env.lhcb1)
+    assert np.any(kicks_ref[n_micado] != 0)
+
+# Stored from one environment, and loaded in another one
+store_orbit_response(make_env(), path_temp / 'ring.orbit_response.npz')
+for n_micado in [None, 5]:
+    env = make_env()
+    assert load_orbit_response(env, path_temp / 'ring.orbit_response.npz') == ['lhcb1']
+    loaded = get_trajectory_correction(env.lhcb1)
+    tw = env.lhcb1.twiss4d()
+    add_errors(env)
+    assert correct_trajectory(env.lhcb1, twiss_table=tw, n_micado=n_micado, n_iter=1) is loaded
+    assert np.allclose(kicks(env.lhcb1), kicks_ref[n_micado], rtol=1e-10, atol=1e-15)
+
+# Other optics give another correction
+env = make_env()
+load_orbit_response(env, path_temp / 'ring.orbit_response.npz')
+loaded = get_trajectory_correction(env.lhcb1)
+env['kqf'] = 0.0121
+assert get_trajectory_correction(env.lhcb1) is not loaded
+env['kqf'] = 0.012
+assert get_trajectory_correction(env.lhcb1) is loaded
+
+# Nothing is loaded on another lattice
+assert load_orbit_response(make_env(n_cells=40), path_temp / 'ring.orbit_response.npz') == []
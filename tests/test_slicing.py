@@ -0,0 +1,81 @@
+import tempfile
+import numpy as np
+import xtrack as xt
+from pathlib import Path
+
+from slice_tools import slice_env
+
+
+# Slicing with the cache (storing it, and applying it the next time) must give the same lines as
+# slicing without it: the same elements, optics and tracking, also when the knobs change afterwards
+path_temp = Path(tempfile.mkdtemp())
+
+
+def make_env(n_cells=8):
+    env = xt.Environment()
+    env.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, p0c=450e9)
+    env['kqf'] = 0.008
+    env['kqd'] = -0.008
+    env['kqt'] = 0
+    env['ksf'] = 0.05
+    for beam in [1, 2]:
+        components = []
+        for cell in range(n_cells):
+            components += [env.new(f'mq.{cell}f.b{beam}', xt.Quadrupole, length=3, k1='kqf'),
+                           env.new(f'mqt.{cell}.b{beam}', xt.Quadrupole, length=0.3, k1='kqt'),
+                           env.new(f'ms.{cell}.b{beam}', xt.Sextupole, length=0.4, k2='ksf'),
+                           env.new(f'bpm.{cell}.b{beam}', xt.Marker),
+                           env.new(f'mb.{cell}a.b{beam}', xt.Bend, length=10, angle=np.pi / (2 * n_cells),
+                                   k0_from_h=True),
+                           env.new(f'mq.{cell}d.b{beam}', xt.Quadrupole, length=3, k1='kqd'),
+                           env.new(f'mb.{cell}b.b{beam}', xt.Bend, length=10, angle=np.pi / (2 * n_cells),
+                                   k0_from_h=True),
+                           env.new(f'd.{cell}.b{beam}', xt.Drift, length=2)]
+        components.append(env.new(f'mqxa.1.b{beam}', xt.Quadrupole, length=1, k1=f'kqf * {0.1 * beam}'))
+        env.new_line(name=f'lhcb{beam}', components=components)
+    return env
+
+
+def optics_and_tracking(env):
+    result = {}
+    for linename, line in env.lines.items():
+        tw = line.twiss4d()
+        particles = line.build_particles(x=np.linspace(0, 1e-3, 10), px=1e-5)
+        line.track(particles, num_turns=20)
+        result[linename] = {'names': list(line.element_names), 'qx': tw.qx, 'qy': tw.qy,
+                            'betx': tw.betx, 'bety': tw.bety, 'x': particles.x.copy(), 'px': particles.px.copy()}
+    return result
+
+
+def check_same(result, reference):
+    assert result.keys() == reference.keys()
+    for linename, this in result.items():
+        ref = reference[linename]
+        assert this['names'] == ref['names'], linename
+        for kk in ['qx', 'qy', 'betx', 'bety', 'x', 'px']:
+            assert np.array_equal(this[kk], ref[kk]), f"{linename}: {kk}"
+
+
+fresh = slice_env(make_env(), slicefactor=2)
+assert len(fresh.lhcb1.element_names) > len(make_env().lhcb1.element_names)
+stored = slice_env(make_env(), slicefactor=2, cache_dir=path_temp)
+assert len(list(path_temp.glob('sliced_*.json'))) == 1
+applied = slice_env(make_env(), slicefactor=2, cache_dir=path_temp)
+assert len(list(path_temp.glob('sliced_*.json'))) == 1
+
+reference = optics_and_tracking(fresh)
+check_same(optics_and_tracking(stored), reference)
+check_same(optics_and_tracking(applied), reference)
+
+# The slices follow the knobs of their parents
+for env in [fresh, stored, applied]:
+    env['kqt'] = 1e-4
+    env['ksf'] = 0.08
+reference = optics_and_tracking(fresh)
+assert reference['lhcb1']['qx'] != optics_and_tracking(slice_env(make_env(), slicefactor=2))['lhcb1']['qx']
+check_same(optics_and_tracking(stored), reference)
+check_same(optics_and_tracking(applied), reference)
+
+# Another slicing is stored next to it
+slice_env(make_env(), slicefactor=3, cache_dir=path_temp)
+assert len(list(path_temp.glob('sliced_*.json'))) == 2
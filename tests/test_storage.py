@@ -0,0 +1,145 @@
+import json
+import tempfile
+import numpy as np
+import xtrack as xt
+from pathlib import Path
+
+from storage_tools import store_env, load_env, store_delta, load_delta, record_file
+
+
+# The binary environment files must give the same environment as the JSON path (to_json/from_json),
+# also for deltas w.r.t. them
+path_temp = Path(tempfile.mkdtemp())
+
+
+def make_env(n_cells=8):
+    env = xt.Environment()
+    env.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, p0c=450e9)
+    env['kqf'] = 0.008
+    env['kqd'] = -0.008
+    env['on_b3'] = 1
+    env['kcorr'] = 0
+    for beam in [1, 2]:
+        components = []
+        for cell in range(n_cells):
+            env.new(f'mb.{cell}.b{beam}', xt.Bend, length=10, angle=2 * np.pi / (2 * n_cells), k0_from_h=True)
+            env.new(f'mqf.{cell}.b{beam}', xt.Quadrupole, length=1, k1='kqf')
+            env.new(f'mqd.{cell}.b{beam}', xt.Quadrupole, length=1, k1='kqd')
+            env.new(f'mcb.{cell}.b{beam}', xt.Multipole, knl=[0], ksl=[0])
+            env.new(f'bpm.{cell}.b{beam}', xt.Marker)
+            env.new(f'ap.{cell}.b{beam}', xt.LimitEllipse, a=0.02, b=0.02)
+            components += [env.place(f'mqf.{cell}.b{beam}'), env.new(f'd1.{cell}.b{beam}', xt.Drift, length=2),
+                           env.place(f'mb.{cell}.b{beam}'), env.place(f'ap.{cell}.b{beam}'),
+                           env.place(f'mqd.{cell}.b{beam}'), env.place(f'mcb.{cell}.b{beam}'),
+                           env.place(f'bpm.{cell}.b{beam}'), env.new(f'd2.{cell}.b{beam}', xt.Drift, length=10)]
+        env.new_line(name=f'lhcb{beam}', components=components)
+        env[f'lhcb{beam}'].extend_knl_ksl(order=5, element_names=[f'mqf.{cell}.b{beam}' for cell in range(n_cells)])
+        for cell in range(n_cells):
+            env.ref[f'mqf.{cell}.b{beam}'].knl[2] = 1e-3 * (cell + 1) * env.ref['on_b3']
+            env.ref[f'mcb.{cell}.b{beam}'].knl[0] = env.ref['kcorr'] * (cell % 3 - 1)
+    env.lhcb2.slice_thick_elements(slicing_strategies=[xt.Strategy(slicing=None),
+                                                       xt.Strategy(slicing=xt.Teapot(2), element_type=xt.Quadrupole)])
+    env.metadata['steering'] = {'lhcb1': 'abc'}
+    return env
+
+
+def as_json(env):
+    # Without the time of the reference particles, which is set by twiss
+    dct = env.to_dict()
+    for this_dct in [dct, *dct['lines'].values()]:
+        if isinstance(this_dct.get('particle_ref'), dict):
+            this_dct['particle_ref'].pop('t_sim', None)
+    return json.dumps(dct, cls=xt.json._XtrackJSONEncoder, sort_keys=True)
+
+
+def check_same(env, ref):
+    assert as_json(env) == as_json(ref), "The environments differ"
+    for linename, line in ref.lines.items():
+        tw = env[linename].twiss4d()
+        tw_ref = line.twiss4d()
+        assert np.isclose(tw.qx, tw_ref.qx, rtol=0, atol=1e-12) and np.isclose(tw.qy, tw_ref.qy, rtol=0, atol=1e-12)
+        assert np.allclose(tw.betx, tw_ref.betx, rtol=1e-12, atol=0)
+        particles = line.build_particles(x=[1e-4, 2e-4], y=[1e-4, -1e-4])
+        particles_new = env[linename].build_particles(x=[1e-4, 2e-4], y=[1e-4, -1e-4])
+        line.track(particles, num_turns=10)
+        env[linename].track(particles_new, num_turns=10)
+        assert np.array_equal(particles.x, particles_new.x) and np.array_equal(particles.py, particles_new.py)
+
+
+for mmap in [True, False]:
+    env = make_env()
+    store_env(env, path_temp / 'env.xenv')
+    env.to_json(path_temp / 'env.json')
+    loaded = load_env(path_temp / 'env.xenv', mmap=mmap)
+    check_same(loaded, xt.Environment.from_json(path_temp / 'env.json'))
+
+    # The loaded environment behaves as the original one, and changing it does not change the file
+    for ee in [env, loaded]:
+        ee['kqf'] = 0.0081
+        ee['kcorr'] = 1e-5
+        ee.lhcb1.extend_knl_ksl(order=8, element_names=['mcb.3.b1'])
+        ee['mcb.3.b1'].ksl[7] = 0.1
+        ee.new('extra', xt.Multipole, knl=[0, 0, 1e-3])
+    assert loaded['mqf.0.b1'].knl[2] == env['mqf.0.b1'].knl[2] and loaded['mcb.1.b1'].knl[0] == env['mcb.1.b1'].knl[0]
+    check_same(loaded, env)
+    check_same(load_env(path_temp / 'env.xenv'), make_env())
+
+    # Deltas w.r.t. the binary file are the same as the ones w.r.t. the JSON file
+    del env.element_dict['extra']
+    env['on_b3'] = 0.5
+    env.ref['mqd.2.b1'].knl[0] = 1e-6 * env.ref['kcorr']
+    env.metadata['steering']['lhcb2'] = 'def'
+    store_delta(env, path_temp / 'env.xenv', path_temp / 'env_xenv.delta.json')
+    store_delta(env, path_temp / 'env.json', path_temp / 'env_json.delta.json')
+    assert xt.json.load(path_temp / 'env_xenv.delta.json')['delta'] == xt.json.load(path_temp / 'env_json.delta.json')['delta']
+    check_same(load_delta(path_temp / 'env_xenv.delta.json'), env)
+    check_same(load_delta(path_temp / 'env_json.delta.json'), env)
+
+# A delta is only applied to the base it was stored against
+for suffix in ['xenv', 'json']:
+    base = make_env()
+    base['kqf'] = 0.0079
+    store_env(base, path_temp / f'other.{suffix}')
+    for args in [(path_temp / f'env_{suffix}.delta.json', path_temp / f'other.{suffix}'),
+                 (path_temp / f'env_{suffix}.delta.json',)]:
+        if len(args) == 1:
+            store_env(base, path_temp / f'env.{suffix}')  # The base is built again, differently
+        try:
+            load_delta(*args)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"A delta was applied to another base ({args})")
+
+# With a lattice of record, a delta w.r.t. the binary file refers to the JSON file, which does not
+# depend on the xsuite versions (and can be loaded without the binary file)
+store_env(make_env(), path_temp / 'recorded.xenv', record=True)
+assert record_file(path_temp / 'recorded.xenv') == path_temp / 'recorded.json'
+store_delta(env, path_temp / 'recorded.xenv', path_temp / 'recorded.delta.json')
+delta = xt.json.load(path_temp / 'recorded.delta.json')
+assert Path(delta['base_file']) == path_temp / 'recorded.json'
+assert delta['delta'] == xt.json.load(path_temp / 'env_json.delta.json')['delta']
+(path_temp / 'recorded.xenv').unlink()
+check_same(load_delta(path_temp / 'recorded.delta.json'), env)
+# A lattice of record that changed since is not used
+store_env(make_env(), path_temp / 'recorded.xenv', record=True)
+store_env(base, path_temp / 'recorded.json')
+store_delta(env, path_temp / 'recorded.xenv', path_temp / 'recorded.delta.json')
+assert Path(xt.json.load(path_temp / 'recorded.delta.json')['base_file']) == path_temp / 'recorded.xenv'
+check_same(load_delta(path_temp / 'recorded.delta.json'), env)
+
+# A file ending in .json is just JSON
+store_env(env, path_temp / 'env2.json')
+check_same(load_env(path_temp / 'env2.json'), xt.Environment.from_json(path_temp / 'env2.json'))
+
+# Storing an environment that cannot be converted leaves it as it was
+env = make_env()
+elements = dict(env.element_dict)
+env.metadata['unstorable'] = (ii for ii in range(3))
+try:
+    store_env(env, path_temp / 'unstorable.xenv')
+except TypeError:
+    pass
+else:
+    raise AssertionError("Storing a generator did not fail")
+assert env.element_dict.keys() == elements.keys() and all(env.element_dict[nn] is ee for nn, ee in elements.items())
@@ -0,0 +1,124 @@
+import numpy as np
+import xtrack as xt
+
+from tuning_tools import match_tune_chrom, match_coupling, match_tune_chrom_coupling, match_tune_chrom_coupling_newton, \
+    tune_response, clear_response_matrices, _TUNE_KNOBS
+
+
+# The tolerance ladder in one optimizer must reach the same knobs as a line.match per tolerance
+# (as match_tune_chrom did before), and restore the knobs of the last level that was met on failure
+tols = [1e-4, 2e-5, 5e-6, 1e-6]
+
+
+def make_line(n_cells=16):
+    env = xt.Environment()
+    env.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, p0c=450e9)
+    for nn, vv in dict(kqf=0.0095, kqd=-0.0095, kqtf=0, kqtd=0, ksf=0.02, ksd=-0.04, cmrs=0, cmis=0).items():
+        env[nn] = vv
+    angle = np.pi / n_cells
+    components = []
+    for cell in range(n_cells):
+        skew = ['cmrs', 'cmis', '0', '0'][cell % 4]
+        components += [env.new(f'mqf.{cell}', xt.Quadrupole, length=3, k1='kqf + kqtf'),
+                       env.new(f'msf.{cell}', xt.Sextupole, length=0.5, k2='ksf'),
+                       env.new(f'mqs.{cell}', xt.Quadrupole, length=0.3, k1s=skew),
+                       env.new(f'mb.{cell}a', xt.Bend, length=20, angle=angle, k0_from_h=True),
+                       env.new(f'mqd.{cell}', xt.Quadrupole, length=3, k1='kqd + kqtd'),
+                       env.new(f'msd.{cell}', xt.Sextupole, length=0.5, k2='ksd'),
+                       env.new(f'mb.{cell}b', xt.Bend, length=20, angle=angle, k0_from_h=True),
+                       env.new(f'd.{cell}', xt.Drift, length=2)]
+    components.append(env.new('cav', xt.Cavity, voltage=6e6, frequency=400e6, phase=np.pi))
+    line = env.new_line(name='lhcb1', components=components)
+    line.particle_ref = env.particle_ref
+    line.twiss_default['method'] = '4d'
+    return line
+
+
+def match_tune_chrom_per_level(line, qx, qy, dqx, dqy, tol):
+    penalty = 1e10
+    n_twiss = 0
+    for this_tol in tol:
+        if penalty < this_tol:
+            continue
+        opt = line.match(method='6d',
+                         vary=[xt.VaryList(['kqtf', 'kqtd'], step=this_tol*1e-1, tag='quad'),
+                               xt.VaryList(['ksf', 'ksd'], step=this_tol*1e-1, tag='sext')],
+                         targets=[xt.TargetSet(qx=qx, qy=qy, tol=this_tol, tag='tune'),
+                                  xt.TargetSet(dqx=dqx, dqy=dqy, tol=this_tol, tag='chrom')])
+        n_twiss += opt._err.call_counter
+        if this_tol != tol[-1]:
+            penalty = np.sqrt((opt.target_status(True).residue**2).sum())
+    return n_twiss
+
+
+tw0 = make_line().twiss(method='6d')
+targets = dict(qx=tw0.qx + 0.01, qy=tw0.qy - 0.01, dqx=5., dqy=3.)
+knobs = {}
+n_twiss = {}
+for name, match in [('ladder', match_tune_chrom), ('per level', match_tune_chrom_per_level)]:
+    line = make_line()
+    result = match(line, **targets, tol=tols)
+    if name == 'ladder':
+        call_counts = result.call_counts
+        result = sum(cc['n_twiss'] for cc in call_counts)
+    n_twiss[name] = result
+    knobs[name] = np.array([line[kk] for kk in ['kqtf', 'kqtd', 'ksf', 'ksd']])
+    tw = line.twiss(method='6d')
+    for kk, vv in targets.items():
+        assert abs(tw[kk] - vv) < tols[-1], f"{name}: {kk} = {tw[kk]} instead of {vv}"
+assert np.allclose(knobs['ladder'], knobs['per level'], rtol=1e-6, atol=0)
+# The ladder saves twisses: only the first level needs a Jacobian
+print(f"Twisses: {n_twiss}, per level of the ladder: {call_counts}")
+assert n_twiss['ladder'] < n_twiss['per level']
+
+# A level that cannot be met restores the knobs of the previous one
+line = make_line()
+match_coupling(line, c_minus=0.01, tol=[1e-3, 1e-4])
+matched = (line['cmrs'], line['cmis'])
+try:
+    match_coupling(line, c_minus=0.9, tol=[1e-3, 1e-4])
+except RuntimeError:
+    assert (line['cmrs'], line['cmis']) == matched
+else:
+    raise AssertionError("Matching an unreachable coupling did not fail")
+
+# The Newton steps on the response matrix reach the same machine as the matcher
+targets['c_minus'] = 1e-3
+lines = {}
+for name in ['newton', 'match']:
+    lines[name] = line = make_line()
+    if name == 'newton':
+        result = match_tune_chrom_coupling_newton(line, **targets, tol=1e-6, tol_coupling=1e-6)
+        assert result['converged'], result
+    else:
+        match_tune_chrom_coupling(line, **targets, tol=[1e-4, 1e-5, 1e-6])
+    tw = line.twiss(method='6d')
+    for kk, vv in [*targets.items(), ('c_minus_re_0', targets['c_minus']), ('c_minus_im_0', 0)]:
+        if kk != 'c_minus':
+            assert abs(tw[kk] - vv) < 1e-6, f"{name}: {kk} = {tw[kk]} instead of {vv}"
+assert np.allclose([lines['newton'][kk] for kk in _TUNE_KNOBS], [lines['match'][kk] for kk in _TUNE_KNOBS],
+                   rtol=1e-3, atol=1e-7)
+
+# The response matrix is calculated once when tuning the clean machine, and reused for the errors of
+# every seed (as in campaign_tools.prepare_environment)
+clear_response_matrices()
+line = make_line()
+match_tune_chrom_coupling_newton(line, **targets, tol=1e-6, tol_coupling=1e-6)
+response = tune_response(line)
+rng = np.random.default_rng(0)
+for seed in range(2):
+    errored = make_line()
+    for kk in _TUNE_KNOBS:
+        errored[kk] = line[kk]
+    for cell in range(16):
+        errored[f'msf.{cell}'].shift_x = rng.normal(0, 1e-3)
+        errored[f'mqd.{cell}'].rot_s_rad = rng.normal(0, 1e-4)
+    assert tune_response(errored) is response
+    result = match_tune_chrom_coupling_newton(errored, **targets, tol=1e-5)
+    assert result['converged'] and result['n_twiss'] == result['n_steps'] + 1, result
+# but not for another lattice
+assert tune_response(make_line(n_cells=20)) is not response
+# and the finite-difference step of every knob is large enough to be above the numerical noise
+tw = line.twiss(method='6d')
+line['ksf'] += 1e-3
+assert np.allclose(line.twiss(method='6d').dqx - tw.dqx, response[2, 2] * 1e-3, rtol=1e-3)
@@ -0,0 +1,60 @@
+import numpy as np
+import xtrack as xt
+
+from twiss_tools import cached_twiss, get_twiss_cache, state_fingerprint
+
+
+# The twiss cache must only reuse a table for the same machine state: a hit on an unchanged line, a
+# miss after a knob or an element attribute changed, and a hit again once the change is undone
+n_cells = 8
+env = xt.Environment()
+env.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, p0c=450e9)
+env['kqf'] = 0.0095
+env['kqd'] = -0.0095
+components = []
+for cell in range(n_cells):
+    components += [env.new(f'mqf.{cell}', xt.Quadrupole, length=3, k1='kqf'),
+                   env.new(f'mb.{cell}a', xt.Bend, length=20, angle=np.pi / n_cells, k0_from_h=True),
+                   env.new(f'mqd.{cell}', xt.Quadrupole, length=3, k1='kqd'),
+                   env.new(f'mb.{cell}b', xt.Bend, length=20, angle=np.pi / n_cells, k0_from_h=True)]
+line = env.new_line(name='ring', components=components)
+line.twiss_default['method'] = '4d'
+cache = get_twiss_cache(env)
+
+
+def check(hit, expected):
+    # Whether the last call was a hit or a miss, and the table is the same as a fresh twiss
+    stats = dict(cache.stats())
+    tw = cached_twiss(line)
+    assert cache.hits - stats['hits'] == hit and cache.misses - stats['misses'] == (not hit)
+    assert np.isclose(tw.qx, line.twiss().qx, rtol=1e-12, atol=0)
+    if expected is not None:
+        assert (tw is expected) == hit
+    return tw
+
+
+tw0 = check(hit=False, expected=None)
+fingerprint0 = state_fingerprint(line)
+check(hit=True, expected=tw0)
+
+# A knob
+env['kqf'] = 0.0096
+assert state_fingerprint(line) != fingerprint0
+tw1 = check(hit=False, expected=tw0)
+assert tw1.qx != tw0.qx
+env['kqf'] = 0.0095
+assert state_fingerprint(line) == fingerprint0
+check(hit=True, expected=tw0)
+
+# An element attribute set directly in the element (not through a knob or an expression)
+line.element_dict['mqd.3'].k1 = -0.0097
+assert state_fingerprint(line) != fingerprint0
+tw2 = check(hit=False, expected=tw0)
+assert tw2.qy != tw0.qy
+line.element_dict['mqd.3'].k1 = -0.0095
+check(hit=True, expected=tw0)
+assert str(env.ref['mqd.3'].k1._expr) == "vars['kqd']"
+
+# Other options are another table
+assert cached_twiss(line, method='4d', delta0=1e-4) is not tw0
+assert cache.stats()['size'] == 4
@@ -0,0 +1 @@
+../twiss_tools.py
\ No newline at end of file
@@ -1,11 +1,38 @@
+import os
+import numpy as np
+from hashlib import sha1
 from math import floor, log10
 from pathlib import Path
 
+from index_tools import get_element_index
+from twiss_tools import cached_twiss
 
-def store_twiss_reference(env):
+
+def get_twiss_reference(env):
+    # The optics needed for the MB correction (see correction_tools), per line as a dict of columns
+    # in the same format as read_table_columns of the stored file
+    result = {}
+    index = get_element_index(env)
     for linename, line in env.lines.items():
         tt = line.get_table(attr=True)
-        tw = line.twiss()
+        tw = cached_twiss(line)
+        n_rows = min(len(tt.name), len(tw.name))
+        names = tt.name[:n_rows]
+        mask = index[linename].plugged[:n_rows].copy()
+        mask &= np.array([nn.startswith(('mb.', 'mbh.', 'mqt.14', 'mqt.15', 'mqt.16', 'mqt.17', 'mqt.18',
+                                         'mqt.19', 'mqt.20', 'mqt.21', 'mqs.', 'mss.', 'mco.', 'mcd.', 'mcs.'))
+                          for nn in names], dtype=bool)
+        result[linename] = {'name': np.array(names[mask], dtype=str),
+                            'K0L': tt.k0l[:n_rows][mask], 'K1L': tt.k1l[:n_rows][mask],
+                            'BETX': tw.betx[:n_rows][mask], 'BETY': tw.bety[:n_rows][mask],
+                            'DX': tw.dx[:n_rows][mask], 'MUX': tw.mux[:n_rows][mask],
+                            'MUY': tw.muy[:n_rows][mask]}
+    return result
+
+
+def store_twiss_reference(env, path_temp='temp'):
+    for linename, columns in get_twiss_reference(env).items():
+        line = env.lines[linename]
         lines = []
         lines.append('@ NAME             %05s "TWISS"')
         lines.append('@ TYPE             %05s "TWISS"')
@@ -14,23 +41,10 @@ def store_twiss_reference(env):
         lines.append(f'@ ENERGY           %le                 {energy}')
         lines.append("* NAME                              K0L                K1L               BETX               BETY                 DX                MUX                MUY ")
         lines.append("$ %s                                %le                %le                %le                %le                %le                %le                %le ")
-        for nn, et, k0l, k1l, betx, bety, dx, mux, muy in zip(tt.name, tt.element_type, tt.k0l, tt.k1l, tw.betx, tw.bety, tw.dx, tw.mux, tw.muy):
-            if et.startswith('Drift') or et.startswith('Limit') or et.startswith('Marker'):
-                continue
-            if nn.startswith('mb.') or nn.startswith('mbh.') or nn.startswith('mqt.14') \
-            or nn.startswith('mqt.15') or nn.startswith('mqt.16') or nn.startswith('mqt.17') \
-            or nn.startswith('mqt.18') or nn.startswith('mqt.19') or nn.startswith('mqt.20') \
-            or nn.startswith('mqt.21') or nn.startswith('mqs.') or nn.startswith('mss.') \
-            or nn.startswith('mco.') or nn.startswith('mcd.') or nn.startswith('mcs.'):
-                mess  = f' "{nn.upper()}"'
-                mess  = f'{mess:20}'
-                mess += f'     {_format_fortran_float(k0l)}     {_format_fortran_float(k1l)}'
-                mess += f'     {_format_fortran_float(betx)}     {_format_fortran_float(bety)}'
-                mess += f'     {_format_fortran_float(dx)}     {_format_fortran_float(mux)}'
-                mess += f'     {_format_fortran_float(muy)}'
-                lines.append(mess)
-        Path('temp').mkdir(parents=True, exist_ok=True)
-        with Path(f'temp/optics0_MB_{linename}.mad').open('w') as fp:
+        values = np.column_stack([columns[kk] for kk in ['K0L', 'K1L', 'BETX', 'BETY', 'DX', 'MUX', 'MUY']])
+        lines += _format_fortran_rows(columns['name'], values)
+        Path(path_temp).mkdir(parents=True, exist_ok=True)
+        with (Path(path_temp) / f'optics0_MB_{linename}.mad').open('w') as fp:
             fp.write('\n'.join(lines) + '\n')
 
 
@@ -53,10 +67,91 @@ def read_table(filename):
     return result
 
 
-def store_errors(env, pattern=['mb.*', 'mbh.*']):
-    pattern = [patt.replace('*', '') for patt in pattern]  # TODO: use table rows instead of loop
+def read_table_columns(filename, cache_dir='temp/tfs_cache'):
+    # Same as read_table, but returns a dict of NumPy columns (name as str, all others as float).
+    # The parsed table is cached as an .npz file keyed on the path, size and modification time
+    # of the source, such that repeated reads of the same table skip the text parsing.
+    filename = Path(filename)
+    cache_file = _table_cache_file(filename, cache_dir) if cache_dir else None
+    if cache_file is not None and cache_file.exists():
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                names, header, values = data['name'], data['header'], data['values']
+        except (OSError, ValueError, KeyError):
+            cache_file.unlink(missing_ok=True)
+        else:
+            return _columns_from_arrays(names, header, values)
+    with filename.open('r') as fp:
+        header = []
+        rows = []
+        for line in fp.readlines():
+            line = line.strip()
+            if line == '' or line.startswith('@') or line.startswith('$'):
+                continue
+            elif line.startswith('*'):
+                header = line.split()[1:]
+            else:
+                parts = line.split()
+                if parts[0].lower() == 'not_found' \
+                or [parts[0].lower(), parts[1].lower()] == ['not', 'found']:
+                    continue
+                rows.append(parts)
+    names = np.array([parts[0].replace('"', '').lower() for parts in rows], dtype=str)
+    values = np.array([parts[1:len(header)] for parts in rows], dtype=float).reshape(len(rows), len(header)-1)
+    header = np.array(header[1:], dtype=str)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp.npz')
+        np.savez(tmp_file, name=names, header=header, values=values)
+        tmp_file.replace(cache_file)
+    return _columns_from_arrays(names, header, values)
+
+
+def columns_to_rows(columns):
+    # Convert the output of read_table_columns into the dict-of-dicts format of read_table
+    keys = [kk for kk in columns if kk != 'name']
+    values = np.column_stack([columns[kk] for kk in keys]).tolist() if keys else [[]]*len(columns['name'])
+    return {nn: dict(zip(keys, vv)) for nn, vv in zip(columns['name'].tolist(), values)}
+
+
+def _columns_from_arrays(names, header, values):
+    columns = {'name': names}
+    for i, kk in enumerate(header.tolist()):
+        columns[kk] = values[:, i]
+    return columns
+
+
+def _table_cache_file(filename, cache_dir):
+    stat = filename.stat()
+    key = sha1(f'{filename.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()[:16]
+    return Path(cache_dir) / f'{filename.stem}-{key}.npz'
+
+
+def get_errors(env, pattern=['mb.*', 'mbh.*']):
+    # The knl and ksl (up to order 20) of the plugged magnets starting with the given patterns, per
+    # line as a dict of columns K0L, K0SL, K1L, ... (as read_table_columns of the stored file)
+    pattern = tuple(patt.replace('*', '') for patt in pattern)
+    result = {}
     for linename, line in env.lines.items():
-        tt = line.get_table(attr=True)
+        index = get_element_index(env)[linename]
+        mask = index.plugged & np.array([nn.startswith(pattern) for nn in index.name], dtype=bool)
+        names = index.name[mask]
+        values = np.zeros((len(names), 42))
+        for i, nn in enumerate(names):
+            knl = np.asarray(line[nn].knl)[:21]
+            ksl = np.asarray(line[nn].ksl)[:21]
+            values[i, 0:2*len(knl):2] = knl
+            values[i, 1:2*len(ksl):2] = ksl
+        columns = {'name': names}
+        for i in range(21):
+            columns[f'K{i}L'] = values[:, 2*i]
+            columns[f'K{i}SL'] = values[:, 2*i+1]
+        result[linename] = columns
+    return result
+
+
+def store_errors(env, pattern=['mb.*', 'mbh.*'], path_temp='temp'):
+    for linename, columns in get_errors(env, pattern=pattern).items():
         lines = ['@ NAME             %06s "EFIELD"']
         lines.append('@ TYPE             %06s "EFIELD"')
         mess_col   = '* NAME                              K0L               K0SL                K1L               '
@@ -79,59 +174,68 @@ def store_errors(env, pattern=['mb.*', 'mbh.*']):
         mess_type += '%le                %le                %le                %le                %le                '
         mess_type += '%le                %le                %le                %le '
         lines.append(mess_type)
-        for nn, et in zip(tt.name, tt.element_type):
-            if et.startswith('Drift') or et.startswith('Limit') or et.startswith('Marker'):
-                continue
-            if any([nn.startswith(patt) for patt in pattern]):
-                mess  = f' "{nn.upper()}"'
-                mess  = f'{mess:20}'
-                knl = line[nn].knl
-                ksl = line[nn].ksl
-                for i in range(21):
-                    knli = knl[i] if i < len(knl) else 0.0
-                    ksli = ksl[i] if i < len(ksl) else 0.0
-                    mess += f'     {_format_fortran_float(knli)}     {_format_fortran_float(ksli)}'
-                lines.append(mess)
-        Path('temp').mkdir(parents=True, exist_ok=True)
-        with Path(f'temp/MB_{linename}.errors').open('w') as fp:
+        values = np.column_stack([columns[f'K{i}{kk}'] for i in range(21) for kk in ['L', 'SL']])
+        lines += _format_fortran_rows(columns['name'], values)
+        Path(path_temp).mkdir(parents=True, exist_ok=True)
+        with (Path(path_temp) / f'MB_{linename}.errors').open('w') as fp:
             fp.write('\n'.join(lines) + '\n')
 
 
 def _format_fortran_float(value, n_digits=14):
-    if abs(value) > 9.99e99:
-        raise ValueError(f"Value {value} is too large.")
-    elif abs(value) < 1e-99:
-        return f"{'0.0':>{n_digits}}"
-    if 1.e-4 <= value <= 999999999. or -1.e-4 >= value >= -99999999.:
-        max_digits = n_digits-2 if value > 0 else n_digits-3
-        n_decimal_digits = int(max_digits - max(floor(log10(abs(value))), 0))
-        value_string = f"{value:{n_digits}.{n_decimal_digits}f}"
-        value_splitted = value_string.split('.')
-        if len(value_splitted) == 1:
-            return f"{value_string[1:]}."
-        else:
-            decimals = value_splitted[1]
-            while decimals[-1] == '0':
-                decimals = decimals[:-1]
-                if decimals == '':
-                    decimals = '0'
-                    break
-            value_string = f"{value_splitted[0]}.{decimals}"
-            return f"{value_string:>{n_digits}}"
-    else:
-        max_digits = n_digits-6 if value > 0 else n_digits-7
-        value_string = f"{value:.{max_digits}E}"
-        value_splitted = value_string.split('E')
-        value_splitted_mant = value_splitted[0].split('.')
-        if len(value_splitted_mant) == 1:
-            return value_string
-        else:
-            decimals = value_splitted_mant[1]
-            dot = '.'
-            while decimals[-1] == '0':
-                decimals = decimals[:-1]
-                if decimals == '':
-                    dot = ''
-                    break
-            value_string = f"{value_splitted_mant[0]}{dot}{decimals}E{value_splitted[1]}"
-            return f"{value_string:>{n_digits}}"
+    return str(_format_fortran_floats([value], n_digits=n_digits)[0])
+
+
+def _format_fortran_floats(values, n_digits=14):
+    # Vectorised version of _format_fortran_float, giving identical strings for a whole array
+    values = np.asarray(values, dtype=float)
+    if np.any(~np.isfinite(values)) or np.any(np.abs(values) > 9.99e99):
+        raise ValueError("Array contains values that are too large.")
+    flat = values.ravel()
+    result = np.full(flat.shape, '0.0', dtype=f'<U{n_digits+10}')
+    nonzero = np.abs(flat) >= 1e-99
+    fixed = nonzero & (((flat >= 1.e-4) & (flat <= 999999999.)) | ((flat <= -1.e-4) & (flat >= -99999999.)))
+    scientific = nonzero & ~fixed
+
+    # Fixed-point notation, the number of decimals depends on the magnitude
+    if np.any(fixed):
+        vals = flat[fixed]
+        exponent = np.log10(np.abs(vals))
+        # Close to a power of ten the floor is sensitive to the log implementation: use math.log10
+        edge = np.abs(exponent - np.round(exponent)) < 1e-9
+        exponent = np.floor(exponent)
+        exponent[edge] = [floor(log10(abs(vv))) for vv in vals[edge]]
+        n_decimal_digits = np.where(vals > 0, n_digits-2, n_digits-3) - np.maximum(exponent, 0).astype(int)
+        strings = np.empty(vals.shape, dtype=result.dtype)
+        for n_dec in np.unique(n_decimal_digits):
+            this_mask = n_decimal_digits == n_dec
+            strings[this_mask] = _format_many(f'%.{n_dec}f', vals[this_mask])
+        strings = np.char.rstrip(strings, '0')
+        result[fixed] = np.where(np.char.endswith(strings, '.'), np.char.add(strings, '0'), strings)
+
+    # Scientific notation, with trailing zeros of the mantissa removed
+    if np.any(scientific):
+        vals = flat[scientific]
+        strings = np.empty(vals.shape, dtype=result.dtype)
+        positive = vals > 0
+        strings[positive] = _format_many(f'%.{n_digits-6}E', vals[positive])
+        strings[~positive] = _format_many(f'%.{n_digits-7}E', vals[~positive])
+        mantissa, _, exponent = np.char.partition(strings, 'E').T
+        mantissa = np.char.rstrip(np.char.rstrip(mantissa, '0'), '.')
+        result[scientific] = np.char.add(np.char.add(mantissa, 'E'), exponent)
+
+    return np.char.rjust(result, n_digits).reshape(values.shape)
+
+
+def _format_many(fmt, values):
+    # A single formatting call for all values is much faster than one call per value
+    if len(values) == 0:
+        return []
+    return ((fmt + '\n') * len(values) % tuple(values.tolist())).split('\n')[:-1]
+
+
+def _format_fortran_rows(names, values):
+    # One TFS row per name, with the name column followed by all formatted values
+    strings = _format_fortran_floats(values).tolist()
+    names = [f' "{nn.upper()}"' for nn in names]
+    return [f'{nn:20}     ' + '     '.join(row) for nn, row in zip(names, strings)]
+
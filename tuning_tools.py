@@ -1,77 +1,397 @@
+import multiprocessing
+from collections import OrderedDict
+
 import xtrack as xt
 import numpy as np
 
+from orbit_tools import correct_trajectory
+from knob_tools import KnobTransaction
+from profiling_tools import step, timed, step_stats, reset_steps, merge_step_stats
 
-def match_tune_chrom(line, qx, qy, dqx, dqy, tol=1e-3):
-    if hasattr(tol, '__iter__'):
-        penalty = 1e10
-        for this_tol in tol:
-            if penalty < this_tol:
-                continue
-            opt = match_tune_chrom(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy,
-                                   tol=this_tol)
-            if this_tol != tol[-1]:
-                penalty = np.sqrt((opt.target_status(True).residue**2).sum())
-        return opt
-    return line.match(
+
+def match_tune_chrom(line, qx, qy, dqx, dqy, tol=1e-3, knobs=None):
+    # tol can be a list of tolerances, which are tightened in one optimizer (see _match_ladder).
+    # knobs replaces the names of the tuning knobs (in the order of _TUNE_KNOBS, see beam_tuning_knobs).
+    tols = np.atleast_1d(tol)
+    knobs = _TUNE_KNOBS if knobs is None else knobs
+    opt = line.match(
+        solve=False, assert_within_tol=False, restore_if_fail=False,
         method='6d', # <- passed to twiss
         vary=[
-            xt.VaryList(['kqtf', 'kqtd'], step=tol*1e-1, tag='quad'),
-            xt.VaryList(['ksf', 'ksd'], step=tol*1e-1, tag='sext'),
+            xt.VaryList(knobs[:2], step=tols[0]*1e-1, tag='quad'),
+            xt.VaryList(knobs[2:4], step=tols[0]*1e-1, tag='sext'),
         ],
         targets = [
-            xt.TargetSet(qx=qx, qy=qy, tol=tol, tag='tune'),
-            xt.TargetSet(dqx=dqx, dqy=dqy, tol=tol, tag='chrom'),
+            xt.TargetSet(qx=qx, qy=qy, tol=tols[0], tag='tune'),
+            xt.TargetSet(dqx=dqx, dqy=dqy, tol=tols[0], tag='chrom'),
         ]
     )
+    return _match_ladder(opt, tols)
 
 
-def match_coupling(line, c_minus, tol=1e-3):
-    if hasattr(tol, '__iter__'):
-        penalty = 1e10
-        for this_tol in tol:
-            if penalty < this_tol:
-                continue
-            opt = match_coupling(line, c_minus=c_minus, tol=this_tol)
-            if this_tol != tol[-1]:
-                penalty = np.sqrt((opt.target_status(True).residue**2).sum())
-        return opt
-    return line.match(
+def match_coupling(line, c_minus, tol=1e-3, knobs=None):
+    tols = np.atleast_1d(tol)
+    knobs = _TUNE_KNOBS if knobs is None else knobs
+    opt = line.match(
+        solve=False, assert_within_tol=False, restore_if_fail=False,
         method='6d',
-        vary=[xt.VaryList(['cmrs', 'cmis'], limits=[-0.5e-2, 0.5e-2], step=tol*1e-1)],
+        vary=[xt.VaryList(knobs[4:6], limits=[-0.5e-2, 0.5e-2], step=tols[0]*1e-1)],
         targets=[
-            xt.Target('c_minus_re_0', c_minus, tol=tol), xt.Target('c_minus_im_0', 0, tol=tol)]
+            xt.Target('c_minus_re_0', c_minus, tol=tols[0]), xt.Target('c_minus_im_0', 0, tol=tols[0])]
     )
+    return _match_ladder(opt, tols)
 
 
-def match_tune_chrom_coupling(line, qx, qy, dqx, dqy, c_minus, tol=1e-3):
-    if hasattr(tol, '__iter__'):
-        penalty = 1e10
-        for this_tol in tol:
-            if penalty < this_tol:
-                continue
-            opt = match_tune_chrom_coupling(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy,
-                                            c_minus=c_minus, tol=this_tol)
-            if this_tol != tol[-1]:
-                penalty = np.sqrt((opt.target_status(True).residue**2).sum())
-        return opt
-    return line.match(
+def match_tune_chrom_coupling(line, qx, qy, dqx, dqy, c_minus, tol=1e-3, knobs=None):
+    tols = np.atleast_1d(tol)
+    knobs = _TUNE_KNOBS if knobs is None else knobs
+    opt = line.match(
+        solve=False, assert_within_tol=False, restore_if_fail=False,
         method='6d', # <- passed to twiss
         vary=[
-            xt.VaryList(['kqtf', 'kqtd'], step=tol*1e-1, tag='quad'),
-            xt.VaryList(['ksf', 'ksd'], step=tol*1e-1, tag='sext'),
-            xt.VaryList(['cmrs', 'cmis'], limits=[-5e-2, 5e-3], step=tol*1e-1, tag='skwew'),
+            xt.VaryList(knobs[:2], step=tols[0]*1e-1, tag='quad'),
+            xt.VaryList(knobs[2:4], step=tols[0]*1e-1, tag='sext'),
+            xt.VaryList(knobs[4:6], limits=[-5e-2, 5e-3], step=tols[0]*1e-1, tag='skwew'),
         ],
         targets = [
-            xt.TargetSet(qx=qx, qy=qy, tol=tol, tag='tune'),
-            xt.TargetSet(dqx=dqx, dqy=dqy, tol=tol, tag='chrom'),
-            xt.Target('c_minus_re_0', c_minus, tol=tol),
-            xt.Target('c_minus_im_0', 0, tol=tol)
+            xt.TargetSet(qx=qx, qy=qy, tol=tols[0], tag='tune'),
+            xt.TargetSet(dqx=dqx, dqy=dqy, tol=tols[0], tag='chrom'),
+            xt.Target('c_minus_re_0', c_minus, tol=tols[0]),
+            xt.Target('c_minus_im_0', 0, tol=tols[0])
         ]
     )
+    return _match_ladder(opt, tols)
+
+
+def _match_ladder(opt, tols, n_steps_broyden=5):
+    # Solve with the targets tightened in place through the tolerances, keeping the knobs and the
+    # Jacobian of the previous level: after the first level, Broyden updates of the last Jacobian
+    # are tried first, and a new Jacobian is only calculated if these do not converge. The steps of
+    # the knobs for the Jacobian follow the tolerance of the level (as in a line.match per level).
+    # Every level starts with a tagged point in the log, which also tells whether the level is
+    # already met (then it is skipped). As with a line.match per level, a RuntimeError is raised if
+    # a level cannot be met, with the knobs restored to where that level started (the last level
+    # that was met). The optimizer must be made with assert_within_tol=False and restore_if_fail=False.
+    # The number of twisses and Jacobians of every level are in opt.call_counts (also on failure).
+    opt.call_counts = []
+    get_jacobian = opt._err.get_jacobian
+
+    def counted_jacobian(*args, **kwargs):
+        opt.call_counts[-1]['n_jacobians'] += 1
+        return get_jacobian(*args, **kwargs)
+
+    opt._err.get_jacobian = counted_jacobian
+    try:
+        for level, this_tol in enumerate(tols):
+            for tt in opt.targets:
+                tt.tol = this_tol
+            for vv in opt.vary:
+                vv.step = this_tol * 1e-1
+            opt._err.steps_for_jacobian = [vv.step for vv in opt.vary]
+            n_calls = opt._err.call_counter
+            opt.call_counts.append({'tol': float(this_tol), 'n_twiss': 0, 'n_jacobians': 0})
+            try:
+                opt.tag(f'ladder_{level}')
+                if _within_tol(opt):
+                    continue
+                if level > 0:
+                    try:
+                        opt.solve(n_steps=n_steps_broyden, broyden=True)
+                    except np.linalg.LinAlgError:
+                        pass
+                if not _within_tol(opt):
+                    opt.solve()
+                if not _within_tol(opt):
+                    raise RuntimeError("Could not find point within tolerance.")
+            except Exception:
+                opt.reload(tag=f'ladder_{level}')
+                raise
+            finally:
+                opt.call_counts[-1]['n_twiss'] = opt._err.call_counter - n_calls
+    finally:
+        del opt._err.get_jacobian
+    return opt
+
+
+def _within_tol(opt):
+    # Whether all targets are met at the last point in the log
+    return 'n' not in opt.log().tol_met[-1]
+
+
+# Knobs and twiss quantities of the tune, chromaticity and coupling correction, and the per-beam
+# circuits the knobs drive (see knob_tools.add_tuning_knobs)
+_TUNE_KNOBS = ['kqtf', 'kqtd', 'ksf', 'ksd', 'cmrs', 'cmis']
+_TUNE_CIRCUITS = ['dqx', 'dqy', 'dqpx', 'dqpy', 'cmrs', 'cmis']
+_TUNE_OBSERVABLES = ['qx', 'qy', 'dqx', 'dqy', 'c_minus_re_0', 'c_minus_im_0']
+
+# Response matrices of the observables to the knobs, per lattice and scenario (see tune_response),
+# of which the _MAX_RESPONSE_MATRICES most recently used are kept
+_response_matrices = OrderedDict()
+_MAX_RESPONSE_MATRICES = 16
+# Change of the observables aimed at by the finite-difference step of every knob
+_RESPONSE_CHANGES = np.array([3e-4, 3e-4, 3e-2, 3e-2, 3e-4, 3e-4])
+
+# Quantities per point of a knob scan (see scan_knob)
+_SCAN_OBSERVABLES = ['qx', 'qy', 'dqx', 'dqy', 'c_minus']
+
+# Set by tune_lines_parallel and scan_knob before forking the workers
+_parallel_env = None
+
+
+def match_tune_chrom_coupling_newton(line, qx, qy, dqx, dqy, c_minus, tol=1e-6, tol_coupling=5e-5,
+                                     max_steps=10, scenario=None, knobs=None):
+    # Same targets as match_tune_chrom_coupling, but solved with Newton steps on a response matrix
+    # that is calculated once per lattice and scenario (see tune_response), such that every step
+    # only costs one twiss. The response matrix is recalculated once if the steps do not converge.
+    # Returns a dict with whether it converged, the number of steps and twisses, and the residue.
+    knob_names = _TUNE_KNOBS if knobs is None else list(knobs)
+    targets = np.array([qx, qy, dqx, dqy, c_minus, 0.])
+    tols = np.array([tol]*4 + [tol_coupling]*2)
+    key = _response_key(line, scenario, knob_names)
+    n_twiss = 0
+    response = _get_response(key)
+    if response is None:
+        response, n_twiss = _calculate_response(line, knob_names)
+        _store_response(key, response)
+    knobs = np.array([line[kk] for kk in knob_names], dtype=float)
+    residue = _tune_observables(line) - targets
+    n_twiss += 1
+    updated = False
+    n_steps = 0
+    while np.any(np.abs(residue) >= tols) and n_steps < max_steps:
+        # Scale by the tolerances such that all targets weigh the same
+        knobs += np.linalg.lstsq(response / tols[:, None], -residue / tols, rcond=None)[0]
+        for kk, vv in zip(knob_names, knobs):
+            line[kk] = vv
+        new_residue = _tune_observables(line) - targets
+        n_twiss += 1
+        n_steps += 1
+        if not updated and np.linalg.norm(new_residue / tols) > 0.5 * np.linalg.norm(residue / tols):
+            # The machine is too far from where the response was calculated
+            response, n_response = _calculate_response(line, knob_names)
+            _store_response(key, response)
+            n_twiss += n_response
+            updated = True
+        residue = new_residue
+    return {'converged': bool(np.all(np.abs(residue) < tols)), 'n_steps': n_steps, 'n_twiss': n_twiss,
+            'residue': dict(zip(_TUNE_OBSERVABLES, residue.tolist()))}
+
+
+def tune_response(line, scenario=None, update=False, knobs=None):
+    # Response of (qx, qy, dqx, dqy, c_minus_re_0, c_minus_im_0) to (kqtf, kqtd, ksf, ksd, cmrs,
+    # cmis). This hardly changes between error seeds, so it is cached per lattice (the line name and
+    # element names, which the errors do not change), knobs and scenario (any hashable, e.g. the
+    # targets and the octupole and phase knobs). Calculating it on the clean machine before forking
+    # (e.g. in campaign_tools.prepare_environment) shares it with the workers, and
+    # match_tune_chrom_coupling_newton recalculates it when the steps stall on a seed.
+    knobs = _TUNE_KNOBS if knobs is None else list(knobs)
+    key = _response_key(line, scenario, knobs)
+    response = None if update else _get_response(key)
+    if response is None:
+        response, _ = _calculate_response(line, knobs)
+        _store_response(key, response)
+    return response
+
+
+def clear_response_matrices():
+    _response_matrices.clear()
+
+
+def _response_key(line, scenario, knobs):
+    return (line.name, len(line.element_names), hash(tuple(line.element_names)), tuple(knobs), scenario)
+
+
+def _get_response(key):
+    response = _response_matrices.get(key)
+    if response is not None:
+        _response_matrices.move_to_end(key)
+    return response
+
+
+def _store_response(key, response):
+    _response_matrices[key] = response
+    _response_matrices.move_to_end(key)
+    while len(_response_matrices) > _MAX_RESPONSE_MATRICES:
+        _response_matrices.popitem(last=False)
 
 
-def tune_line(line, qx, qy, dqx, dqy, c_minus, i_mo=None, phase_knob=None, orbit_ref=None):
+def _calculate_response(line, knob_names, step=1e-5):
+    # Finite differences around the current knob values, which are restored afterwards. The knobs
+    # have different units (tune, chromaticity and coupling knobs or circuits), so the step of every
+    # knob starts at step*max(1, |value|) and is rescaled once such that it changes the observables
+    # by about _RESPONSE_CHANGES: well above the numerical noise of twiss (mostly in the
+    # chromaticities), and small enough to stay linear. Returns the response and the number of twisses.
+    knobs = [line[kk] for kk in knob_names]
+    reference = _tune_observables(line)
+    n_twiss = 1
+    response = np.zeros((len(_TUNE_OBSERVABLES), len(knob_names)))
+    try:
+        for i, (kk, vv) in enumerate(zip(knob_names, knobs)):
+            this_step = step * max(1., abs(vv))
+            for _ in range(2):
+                line[kk] = vv + this_step
+                response[:, i] = (_tune_observables(line) - reference) / this_step
+                n_twiss += 1
+                change = np.max(np.abs(response[:, i]) * this_step / _RESPONSE_CHANGES)
+                if change == 0 or 0.1 <= change <= 10:
+                    break
+                this_step /= change
+            line[kk] = vv
+    finally:
+        for kk, vv in zip(knob_names, knobs):
+            line[kk] = vv
+    return response, n_twiss
+
+
+def _tune_observables(line):
+    tw = line.twiss(method='6d')
+    return np.array([getattr(tw, oo) for oo in _TUNE_OBSERVABLES], dtype=float)
+
+
+@timed('tune_line[{line.name}]')
+def tune_line(line, qx, qy, dqx, dqy, c_minus, i_mo=None, phase_knob=None, orbit_ref=None, solver='match',
+              knobs=None):
+    # With solver='newton', match_tune_chrom_coupling_newton is tried first (falling back to the
+    # matching if it does not converge). knobs replaces the names of the tuning knobs (see match_tune_chrom).
+    old_twiss_default_method = _prepare_tuning(line, i_mo=i_mo, phase_knob=phase_knob, orbit_ref=orbit_ref)
+    _match_line(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy, c_minus=c_minus, solver=solver, knobs=knobs,
+                scenario=(qx, qy, dqx, dqy, c_minus, i_mo, phase_knob))
+    if old_twiss_default_method:
+        line.twiss_default["method"] = old_twiss_default_method
+
+
+@timed()
+def tune_lines_parallel(env, settings, solver='match'):
+    # Tune the lines at the same time, each in a forked worker. settings is a dict of line names to
+    # the arguments of tune_line. As the tuning knobs (kqtf, ...) are shared by the beams, every
+    # line is matched on its own circuits instead (see beam_tuning_knobs). The tuned values are
+    # merged back as offsets on top of the circuit expressions, such that the shared knobs keep
+    # working. The settings shared by the beams (i_mo, phase_change) are applied before forking,
+    # and a ValueError is raised if the lines ask for different values.
+    global _parallel_env
+    shared = {}
+    for linename, kwargs in settings.items():
+        for name, value in [('i_mo', kwargs.get('i_mo')), ('phase_change', kwargs.get('phase_knob'))]:
+            if not value:
+                continue
+            value = int(value) if name == 'phase_change' else value
+            if name in shared and shared[name][1] != value:
+                raise ValueError(f"Conflicting values for {name}: {shared[name][1]} ({shared[name][0]}) "
+                                 f"and {value} ({linename}).")
+            shared[name] = (linename, value)
+    knobs = {linename: beam_tuning_knobs(env, linename) for linename in settings}
+    conflicts = set.intersection(*[set(kk) for kk in knobs.values()]) if len(knobs) > 1 else set()
+    if conflicts:
+        raise ValueError(f"The lines would vary the same knobs: {sorted(conflicts)}")
+
+    old_twiss_default_methods = {}
+    for linename, kwargs in settings.items():
+        old_twiss_default_methods[linename] = _prepare_tuning(env.lines[linename], i_mo=kwargs.get('i_mo'),
+                                                              phase_knob=kwargs.get('phase_knob'),
+                                                              orbit_ref=kwargs.get('orbit_ref'))
+    # Fork, such that the workers inherit the environment as it is now
+    _parallel_env = env
+    args = [(linename, {kk: vv for kk, vv in kwargs.items() if kk not in ['orbit_ref', 'knobs']},
+             knobs[linename], solver) for linename, kwargs in settings.items()]
+    try:
+        with multiprocessing.get_context('fork').Pool(processes=len(args)) as pool:
+            results = pool.map(_tune_line_worker, args)
+    finally:
+        _parallel_env = None
+
+    for values, response_matrices, steps in results:
+        merge_step_stats(steps)
+        for name, value in values.items():
+            expr = env.ref[name]._expr
+            if expr is None:
+                env[name] = value
+            elif value != env[name]:
+                env[name] = expr + float(value - env[name])
+        for key, response in response_matrices.items():
+            _store_response(key, response)
+    for linename, old_twiss_default_method in old_twiss_default_methods.items():
+        if old_twiss_default_method:
+            env.lines[linename].twiss_default["method"] = old_twiss_default_method
+
+
+def beam_tuning_knobs(env, linename):
+    # The per-beam circuits of the tuning knobs (in the order of _TUNE_KNOBS), as defined by
+    # knob_tools.add_tuning_knobs (the _sq variants if on_sq is set)
+    suffix = '_sq' if env['on_sq'] else ''
+    return [f'{nn}.b{linename[-1]}{suffix}' for nn in _TUNE_CIRCUITS]
+
+
+def scan_knob(env, knob, values, linenames=None, n_processes=None, **twiss_kwargs):
+    # Tunes, chromaticities and c_minus of the lines (all by default) for every value of the knob,
+    # as {linename: {knob: values, 'qx': ..., 'qy': ..., 'dqx': ..., 'dqy': ..., 'c_minus': ...}}.
+    # The values are split in contiguous chunks over forked workers (n_processes defaults to the
+    # number of cores), which inherit the built trackers, and every closed orbit search starts from
+    # the one of the previous value. Points where the twiss fails are nan. The knob is left as is.
+    global _parallel_env
+    if knob not in env.vars:
+        raise KeyError(f"Knob {knob} not found in the environment.")
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    linenames = list(env.lines) if linenames is None else list(linenames)
+    for linename in linenames:
+        if not env.lines[linename]._has_valid_tracker():
+            env.lines[linename].build_tracker()
+    n_processes = max(1, min(n_processes or multiprocessing.cpu_count(), len(values)))
+    args = [(knob, chunk, linenames, twiss_kwargs) for chunk in np.array_split(values, n_processes)]
+
+    _parallel_env = env
+    try:
+        if len(args) == 1:
+            results = [_scan_worker(args[0])]
+        else:
+            with multiprocessing.get_context('fork').Pool(processes=len(args)) as pool:
+                results = pool.map(_scan_worker, args)
+    finally:
+        _parallel_env = None
+
+    return {linename: {knob: values, **{oo: np.concatenate([result[linename][oo] for result in results])
+                                        for oo in _SCAN_OBSERVABLES}}
+            for linename in linenames}
+
+
+def _scan_worker(args):
+    knob, values, linenames, twiss_kwargs = args
+    env = _parallel_env
+    result = {linename: {oo: np.full(len(values), np.nan) for oo in _SCAN_OBSERVABLES} for linename in linenames}
+    co_guess = {}
+    with KnobTransaction(env, restore=True) as transaction:
+        for i, value in enumerate(values):
+            transaction[knob] = value
+            transaction.commit()
+            for linename in linenames:
+                kwargs = {'strengths': False, 'co_guess': co_guess.get(linename), **twiss_kwargs}
+                try:
+                    tw = env.lines[linename].twiss(**kwargs)
+                except Exception as error:
+                    print(f"Twiss of {linename} failed for {knob} = {value}: {error}")
+                    co_guess.pop(linename, None)
+                    continue
+                co_guess[linename] = tw.particle_on_co
+                for oo in _SCAN_OBSERVABLES:
+                    result[linename][oo][i] = getattr(tw, oo)
+    return result
+
+
+def _tune_line_worker(args):
+    linename, kwargs, knobs, solver = args
+    env = _parallel_env
+    existing = set(_response_matrices)
+    reset_steps()  # Only the steps of this worker are merged back
+    with step(f'tune_line[{linename}]'):
+        _match_line(env.lines[linename], qx=kwargs['qx'], qy=kwargs['qy'], dqx=kwargs['dqx'], dqy=kwargs['dqy'],
+                    c_minus=kwargs['c_minus'], solver=solver, knobs=knobs,
+                    scenario=(kwargs['qx'], kwargs['qy'], kwargs['dqx'], kwargs['dqy'], kwargs['c_minus'],
+                              kwargs.get('i_mo'), kwargs.get('phase_knob')))
+    return {kk: env[kk] for kk in knobs}, \
+           {kk: vv for kk, vv in _response_matrices.items() if kk not in existing}, step_stats()
+
+
+def _prepare_tuning(line, i_mo=None, phase_knob=None, orbit_ref=None):
+    # Everything in tune_line before the matching; returns the previous default twiss method
     if i_mo:
         line['i_mo'] = i_mo
     if phase_knob:
@@ -87,19 +407,37 @@ def tune_line(line, qx, qy, dqx, dqy, c_minus, i_mo=None, phase_knob=None, orbit
             raise ValueError('No steering monitors found in the line')
         if isinstance(orbit_ref, xt.Line):
             orbit_ref = orbit_ref.twiss()
-        line.correct_trajectory(twiss_table=orbit_ref)
-    match_tune_chrom(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy, tol=[1e-4, 2e-5, 5e-6, 1e-6])
-    match_coupling(line, c_minus=c_minus, tol=5e-5)
-    match_tune_chrom(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy, tol=[1e-4, 2e-5, 5e-6, 1e-6])
-    if old_twiss_default_method:
-        line.twiss_default["method"] = old_twiss_default_method
+        correct_trajectory(line, twiss_table=orbit_ref)
+    return old_twiss_default_method
+
+
+def _match_line(line, qx, qy, dqx, dqy, c_minus, solver='match', knobs=None, scenario=None):
+    converged = False
+    if solver == 'newton':
+        result = match_tune_chrom_coupling_newton(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy, c_minus=c_minus,
+                                                  scenario=scenario, knobs=knobs)
+        converged = result['converged']
+        if not converged:
+            print(f"Newton tuning did not converge after {result['n_steps']} steps, falling back to matching")
+    elif solver != 'match':
+        raise ValueError(f"Unknown solver {solver}")
+    if not converged:
+        match_tune_chrom(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy, tol=[1e-4, 2e-5, 5e-6, 1e-6], knobs=knobs)
+        match_coupling(line, c_minus=c_minus, tol=5e-5, knobs=knobs)
+        match_tune_chrom(line, qx=qx, qy=qy, dqx=dqx, dqy=dqy, tol=[1e-4, 2e-5, 5e-6, 1e-6], knobs=knobs)
 
 
-def tune_environment_from_config(env, config, orbit_ref=None):
-    for linename, line in env.lines.items():
-        this_orbit_ref = orbit_ref[linename] if orbit_ref else None
-        tune_line(line, qx=config['qx'][linename], qy=config['qy'][linename],
-                  dqx=config['dqx'][linename], dqy=config['dqy'][linename],
-                  c_minus=0.001, i_mo=config['knob_settings'][f'i_oct_b{linename[-1]}'],
-                  phase_knob=config['knob_settings']['phase_knob'],
-                  orbit_ref=this_orbit_ref)
+def tune_environment_from_config(env, config, orbit_ref=None, solver='match', parallel=False):
+    # With parallel, the lines are tuned at the same time on their own circuits (see tune_lines_parallel)
+    settings = {}
+    for linename in env.lines:
+        settings[linename] = dict(qx=config['qx'][linename], qy=config['qy'][linename],
+                                  dqx=config['dqx'][linename], dqy=config['dqy'][linename],
+                                  c_minus=0.001, i_mo=config['knob_settings'][f'i_oct_b{linename[-1]}'],
+                                  phase_knob=config['knob_settings']['phase_knob'],
+                                  orbit_ref=orbit_ref[linename] if orbit_ref else None)
+    if parallel:
+        tune_lines_parallel(env, settings, solver=solver)
+    else:
+        for linename, line in env.lines.items():
+            tune_line(line, **settings[linename], solver=solver)
@@ -0,0 +1,94 @@
+import hashlib
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def cached_twiss(line, **kwargs):
+    # Same as line.twiss(**kwargs), but the table is reused if the line, the twiss options and the
+    # machine state (see state_fingerprint) are the same as in one of the recent calls. The table is
+    # shared with the other callers, so it should not be modified.
+    # Calls with options that are not plain values (e.g. an init or a twiss table) are not cached.
+    return get_twiss_cache(line.env if line.env is not None else line).twiss(line, **kwargs)
+
+
+def get_twiss_cache(env, max_size=16):
+    # One cache per environment (or per line if it has no environment)
+    cache = _caches.get(env)
+    if cache is None:
+        cache = TwissCache(max_size=max_size)
+        _caches[env] = cache
+    return cache
+
+
+def clear_twiss_cache(env):
+    _caches.pop(env, None)
+
+
+def state_fingerprint(line):
+    # Digest of everything twiss depends on besides its options: the element data in the tracker
+    # buffer (so all element strengths, which are updated from the variables), the variable values,
+    # the element order, and the reference particle.
+    if not line._has_valid_tracker():
+        line.build_tracker()
+    digest = hashlib.sha1(line._buffer.buffer)
+    if line.env is not None:
+        values = line.env.ref_manager.containers['vars']._owner
+        digest.update(repr(list(values.items())).encode())
+    digest.update('\n'.join(line.element_names).encode())
+    particle_ref = line.particle_ref
+    if particle_ref is not None:
+        for attr in ['p0c', 'mass0', 'q0', 'x', 'px', 'y', 'py', 'zeta', 'delta']:
+            digest.update(np.ascontiguousarray(getattr(particle_ref, attr)))
+    return digest.hexdigest()
+
+
+class TwissCache:
+    # Twiss tables per (line name, options, state fingerprint), of which the max_size most recently
+    # used are kept. Counts the hits and misses (see stats).
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def twiss(self, line, **kwargs):
+        options = _options_key(line, kwargs)
+        if options is None:
+            self.uncached += 1
+            return line.twiss(**kwargs)
+        key = (line.name, options, state_fingerprint(line))
+        if key in self._tables:
+            self.hits += 1
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        self.misses += 1
+        tw = line.twiss(**kwargs)
+        self._tables[key] = tw
+        while len(self._tables) > self.max_size:
+            self._tables.popitem(last=False)
+        return tw
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'uncached': self.uncached,
+                'size': len(self._tables), 'max_size': self.max_size}
+
+    def clear(self):
+        self._tables.clear()
+
+
+def _options_key(line, kwargs):
+    # The twiss options (including the defaults and the config of the line), or None if they are
+    # not all plain values
+    options = [('kwargs', sorted(kwargs.items())), ('default', sorted(line.twiss_default.items())),
+               ('config', sorted(line.config.items()))]
+    for _, items in options:
+        for _, vv in items:
+            if not isinstance(vv, (str, int, float, bool, type(None), tuple)):
+                return None
+    return repr(options)